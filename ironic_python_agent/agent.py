@@ -384,6 +384,9 @@ class IronicPythonAgent(base.ExecuteCommandMixin):
                 LOG.info('Lookup succeeded, node UUID is %s',
                          self.node['uuid'])
                 hardware.cache_node(self.node)
+                if cfg.CONF.image_prefetch:
+                    self.get_extension('standby').prefetch_node_image(
+                        self.node)
                 self.heartbeat_timeout = content['config']['heartbeat_timeout']
 
                 # Update config with values from Ironic
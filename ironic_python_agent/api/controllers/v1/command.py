@@ -42,9 +42,10 @@ class CommandResult(base.APIBase):
                   CommandResult` object.
         """
         instance = cls()
+        data = result.serialize()
         for field in ('id', 'command_name', 'command_params', 'command_status',
                       'command_error', 'command_result'):
-            setattr(instance, field, getattr(result, field))
+            setattr(instance, field, data[field])
         return instance
 
 
@@ -0,0 +1,53 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from ironic_lib import metrics_utils
+from oslo_config import cfg
+import pecan
+from pecan import rest
+
+from ironic_python_agent import peers
+
+CONF = cfg.CONF
+
+
+class ImageController(rest.RestController):
+    """Controller for serving chunks of images to peer agents."""
+
+    @pecan.expose(content_type='application/octet-stream')
+    def get_one(self, image_id, index):
+        """Get a chunk of an image held by the agent.
+
+        :param image_id: the ID of the image.
+        :param index: the index of the chunk in the block-hash manifest of
+                      the image.
+        :returns: the data of the chunk.
+        """
+        with metrics_utils.get_metrics_logger(__name__).timer('get_one'):
+            if not CONF.image_peer_sharing:
+                pecan.abort(404)
+            try:
+                index = int(index)
+            except ValueError:
+                pecan.abort(400, 'Invalid chunk index {}'.format(index))
+            agent = pecan.request.agent
+            shared_images = agent.get_extension('standby').shared_images
+            # Read first, the chunks held can only grow after.
+            available = shared_images.available(image_id)
+            headers = {}
+            if available is not None:
+                headers[peers.AVAILABLE_HEADER] = str(available)
+            data = shared_images.read_chunk(image_id, index)
+            if data is None:
+                pecan.abort(404, headers=headers)
+            pecan.response.headers.update(headers)
+            return data
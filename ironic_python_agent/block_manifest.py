@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Block-hash manifests of raw images.
+
+A manifest lists the checksum of every fixed-size block of a raw image, so
+that a device already holding a similar image can be compared with it
+block by block. It is a JSON document such as::
+
+    {"size": 10737418240,
+     "block_size": 4194304,
+     "algorithm": "sha256",
+     "blocks": ["9f86d081884c7d65...", ...]}
+
+where the last block may be shorter than block_size.
+"""
+
+import hashlib
+import json
+
+import six
+
+from ironic_python_agent import errors
+
+ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+# Blocks are compared in whole sectors.
+SECTOR_SIZE = 512
+
+
+class Manifest(object):
+    """The block-hash manifest of a raw image."""
+
+    def __init__(self, data):
+        """Parse a manifest.
+
+        :param data: The JSON document, as bytes or a string.
+        :raises: ImageFormatError if the manifest is invalid.
+        """
+        try:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            manifest = json.loads(data)
+            self.size = manifest['size']
+            self.block_size = manifest['block_size']
+            self.algorithm = manifest['algorithm']
+            self.blocks = [block.lower() for block in manifest['blocks']]
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            raise errors.ImageFormatError(
+                'Invalid block manifest: {}'.format(e))
+
+        if (not isinstance(self.size, six.integer_types)
+                or isinstance(self.size, bool) or self.size <= 0):
+            raise errors.ImageFormatError(
+                'Invalid block manifest size {}'.format(self.size))
+        if (not isinstance(self.block_size, six.integer_types)
+                or self.block_size <= 0 or self.block_size % SECTOR_SIZE):
+            raise errors.ImageFormatError(
+                'Block manifest block size must be a positive multiple of '
+                '{}, got {}'.format(SECTOR_SIZE, self.block_size))
+        if self.algorithm not in ALGORITHMS:
+            raise errors.ImageFormatError(
+                'Block manifest algorithm must be one of {}, got '
+                '{}'.format(', '.join(ALGORITHMS), self.algorithm))
+        expected = (self.size + self.block_size - 1) // self.block_size
+        if len(self.blocks) != expected:
+            raise errors.ImageFormatError(
+                'Block manifest has {} blocks, expected {}'.format(
+                    len(self.blocks), expected))
+
+    def to_json(self):
+        """Get the JSON document of the manifest."""
+        return json.dumps({'size': self.size,
+                           'block_size': self.block_size,
+                           'algorithm': self.algorithm,
+                           'blocks': self.blocks})
+
+    @property
+    def block_count(self):
+        return len(self.blocks)
+
+    def block_range(self, index):
+        """Get the location of a block in the image.
+
+        :param index: The index of the block.
+        :returns: A tuple of the offset and the length of the block.
+        """
+        offset = index * self.block_size
+        return offset, min(self.block_size, self.size - offset)
+
+    def matches(self, index, data):
+        """Check whether data is identical to a block of the image.
+
+        :param index: The index of the block.
+        :param data: The data to compare with the block.
+        :returns: True if the checksum of data is the one of the block.
+        """
+        hasher = getattr(hashlib, self.algorithm)()
+        hasher.update(data)
+        return hasher.hexdigest() == self.blocks[index]
+
+    def ranges(self, indexes, max_length):
+        """Merge blocks into contiguous ranges of the image.
+
+        :param indexes: The indexes of the blocks, in ascending order.
+        :param max_length: The maximum length of a range. Blocks larger
+                           than it make up a range on their own.
+        :returns: A list of (offset, length) tuples.
+        """
+        ranges = []
+        for index in indexes:
+            offset, length = self.block_range(index)
+            if ranges:
+                last_offset, last_length = ranges[-1]
+                if (last_offset + last_length == offset
+                        and last_length + length <= max_length):
+                    ranges[-1] = (last_offset, last_length + length)
+                    continue
+            ranges.append((offset, length))
+        return ranges
+
+
+class Builder(object):
+    """Builds the manifest of a raw image from its data."""
+
+    def __init__(self, block_size, algorithm='sha256'):
+        """Start building a manifest.
+
+        :param block_size: The size of the blocks, a multiple of
+                           SECTOR_SIZE.
+        :param algorithm: The checksum algorithm of the blocks.
+        """
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self._buffer = bytearray()
+        self._blocks = []
+        self._size = 0
+
+    def _add(self, block):
+        hasher = getattr(hashlib, self.algorithm)()
+        hasher.update(block)
+        digest = hasher.hexdigest()
+        self._blocks.append(digest)
+        return digest, block
+
+    def update(self, data):
+        """Add the next data of the image.
+
+        :param data: The data, as bytes or any object supporting the buffer
+                     protocol.
+        :returns: A list of (checksum, data) tuples of the blocks completed.
+        """
+        self._buffer += data
+        self._size += len(data)
+        blocks = []
+        while len(self._buffer) >= self.block_size:
+            blocks.append(self._add(bytes(self._buffer[:self.block_size])))
+            del self._buffer[:self.block_size]
+        return blocks
+
+    def finish(self):
+        """Complete the last block.
+
+        :returns: A tuple of the list of (checksum, data) tuples of the last
+                  block, if any, and of the Manifest, None if the image is
+                  empty.
+        """
+        blocks = []
+        if self._buffer:
+            blocks.append(self._add(bytes(self._buffer)))
+            self._buffer = bytearray()
+        if not self._size:
+            return blocks, None
+        return blocks, Manifest(json.dumps({
+            'size': self._size,
+            'block_size': self.block_size,
+            'algorithm': self.algorithm,
+            'blocks': self._blocks}))
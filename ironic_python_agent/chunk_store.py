@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent store of the chunks of downloaded images.
+
+The chunks of an image are the blocks of its block-hash manifest (see
+block_manifest). They are kept in a directory outside of the install
+device, one file per chunk named after its checksum, so that they survive
+restarts of the agent and are shared by all the images holding them. The
+manifests of the images are kept next to them, so that an image whose
+server has no manifest can still be pieced together from the store.
+
+The store is limited in size: the chunks used least recently are removed
+when it grows larger than its budget.
+"""
+
+import os
+import threading
+
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import block_manifest
+from ironic_python_agent import errors
+
+CONF = cfg.CONF
+LOG = log.getLogger(__name__)
+
+# Block size of the manifests built for images whose server has none.
+CHUNK_SIZE = 4 * units.Mi
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+class ChunkStore(object):
+    """A directory holding chunks of images by checksum."""
+
+    def __init__(self, path, max_size):
+        """Open a chunk store, creating it if needed.
+
+        :param path: The directory of the store.
+        :param max_size: The maximum size of the chunks held, in bytes.
+        :raises: EnvironmentError if the directory cannot be set up.
+        """
+        self.path = path
+        self.max_size = max_size
+        self._chunks_dir = os.path.join(path, 'chunks')
+        self._manifests_dir = os.path.join(path, 'manifests')
+        for directory in (self._chunks_dir, self._manifests_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._lock = threading.Lock()
+        self.size = 0
+        for name in os.listdir(self._chunks_dir):
+            path = os.path.join(self._chunks_dir, name)
+            if name.endswith('.tmp'):
+                # Left over by an agent which stopped while storing it.
+                os.unlink(path)
+            else:
+                self.size += os.path.getsize(path)
+
+    def _chunk_path(self, algorithm, digest):
+        return os.path.join(self._chunks_dir,
+                            '{}-{}'.format(algorithm, digest))
+
+    def get(self, algorithm, digest):
+        """Read a chunk.
+
+        :param algorithm: The checksum algorithm of the chunk.
+        :param digest: The checksum of the chunk.
+        :returns: The data of the chunk, None if it is not held.
+        """
+        path = self._chunk_path(algorithm, digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time orders the chunks by last use.
+            os.utime(path, None)
+        except EnvironmentError:
+            return None
+        return data
+
+    def put(self, algorithm, digest, data):
+        """Add a chunk, removing the least recently used ones if needed.
+
+        Failing to store a chunk is only logged.
+
+        :param algorithm: The checksum algorithm of the chunk.
+        :param digest: The checksum of the chunk, it is not checked.
+        :param data: The data of the chunk.
+        """
+        path = self._chunk_path(algorithm, digest)
+        if len(data) > self.max_size:
+            return
+        if os.path.exists(path):
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except EnvironmentError as e:
+            LOG.warning('Unable to store chunk %(digest)s in %(path)s: '
+                        '%(err)s', {'digest': digest, 'path': self.path,
+                                    'err': e})
+            try:
+                os.unlink(tmp_path)
+            except EnvironmentError:
+                pass
+            return
+        with self._lock:
+            self.size += len(data)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used chunks until the store fits."""
+        chunks = []
+        for name in os.listdir(self._chunks_dir):
+            path = os.path.join(self._chunks_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            chunks.append((stat.st_mtime, stat.st_size, path))
+        chunks.sort()
+        self.size = sum(size for mtime, size, path in chunks)
+        removed = 0
+        for mtime, size, path in chunks:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self.size -= size
+            removed += 1
+        LOG.debug('Removed %(count)d chunks from %(path)s, %(size)d bytes '
+                  'left', {'count': removed, 'path': self.path,
+                           'size': self.size})
+
+    def _manifest_path(self, key):
+        return os.path.join(self._manifests_dir, key)
+
+    def save_manifest(self, key, manifest):
+        """Save the manifest of an image.
+
+        :param key: The key of the image, a valid file name.
+        :param manifest: The block_manifest.Manifest of the image.
+        """
+        path = self._manifest_path(key)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(manifest.to_json())
+            os.rename(path + '.tmp', path)
+        except EnvironmentError as e:
+            LOG.warning('Unable to store manifest %(key)s in %(path)s: '
+                        '%(err)s', {'key': key, 'path': self.path, 'err': e})
+
+    def load_manifest(self, key):
+        """Load the manifest of an image.
+
+        :param key: The key of the image.
+        :returns: The block_manifest.Manifest of the image, None if it is
+                  not held.
+        """
+        try:
+            with open(self._manifest_path(key), 'rb') as f:
+                return block_manifest.Manifest(f.read())
+        except EnvironmentError:
+            return None
+        except errors.ImageFormatError as e:
+            LOG.warning('Ignoring invalid stored manifest %(key)s: %(err)s',
+                        {'key': key, 'err': e})
+            return None
+
+
+def get_store():
+    """Get the chunk store configured with CONF.image_chunk_store_dir.
+
+    :returns: The ChunkStore, None if there is none or it cannot be set up.
+    """
+    path = CONF.image_chunk_store_dir
+    if not path:
+        return None
+    with _STORES_LOCK:
+        store = _STORES.get(path)
+        if store is None:
+            try:
+                store = ChunkStore(
+                    path, CONF.image_chunk_store_max_size * units.Mi)
+            except EnvironmentError as e:
+                LOG.warning('Unable to use %(path)s as chunk store: '
+                            '%(err)s', {'path': path, 'err': e})
+                return None
+            _STORES[path] = store
+    store.max_size = CONF.image_chunk_store_max_size * units.Mi
+    return store
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental decompression of compressed images.
+
+Images are decompressed chunk by chunk as they are downloaded, the output
+is produced in chunks of bounded size however well the image compresses.
+gzip is always supported, xz requires the lzma module and zstd the
+zstandard package.
+"""
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from ironic_python_agent import errors
+
+GZIP = 'gzip'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+MAGIC = {
+    GZIP: b'\x1f\x8b',
+    XZ: b'\xfd7zXZ\x00',
+    ZSTD: b'\x28\xb5\x2f\xfd',
+}
+
+# Longest magic number, enough of the image to detect its compression.
+MAGIC_SIZE = max(len(magic) for magic in MAGIC.values())
+
+# Decode the gzip header and trailer.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+_ERRORS = (zlib.error,)
+if lzma is not None:
+    _ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    _ERRORS += (zstandard.ZstdError,)
+
+
+def detect(data):
+    """Detect the compression of an image from its first bytes.
+
+    :param data: At least the first MAGIC_SIZE bytes of the image, unless
+                 it is smaller.
+    :returns: GZIP, XZ or ZSTD, or None if the image is not compressed with
+              any of them.
+    """
+    for algorithm, magic in MAGIC.items():
+        if data[:len(magic)] == magic:
+            return algorithm
+    return None
+
+
+def _gunzip(chunks, chunk_size):
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    for data in chunks:
+        while data:
+            out = decompressor.decompress(data, chunk_size)
+            if out:
+                yield out
+            # Output may still be pending after a full chunk.
+            while (len(out) == chunk_size
+                    and not decompressor.unconsumed_tail):
+                out = decompressor.decompress(b'', chunk_size)
+                if out:
+                    yield out
+            data = decompressor.unconsumed_tail
+            if decompressor.unused_data:
+                # Another gzip member follows, as written by pigz or cat.
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(_GZIP_WBITS)
+    # NOTE: Python 2 cannot tell whether the last member is complete.
+    if not getattr(decompressor, 'eof', True):
+        raise errors.ImageFormatError('gzip compressed image is truncated')
+
+
+def _unxz(chunks, chunk_size):
+    if lzma is None:
+        raise errors.ImageFormatError(
+            'xz compressed images require the lzma module')
+    decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    for data in chunks:
+        while True:
+            if decompressor.eof:
+                if not data:
+                    break
+                # Another stream follows.
+                decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            out = decompressor.decompress(data, chunk_size)
+            if out:
+                yield out
+            data = decompressor.unused_data if decompressor.eof else b''
+            if not data and (decompressor.eof or decompressor.needs_input):
+                break
+    if not decompressor.eof:
+        raise errors.ImageFormatError('xz compressed image is truncated')
+
+
+class _ChunkFile(object):
+    """Adapts an iterable of chunks to the read() interface."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def read(self, size):
+        if not self._pending:
+            self._pending = next(self._chunks, b'')
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+
+def _unzstd(chunks, chunk_size):
+    if zstandard is None:
+        raise errors.ImageFormatError(
+            'zstd compressed images require the zstandard package')
+    decompressor = zstandard.ZstdDecompressor()
+    for out in decompressor.read_to_iter(_ChunkFile(chunks),
+                                         write_size=chunk_size):
+        yield out
+
+
+_DECOMPRESSORS = {GZIP: _gunzip, XZ: _unxz, ZSTD: _unzstd}
+
+
+def decompress(chunks, algorithm, chunk_size):
+    """Decompress an image incrementally.
+
+    :param chunks: An iterable yielding the compressed image in chunks.
+    :param algorithm: The compression of the image, GZIP, XZ or ZSTD.
+    :param chunk_size: The maximum size of the decompressed chunks.
+    :raises: ImageFormatError if the image is corrupt or truncated, or the
+             module needed to decompress it is missing.
+    :returns: A generator yielding the decompressed image in chunks.
+    """
+    try:
+        for out in _DECOMPRESSORS[algorithm](chunks, chunk_size):
+            yield out
+    except _ERRORS as e:
+        raise errors.ImageFormatError(
+            'Invalid {} compressed image: {}'.format(algorithm, e))
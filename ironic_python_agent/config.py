@@ -209,6 +209,255 @@ cli_opts = [
                     'Must be provided together with "certfile" option. '
                     'Default is to not present any client certificates to '
                     'the server.'),
+    cfg.IntOpt('image_download_connections',
+               min=1,
+               default=APARAMS.get('ipa-image-download-connections', 1),
+               help='The number of concurrent HTTP connections used to '
+                    'download an image when the image server supports '
+                    'range requests. The default of 1 downloads the image '
+                    'over a single stream. Can be overridden per image by '
+                    'the "download_connections" key of image_info. '
+                    'Can be supplied as "ipa-image-download-connections" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_download_retries',
+               min=0,
+               default=APARAMS.get('ipa-image-download-retries', 3),
+               help='The maximum number of times an interrupted image '
+                    'download is resumed with a range request, from the '
+                    'same URL first and from the next URL of the image '
+                    'after that. Set to 0 to fail the download on the '
+                    'first error. Can be supplied as '
+                    '"ipa-image-download-retries" kernel parameter.'),
+    cfg.IntOpt('image_write_queue_size',
+               min=1,
+               default=APARAMS.get('ipa-image-write-queue-size', 8),
+               help='The maximum number of downloaded chunks (of 1 MiB '
+                    'each) buffered between the download and the device '
+                    'write when streaming a raw image. Bounds the memory '
+                    'used by streaming. '
+                    'Can be supplied as "ipa-image-write-queue-size" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_stream_direct_io',
+                default=APARAMS.get('ipa-image-stream-direct-io', False),
+                help='Whether to bypass the page cache (O_DIRECT) when '
+                     'streaming raw images onto a device, reading the '
+                     'image into a pool of reusable page-aligned buffers. '
+                     'Can be overridden per image by the '
+                     '"stream_direct_io" key of image_info. '
+                     'Can be supplied as "ipa-image-stream-direct-io" '
+                     'kernel parameter.'),
+    cfg.BoolOpt('image_stream_qcow2',
+                default=APARAMS.get('ipa-image-stream-qcow2', False),
+                help='Whether to convert whole disk qcow2 images to raw '
+                     'while streaming them onto the device, instead of '
+                     'caching them in memory and converting them with '
+                     'qemu-img. Requires an image server supporting range '
+                     'requests. Can be overridden per image by the '
+                     '"stream_qcow2_images" key of image_info. '
+                     'Can be supplied as "ipa-image-stream-qcow2" '
+                     'kernel parameter.'),
+    cfg.StrOpt('image_download_url_selection',
+               default=APARAMS.get('ipa-image-download-url-selection',
+                                   'ordered'),
+               choices=['ordered', 'fastest'],
+               help='How to pick the URL to download an image from. '
+                    '"ordered" uses the first URL of the image which '
+                    'responds. "fastest" probes all URLs concurrently, '
+                    'measuring the time to the first byte and the '
+                    'throughput of a short sample, and downloads from the '
+                    'fastest one. Can be overridden per image by the '
+                    '"url_selection" key of image_info. Can be supplied as '
+                    '"ipa-image-download-url-selection" kernel parameter.'),
+    cfg.IntOpt('image_download_min_rate',
+               min=0,
+               default=APARAMS.get('ipa-image-download-min-rate', 0),
+               help='The minimum throughput, in KiB per second, of an image '
+                    'download. When the throughput of a single stream '
+                    'download stays below it for '
+                    'image_download_min_rate_period seconds, the download '
+                    'switches to the next URL of the image with a range '
+                    'request. Set to 0 to never switch. Can be supplied as '
+                    '"ipa-image-download-min-rate" kernel parameter.'),
+    cfg.IntOpt('image_download_min_rate_period',
+               min=1,
+               default=APARAMS.get('ipa-image-download-min-rate-period',
+                                   30),
+               help='The number of seconds the throughput of an image '
+                    'download has to stay below image_download_min_rate '
+                    'before switching to another URL. Can be supplied as '
+                    '"ipa-image-download-min-rate-period" kernel '
+                    'parameter.'),
+    cfg.ListOpt('image_staging_dirs',
+                default=APARAMS.get('ipa-image-staging-dirs', []),
+                help='Directories to cache images in when they do not fit '
+                     'in /tmp, which is held in memory on most ramdisks. '
+                     'They should be on mounted file systems of local disks '
+                     'other than the install device, directories on the '
+                     'install device are never used. Images which fit '
+                     'nowhere are streamed onto the device if possible. '
+                     'Can be supplied as "ipa-image-staging-dirs" kernel '
+                     'parameter.'),
+    cfg.IntOpt('image_staging_memory_reserve',
+               min=0,
+               default=APARAMS.get('ipa-image-staging-memory-reserve', 512),
+               help='The amount of memory, in MiB, to keep available when '
+                    'caching an image on a memory backed file system such '
+                    'as the /tmp of the ramdisk. Can be supplied as '
+                    '"ipa-image-staging-memory-reserve" kernel parameter.'),
+    cfg.BoolOpt('image_delta_deploy',
+                default=APARAMS.get('ipa-image-delta-deploy', False),
+                help='Whether to only write the blocks of whole disk raw '
+                     'images which differ from the content of the device. '
+                     'The device is compared with the block-hash manifest '
+                     'of the image, published at its URL with a '
+                     '".blockmap" suffix unless the "block_manifest_url" '
+                     'key of image_info is set, and only the changed '
+                     'blocks are downloaded with range requests. Falls '
+                     'back to writing the whole image when there is no '
+                     'manifest. Can be overridden per image by the '
+                     '"delta_deploy" key of image_info. Can be supplied as '
+                     '"ipa-image-delta-deploy" kernel parameter.'),
+    cfg.IntOpt('image_delta_scan_workers',
+               min=1,
+               default=APARAMS.get('ipa-image-delta-scan-workers', 4),
+               help='The number of threads reading the device in parallel '
+                    'to compare it with the block-hash manifest of an image '
+                    'during a delta deploy. Can be supplied as '
+                    '"ipa-image-delta-scan-workers" kernel parameter.'),
+    cfg.BoolOpt('image_verify_writes',
+                default=APARAMS.get('ipa-image-verify-writes', False),
+                help='Whether to read raw images streamed onto a device '
+                     'back from it, bypassing the page cache, and compare '
+                     'them with a checksum of every range computed while '
+                     'writing them. Detects data which did not land on the '
+                     'disk as it was written. Can be overridden per image '
+                     'by the "verify_writes" key of image_info. Can be '
+                     'supplied as "ipa-image-verify-writes" kernel '
+                     'parameter.'),
+    cfg.IntOpt('image_verify_workers',
+               min=1,
+               default=APARAMS.get('ipa-image-verify-workers', 4),
+               help='The number of threads reading an image back from the '
+                    'device in parallel when image_verify_writes is '
+                    'enabled, each one verifying its own part of the '
+                    'image. Can be supplied as "ipa-image-verify-workers" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_peer_sharing',
+                default=APARAMS.get('ipa-image-peer-sharing', False),
+                help='Whether to serve the images held by the agent, and '
+                     'the parts of raw images already written while they '
+                     'are being streamed, to other agents deploying the '
+                     'same image. Agents download from the peers listed in '
+                     'the "peers" key of image_info, checking every chunk '
+                     'against the block-hash manifest of the image. Can be '
+                     'supplied as "ipa-image-peer-sharing" kernel '
+                     'parameter.'),
+    cfg.IntOpt('image_download_max_rate',
+               min=0,
+               default=APARAMS.get('ipa-image-download-max-rate', 0),
+               help='The maximum throughput, in KiB per second, of an image '
+                    'download, to keep deployments from saturating shared '
+                    'network links. Can be overridden by the '
+                    '"download_max_rate" key of image_info. Set to 0 to not '
+                    'limit downloads. Can be supplied as '
+                    '"ipa-image-download-max-rate" kernel parameter.'),
+    cfg.IntOpt('image_download_ramp_up',
+               min=0,
+               default=APARAMS.get('ipa-image-download-ramp-up', 0),
+               help='The number of seconds over which the throughput '
+                    'allowed by image_download_max_rate rises from a tenth '
+                    'of it to all of it at the start of a download, so that '
+                    'nodes starting to deploy at once do not all take the '
+                    'whole bandwidth at the same time. Can be overridden by '
+                    'the "download_ramp_up" key of image_info. Can be '
+                    'supplied as "ipa-image-download-ramp-up" kernel '
+                    'parameter.'),
+    cfg.StrOpt('image_write_strategy',
+               default=APARAMS.get('ipa-image-write-strategy', 'auto'),
+               choices=['auto', 'rotational', 'ssd', 'nvme', 'directsync'],
+               help='How cached whole disk images are written to the '
+                    'device with qemu-img. "rotational" writes in order '
+                    'through the page cache with a single flush at the end, '
+                    '"ssd" and "nvme" bypass the page cache with several '
+                    'concurrent, out of order writes, and "directsync" '
+                    'waits for every write to reach the disk. "auto" picks '
+                    'the strategy matching the kind of the device, or '
+                    '"directsync" if it is unknown. Can be supplied as '
+                    '"ipa-image-write-strategy" kernel parameter.'),
+    cfg.BoolOpt('image_prefetch',
+                default=APARAMS.get('ipa-image-prefetch', False),
+                help='Whether to start downloading the image of the node '
+                     'in the background as soon as the instance information '
+                     'received at lookup names it, so that a later '
+                     'cache_image or prepare_image command for it uses the '
+                     'prefetched image instead of downloading it again. '
+                     'Images can also be prefetched with the prefetch_image '
+                     'command. Can be supplied as "ipa-image-prefetch" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_prefetch_max_rate',
+               min=0,
+               default=APARAMS.get('ipa-image-prefetch-max-rate', 0),
+               help='The maximum throughput, in KiB per second, of the '
+                    'background download of a prefetched image, to keep '
+                    'it from competing with the work the agent does '
+                    'meanwhile. Set to 0 to use image_download_max_rate. '
+                    'Can be supplied as "ipa-image-prefetch-max-rate" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_kexec',
+                default=APARAMS.get('ipa-image-kexec', False),
+                help='Whether run_image boots the deployed image with kexec '
+                     'instead of rebooting the machine, skipping its '
+                     'firmware. Only the device the image was written to is '
+                     'flushed first. The machine is rebooted if no kernel is '
+                     'found on the image or kexec fails. Can be supplied as '
+                     '"ipa-image-kexec" kernel parameter.'),
+    cfg.StrOpt('image_chunk_store_dir',
+               default=APARAMS.get('ipa-image-chunk-store-dir'),
+               help='A directory, on a disk other than the install device, '
+                    'keeping the chunks of downloaded images by checksum '
+                    'across restarts of the agent. Images are pieced '
+                    'together from the chunks held there, only the missing '
+                    'ones being downloaded, provided that their server '
+                    'supports range requests. Not used if empty. Can be '
+                    'supplied as "ipa-image-chunk-store-dir" kernel '
+                    'parameter.'),
+    cfg.IntOpt('image_chunk_store_max_size',
+               min=1,
+               default=APARAMS.get('ipa-image-chunk-store-max-size', 10240),
+               help='The maximum size, in MiB, of the chunks kept in '
+                    'image_chunk_store_dir. The chunks used least recently '
+                    'are removed beyond it. Can be supplied as '
+                    '"ipa-image-chunk-store-max-size" kernel parameter.'),
+    cfg.BoolOpt('image_region_writes',
+                default=APARAMS.get('ipa-image-region-writes', False),
+                help='Whether to stream uncompressed raw images, whose '
+                     'server supports range requests, onto non-rotational '
+                     'devices as regions written in parallel, each one '
+                     'downloaded over its own connection. The number of '
+                     'regions follows the depth of the request queue of '
+                     'the device. The image is read back from the device '
+                     'once written to verify it. Can be overridden per '
+                     'image by the "region_writes" key of image_info. Can '
+                     'be supplied as "ipa-image-region-writes" kernel '
+                     'parameter.'),
+    cfg.IntOpt('image_region_max_writers',
+               min=1,
+               default=APARAMS.get('ipa-image-region-max-writers', 16),
+               help='The maximum number of regions of an image written in '
+                    'parallel when image_region_writes is enabled. Can be '
+                    'supplied as "ipa-image-region-max-writers" kernel '
+                    'parameter.'),
+    cfg.BoolOpt('image_stream_splice',
+                default=APARAMS.get('ipa-image-stream-splice', False),
+                help='Whether to move uncompressed raw images downloaded '
+                     'over a single plain HTTP connection from the socket '
+                     'to the device with splice, without copying them to '
+                     'user space. Only a copy made with tee is read, to '
+                     'compute the checksums of the image. Images written '
+                     'as regions with image_region_writes are not spliced. '
+                     'Can be overridden per image by the "stream_splice" '
+                     'key of image_info. Can be supplied as '
+                     '"ipa-image-stream-splice" kernel parameter.'),
 ]
 
 CONF.register_cli_opts(cli_opts)
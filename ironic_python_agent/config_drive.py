@@ -0,0 +1,296 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming of config drives onto their partition.
+
+A config drive is given either as gzip compressed, base64 encoded content
+or as a URL serving such content, or the plain ISO image. It is decoded
+and decompressed chunk by chunk while being written to the config drive
+partition, so that no copy of the whole config drive is kept in memory or
+in a temporary file.
+"""
+
+import base64
+import binascii
+import os
+import re
+import shlex
+
+from ironic_lib import disk_utils
+from ironic_lib import exception
+from ironic_lib import utils as il_utils
+from oslo_concurrency import processutils
+from oslo_log import log
+from oslo_utils import units
+import six
+
+from ironic_python_agent import compression
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+CHUNK_SIZE = units.Mi
+
+MAX_SIZE = disk_utils.MAX_CONFIG_DRIVE_SIZE_MB * units.Mi
+
+CONFIGDRIVE_LABEL = 'config-2'
+
+_BASE64_TEXT = re.compile(b'^[A-Za-z0-9+/=\\s]*$')
+_NOT_BASE64 = re.compile(b'[^A-Za-z0-9+/=]')
+
+_BASE64_ERRORS = (TypeError, ValueError, binascii.Error)
+
+
+def text_chunks(data, chunk_size=CHUNK_SIZE):
+    """Split the content of a config drive given inline into chunks.
+
+    :param data: The content of the config drive, as a string.
+    :param chunk_size: The size of the chunks.
+    :returns: A generator yielding the content in chunks.
+    """
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def _as_bytes(chunk):
+    if isinstance(chunk, six.text_type):
+        # Base64 encoded content is plain ASCII.
+        chunk = chunk.encode('ascii')
+    return chunk
+
+
+def _base64_decoded(chunks):
+    pending = b''
+    for chunk in chunks:
+        # NOTE: Like base64.b64decode(), characters out of the alphabet such
+        # as line breaks are ignored.
+        data = pending + _NOT_BASE64.sub(b'', chunk)
+        usable = len(data) - len(data) % 4
+        pending = data[usable:]
+        if usable:
+            yield base64.b64decode(data[:usable])
+    if pending:
+        # Raises the error of the incorrect padding.
+        yield base64.b64decode(pending)
+
+
+def _decoded(chunks):
+    chunks = (_as_bytes(chunk) for chunk in chunks)
+    first = next(chunks, b'')
+    chunks = _chain([first], chunks)
+    if _BASE64_TEXT.match(first):
+        chunks = compression.decompress(_base64_decoded(chunks),
+                                        compression.GZIP, CHUNK_SIZE)
+    else:
+        LOG.debug('Config drive is not base64 encoded, assuming binary')
+    for data in chunks:
+        yield data
+
+
+def _chain(head, chunks):
+    for chunk in head:
+        yield chunk
+    for chunk in chunks:
+        yield chunk
+
+
+def decode(chunks, node_uuid):
+    """Decode a config drive incrementally.
+
+    Content which looks base64 encoded is decoded and decompressed, any
+    other content is taken as the plain config drive image.
+
+    :param chunks: An iterable yielding the content of the config drive in
+                   chunks of bytes or of text.
+    :param node_uuid: UUID of the node, for logging.
+    :raises: InstanceDeployFailure if the content is malformed.
+    :returns: A generator yielding the config drive image in chunks.
+    """
+    try:
+        for data in _decoded(chunks):
+            yield data
+    except _BASE64_ERRORS + (errors.ImageFormatError,) as e:
+        raise exception.InstanceDeployFailure(
+            'Config drive for node {} is not base64 encoded or the content '
+            'is malformed. {}: {}.'.format(node_uuid, type(e).__name__, e))
+
+
+def _partition_table_type(device):
+    stdout, _err = il_utils.execute('blkid', '-p', '-o', 'value', '-s',
+                                    'PTTYPE', device, use_standard_locale=True,
+                                    run_as_root=True)
+    return stdout.strip().lower()
+
+
+def _disk_size_mb(device):
+    stdout, _err = il_utils.execute('blockdev', '--getsize64', device,
+                                    use_standard_locale=True,
+                                    run_as_root=True)
+    return int(stdout.strip()) // units.Mi
+
+
+def _rescan(device):
+    il_utils.execute('partprobe', device, run_as_root=True, attempts=10,
+                     delay_on_retry=True)
+    il_utils.execute('udevadm', 'settle')
+
+
+def _partition_path(device, number):
+    # Like the kernel names them, e.g. /dev/sda2 but /dev/nvme0n1p2.
+    separator = 'p' if device[-1].isdigit() else ''
+    return '{}{}{}'.format(device, separator, number)
+
+
+def _labelled_partition(device, label, node_uuid):
+    """Find the partition of a device with a file system label.
+
+    :returns: The path of the partition, or None if there is none.
+    """
+    _rescan(device)
+    stdout, _err = il_utils.execute('lsblk', '-Po', 'name,label', device,
+                                    check_exit_code=[0, 1],
+                                    use_standard_locale=True,
+                                    run_as_root=True)
+    found = []
+    for line in stdout.splitlines():
+        fields = dict(field.split('=', 1) for field in shlex.split(line))
+        if fields.get('LABEL') == label:
+            found.append('/dev/' + fields['NAME'].strip())
+    if len(found) > 1:
+        raise exception.InstanceDeployFailure(
+            'More than one partition with label "{}" exists on device {} '
+            'for node {}: {}.'.format(label, device, node_uuid,
+                                      ' and '.join(found)))
+    return found[0] if found else None
+
+
+def _create_partition(node_uuid, device):
+    """Create a partition for the config drive at the end of a device.
+
+    :returns: The path of the new partition.
+    """
+    disk_utils.fix_gpt_partition(device, node_uuid)
+    cur_parts = set(part['number']
+                    for part in disk_utils.list_partitions(device))
+
+    if _partition_table_type(device) == 'gpt':
+        il_utils.execute('sgdisk', '-n',
+                         '0:-%dMB:0' % disk_utils.MAX_CONFIG_DRIVE_SIZE_MB,
+                         device, run_as_root=True)
+    else:
+        try:
+            pp_count, lp_count = disk_utils.count_mbr_partitions(device)
+        except ValueError as e:
+            raise exception.InstanceDeployFailure(
+                'Failed to check the number of primary partitions present '
+                'on {} for node {}. Error: {}'.format(device, node_uuid, e))
+        if pp_count > 3:
+            raise exception.InstanceDeployFailure(
+                'Config drive cannot be created for node {}. Disk ({}) uses '
+                'MBR partitioning and already has {} primary '
+                'partitions.'.format(node_uuid, device, pp_count))
+
+        startlimit = '-%dMiB' % disk_utils.MAX_CONFIG_DRIVE_SIZE_MB
+        endlimit = '-0'
+        if (_disk_size_mb(device)
+                > disk_utils.MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR):
+            # Need to create a small partition at 2TB limit
+            LOG.warning('Disk size is larger than 2TB for node %(node)s. '
+                        'Creating config drive at the end of the disk '
+                        '%(disk)s.', {'node': node_uuid, 'disk': device})
+            startlimit = (disk_utils.MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR
+                          - disk_utils.MAX_CONFIG_DRIVE_SIZE_MB - 1)
+            endlimit = disk_utils.MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR - 1
+        il_utils.execute('parted', '-a', 'optimal', '-s', '--', device,
+                         'mkpart', 'primary', 'fat32', startlimit, endlimit,
+                         run_as_root=True)
+    _rescan(device)
+
+    new_parts = set(part['number']
+                    for part in disk_utils.list_partitions(device)) - cur_parts
+    if len(new_parts) != 1:
+        raise exception.InstanceDeployFailure(
+            'Disk partitioning failed on device {}. Unable to retrieve '
+            'config drive partition information.'.format(device))
+    partition = _partition_path(device, new_parts.pop())
+
+    LOG.debug('Waiting for the config drive partition %(part)s on node '
+              '%(node)s to be ready for writing.',
+              {'part': partition, 'node': node_uuid})
+    il_utils.execute('test', '-e', partition, attempts=15,
+                     delay_on_retry=True)
+    return partition
+
+
+def _write(chunks, partition, node_uuid):
+    """Write the config drive image to its partition.
+
+    :returns: The size of the config drive in bytes.
+    """
+    size = 0
+    fd = os.open(partition, os.O_WRONLY)
+    try:
+        for data in chunks:
+            size += len(data)
+            if size > MAX_SIZE:
+                raise exception.InstanceDeployFailure(
+                    'Config drive size exceeds maximum limit of {}MiB for '
+                    'node {}.'.format(disk_utils.MAX_CONFIG_DRIVE_SIZE_MB,
+                                      node_uuid))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return size
+
+
+def write_partition(node_uuid, device, chunks, partition=None):
+    """Write a config drive to its partition, creating it if needed.
+
+    The content of the config drive is checked to start properly before
+    the device is partitioned.
+
+    :param node_uuid: UUID of the node.
+    :param device: The device path.
+    :param chunks: An iterable yielding the content of the config drive, as
+                   passed to decode().
+    :param partition: The path of the config drive partition, if it was
+                      already created. By default the partition labelled
+                      as a config drive on the device is used, or a new
+                      partition is created at its end.
+    :raises: InstanceDeployFailure if the config drive is malformed or
+             larger than its partition, or if it fails to write it.
+    """
+    chunks = decode(chunks, node_uuid)
+    try:
+        head = [next(chunks, b'')]
+        if partition is None:
+            partition = _labelled_partition(device, CONFIGDRIVE_LABEL,
+                                            node_uuid)
+            if partition:
+                LOG.debug('Configdrive for node %(node)s exists at '
+                          '%(part)s', {'node': node_uuid, 'part': partition})
+                disk_utils.fix_gpt_partition(device, node_uuid)
+            else:
+                partition = _create_partition(node_uuid, device)
+        size = _write(_chain(head, chunks), partition, node_uuid)
+    except (processutils.UnknownArgumentError,
+            processutils.ProcessExecutionError, OSError) as e:
+        msg = ('Failed to create config drive on disk {} for node {}. '
+               'Error: {}'.format(device, node_uuid, e))
+        LOG.error(msg)
+        raise exception.InstanceDeployFailure(msg)
+    LOG.info('Configdrive for node %(node)s of %(size)d bytes successfully '
+             'copied onto partition %(part)s',
+             {'node': node_uuid, 'size': size, 'part': partition})
@@ -147,6 +147,12 @@ class ImageDownloadError(RESTError):
         super(ImageDownloadError, self).__init__(details)
 
 
+class ImageStagingError(ImageDownloadError):
+    """Error raised when there is no room to cache an image."""
+
+    message = 'Error caching image'
+
+
 class ImageChecksumError(RESTError):
     """Error raised when an image fails to verify against its checksum."""
 
@@ -299,6 +305,15 @@ class IncompatibleNumaFormatError(RESTError):
     message = 'Error in NUMA node data format'
 
 
+class ImageFormatError(RESTError):
+    """Error raised when an image is malformed or uses unsupported features."""
+
+    message = 'Error in image format'
+
+    def __init__(self, details):
+        super(ImageFormatError, self).__init__(details)
+
+
 class ISCSICommandError(ISCSIError):
     """Error executing TGT command."""
 
@@ -23,6 +23,7 @@ import six
 
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
+from ironic_python_agent import progress
 
 
 LOG = log.getLogger()
@@ -107,18 +108,21 @@ class AsyncCommandResult(BaseCommandResult):
     """A command that executes asynchronously in the background."""
 
     def __init__(self, command_name, command_params, execute_method,
-                 agent=None):
+                 agent=None, track_progress=False):
         """Construct an instance of AsyncCommandResult.
 
         :param command_name: name of command to execute
         :param command_params: parameters passed to command
         :param execute_method: a callable to be executed asynchronously
         :param agent: Optional: an instance of IronicPythonAgent
+        :param track_progress: Optional: whether the command reports its
+                               progress while it runs. Defaults to False.
         """
         super(AsyncCommandResult, self).__init__(command_name, command_params)
         self.agent = agent
         self.execute_method = execute_method
         self.command_state_lock = threading.Lock()
+        self.progress = progress.Progress() if track_progress else None
 
         thread_name = 'agent-command-{}'.format(self.id)
         self.execution_thread = threading.Thread(target=self.run,
@@ -127,10 +131,18 @@ class AsyncCommandResult(BaseCommandResult):
     def serialize(self):
         """Serializes the AsyncCommandResult into a dict.
 
+        While a command tracking its progress is running, its result is
+        its progress.
+
         :returns: dict containing serializable fields in AsyncCommandResult
         """
         with self.command_state_lock:
-            return super(AsyncCommandResult, self).serialize()
+            data = super(AsyncCommandResult, self).serialize()
+            if (self.progress is not None
+                    and self.command_status == AgentCommandStatus.RUNNING):
+                data['command_result'] = {
+                    'progress': self.progress.snapshot()}
+            return data
 
     def start(self):
         """Begin background execution of command."""
@@ -156,6 +168,8 @@ class AsyncCommandResult(BaseCommandResult):
 
     def run(self):
         """Run a command."""
+        if self.progress is not None:
+            progress.set_current(self.progress)
         try:
             result = self.execute_method(**self.command_params)
 
@@ -183,6 +197,8 @@ class AsyncCommandResult(BaseCommandResult):
                 self.command_error = e
                 self.command_status = AgentCommandStatus.FAILED
         finally:
+            if self.progress is not None:
+                progress.set_current(None)
             if self.agent:
                 self.agent.force_heartbeat()
 
@@ -271,13 +287,15 @@ class ExecuteCommandMixin(object):
             return result
 
 
-def async_command(command_name, validator=None):
+def async_command(command_name, validator=None, track_progress=False):
     """Will run the command in an AsyncCommandResult in its own thread.
 
     command_name is set based on the func name and command_params will
     be whatever args/kwargs you pass into the decorated command.
     Return values of type `str` or `unicode` are prefixed with the
     `command_name` parameter when returned for consistency.
+    If track_progress is True, the command can report its progress through
+    the progress module while it runs.
     """
     def async_decorator(func):
         func.command_name = command_name
@@ -296,7 +314,8 @@ def async_command(command_name, validator=None):
             return AsyncCommandResult(command_name,
                                       command_params,
                                       bound_func,
-                                      agent=self.agent).start()
+                                      agent=self.agent,
+                                      track_progress=track_progress).start()
         return wrapper
     return async_decorator
 
@@ -12,26 +12,105 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import fcntl
 import hashlib
+import io
+import mmap
 import os
+import socket
+import ssl
+import stat
+import struct
+import threading
 import time
+import zlib
 
 from ironic_lib import disk_utils
+from ironic_lib import exception
+from ironic_lib import utils as il_utils
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import units
+import psutil
 import requests
 import six
 
+from ironic_python_agent import block_manifest
+from ironic_python_agent import chunk_store
+from ironic_python_agent import compression
+from ironic_python_agent import config_drive
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import kexec
+from ironic_python_agent import peers
+from ironic_python_agent import progress
+from ironic_python_agent import qcow2
+from ironic_python_agent import splice
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
+IMAGE_RANGE_SIZE = 8 * IMAGE_CHUNK_SIZE  # 8MB
+IMAGE_ALIGNMENT = 4096
+IMAGE_MIN_CHUNK_SIZE = 256 * 1024  # 256KB
+IMAGE_MAX_CHUNK_SIZE = 4 * IMAGE_CHUNK_SIZE  # 4MB
+# Aim for chunks taking about this many seconds to download.
+IMAGE_CHUNK_TARGET_TIME = 0.1
+# Maximum number of chunks waiting to be included in the image checksums.
+IMAGE_HASH_QUEUE_SIZE = 8
+# Amount of an image downloaded from each URL to find the fastest one.
+IMAGE_PROBE_SIZE = 2 * IMAGE_CHUNK_SIZE  # 2MB
+# Seconds to wait for URLs to be probed, slower ones are ranked last.
+IMAGE_PROBE_TIMEOUT = 10
+# Appended to the URL of an image to get its block-hash manifest.
+BLOCK_MANIFEST_SUFFIX = '.blockmap'
+
+# NOTE: O_DIRECT is Linux specific and is not defined everywhere.
+_O_DIRECT = getattr(os, 'O_DIRECT', 0)
+# Errors which interrupt an image download that can be resumed.
+_RESUMABLE_ERRORS = (requests.exceptions.RequestException,
+                     requests.packages.urllib3.exceptions.HTTPError,
+                     IOError, OSError)
+
+# From linux/fs.h: _IO(0x12, 119) and _IO(0x12, 127)
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+# Granularity at which all-zero regions of sparse images are detected.
+SPARSE_BLOCK_SIZE = 16 * IMAGE_ALIGNMENT  # 64KB
+# Size of the ranges of an image checksummed separately while it is written
+# and compared when it is read back.
+VERIFY_RANGE_SIZE = 64 * IMAGE_CHUNK_SIZE  # 64MB
+# Requests of the device queue each thread writing a region of an image is
+# expected to keep busy, picking the number of region writers.
+REGION_WRITER_QUEUE_DEPTH = 32
+# Capacity of the pipes an image is spliced through, the largest allowed
+# to unprivileged processes by default.
+SPLICE_PIPE_SIZE = IMAGE_CHUNK_SIZE  # 1MB
+# Seconds worth of throughput a rate limited download may receive at once.
+RATE_LIMIT_BURST_SECONDS = 0.1
+
+# The qemu-img cache mode, number of coroutines and whether writes may be
+# out of order used to write whole disk images, by kind of device. Disks
+# get sequential writes through the page cache, flushed once at the end,
+# solid state devices concurrent writes bypassing it. None keeps the
+# default number of coroutines of qemu-img.
+WRITE_STRATEGIES = {
+    'rotational': ('writeback', 1, False),
+    'ssd': ('none', 4, True),
+    'nvme': ('none', 16, True),
+    'directsync': ('directsync', None, False),
+}
+
+
+# Locations of images cached outside of /tmp, by image ID.
+_STAGED_IMAGES = {}
+
+_MEMORY_FILESYSTEMS = ('tmpfs', 'ramfs', 'rootfs')
 
 
 def _image_location(image_info):
@@ -40,7 +119,322 @@ def _image_location(image_info):
     :param image_info: Image information dictionary.
     :returns: The full, absolute path to the image as a string.
     """
-    return '/tmp/{}'.format(image_info['id'])
+    return _STAGED_IMAGES.get(image_info['id'],
+                              '/tmp/{}'.format(image_info['id']))
+
+
+def _is_memory_backed(path):
+    """Check whether a path is on a file system held in memory.
+
+    :param path: A path in the local file system.
+    :returns: True if the file system of the path is held in memory.
+    """
+    path = os.path.realpath(path)
+    fstype = None
+    mountpoint = ''
+    for partition in psutil.disk_partitions(all=True):
+        if (len(partition.mountpoint) > len(mountpoint)
+                and (path == partition.mountpoint
+                     or path.startswith(partition.mountpoint.rstrip('/')
+                                        + '/'))):
+            mountpoint = partition.mountpoint
+            fstype = partition.fstype
+    return fstype in _MEMORY_FILESYSTEMS
+
+
+def _disk_of(path):
+    """Get the name of the disk holding a path.
+
+    :param path: A path in the local file system.
+    :returns: The name of the disk, e.g. 'sda', or None if the path is not
+              on a block device.
+    """
+    dev = os.stat(path).st_dev
+    sys_path = os.path.realpath('/sys/dev/block/{}:{}'.format(
+        os.major(dev), os.minor(dev)))
+    if not os.path.exists(sys_path):
+        return None
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        sys_path = os.path.dirname(sys_path)
+    return os.path.basename(sys_path)
+
+
+def _staging_problem(directory, size, device=None):
+    """Check whether an image can be cached in a directory.
+
+    :param directory: The directory to cache the image in.
+    :param size: The size of the image in bytes.
+    :param device: The install device, which must not hold the directory.
+    :returns: None if the image fits, otherwise the reason why not.
+    """
+    try:
+        stat = os.statvfs(directory)
+        memory_backed = _is_memory_backed(directory)
+        disk = None if memory_backed else _disk_of(directory)
+    except OSError as e:
+        return 'not accessible: {}'.format(e)
+    free = stat.f_bavail * stat.f_frsize
+    if free < size:
+        return 'only {} bytes free'.format(free)
+    if memory_backed:
+        available = (psutil.virtual_memory().available
+                     - CONF.image_staging_memory_reserve * units.Mi)
+        if available < size:
+            return 'held in memory with only {} bytes available'.format(
+                max(0, available))
+    elif (device is not None
+            and disk == os.path.basename(os.path.realpath(device))):
+        return 'on the install device {}'.format(device)
+    return None
+
+
+def _stage_image(image_info, size, device=None):
+    """Pick the location to cache an image in before writing it.
+
+    /tmp is used if the image fits there, which on a ramdisk means that it
+    fits in the available memory. Otherwise the first of
+    CONF.image_staging_dirs the image fits in is used.
+
+    :param image_info: Image information dictionary.
+    :param size: The size of the image in bytes, None if unknown.
+    :param device: The install device, if known.
+    :raises: ImageStagingError if the image fits nowhere.
+    :returns: The full, absolute path to cache the image at.
+    """
+    _STAGED_IMAGES.pop(image_info['id'], None)
+    if size is None:
+        LOG.warning('The size of image %s is unknown, caching it in /tmp '
+                    'without checking for free space', image_info['id'])
+        return _image_location(image_info)
+
+    problems = []
+    for directory in ['/tmp'] + CONF.image_staging_dirs:
+        problem = _staging_problem(directory, size, device)
+        if problem is None:
+            location = os.path.join(directory, image_info['id'])
+            if directory != '/tmp':
+                _STAGED_IMAGES[image_info['id']] = location
+            LOG.debug('Caching image %(image)s of %(size)d bytes at '
+                      '%(location)s', {'image': image_info['id'],
+                                       'size': size, 'location': location})
+            return location
+        problems.append('{} is {}'.format(directory, problem))
+    msg = 'The image of {} bytes does not fit anywhere: {}'.format(
+        size, '; '.join(problems))
+    raise errors.ImageStagingError(image_info['id'], msg)
+
+
+def _image_virtual_size(image_info, image_download):
+    """Get the virtual size of an image before downloading it.
+
+    The size of raw images is the size of the download, the size of qcow2
+    images is read from their header with a range request. The size of the
+    download of an image of unknown format is used as is: it is the virtual
+    size of raw images, and no larger than the virtual size of qcow2 or
+    compressed images.
+
+    :param image_info: Image information dictionary.
+    :param image_download: The ImageDownload of the image, nothing must
+                           have been read from it yet.
+    :returns: The virtual size in bytes, or a lower bound of it, None if it
+              cannot be known before downloading the image, e.g. for
+              compressed images.
+    """
+    disk_format = image_info.get('disk_format')
+    if image_download.size is None or _is_compressed_format(image_info):
+        return None
+    if disk_format in (None, 'raw'):
+        return image_download.size
+    if disk_format != 'qcow2' or not image_download.supports_ranges():
+        return None
+    virtual_size = qcow2.virtual_size(image_download.read_range(
+        0, min(qcow2.HEADER_SIZE, image_download.size)))
+    if virtual_size is None:
+        # Not a qcow2 image after all.
+        return image_download.size
+    return virtual_size
+
+
+def _block_device_size(device):
+    """Get the size of a block device.
+
+    :param device: The device name.
+    :returns: The size in bytes, None if the device is not a block device
+              or cannot be opened.
+    """
+    try:
+        if not stat.S_ISBLK(os.stat(device).st_mode):
+            return None
+        return _device_size(device)
+    except OSError as e:
+        LOG.debug('Cannot get the size of device %(dev)s: %(err)s',
+                  {'dev': device, 'err': e})
+        return None
+
+
+def _check_image_fits(image_info, virtual_size, devices):
+    """Checks that an image fits where it is written.
+
+    Partition images must fit in their root partition, whole disk images
+    on the devices they are written to.
+
+    :param image_info: Image information dictionary.
+    :param virtual_size: The virtual size of the image in bytes, nothing is
+                         checked if None.
+    :param devices: The device names the image is written to. For partition
+                    images, they are not checked.
+    :raises: InvalidCommandParamsError if the image does not fit.
+    """
+    if virtual_size is None:
+        return
+    if image_info.get('image_type') == 'partition':
+        if image_info.get('root_mb') is None:
+            return
+        image_mb = (virtual_size + units.Mi - 1) // units.Mi
+        root_mb = int(image_info['root_mb'])
+        if image_mb > root_mb:
+            msg = ('Root partition is too small for requested image. Image '
+                   'virtual size: {} MB, Root size: {} MB').format(image_mb,
+                                                                   root_mb)
+            raise errors.InvalidCommandParamsError(msg)
+        return
+    for device in devices:
+        device_size = _block_device_size(device)
+        if device_size is not None and virtual_size > device_size:
+            msg = ('Device {} is too small for requested image. Image '
+                   'virtual size: {} bytes, device size: {} bytes').format(
+                       device, virtual_size, device_size)
+            raise errors.InvalidCommandParamsError(msg)
+
+
+def _download_connections(image_info):
+    """Get the number of connections to download an image with.
+
+    :param image_info: Image information dictionary.
+    :raises: InvalidCommandParamsError if the requested number of
+             connections is not a positive integer.
+    :returns: The number of concurrent download connections as an integer.
+    """
+    connections = image_info.get('download_connections',
+                                 CONF.image_download_connections)
+    try:
+        connections = int(connections)
+    except (TypeError, ValueError):
+        connections = 0
+    if connections < 1:
+        msg = ('Image \'download_connections\' must be a positive integer, '
+               'got {}').format(image_info.get('download_connections'))
+        raise errors.InvalidCommandParamsError(msg)
+    return connections
+
+
+def _download_rate_limit(image_info):
+    """Get the maximum throughput of the download of an image.
+
+    :param image_info: Image information dictionary.
+    :raises: InvalidCommandParamsError if the requested maximum throughput
+             or ramp-up period is not a non-negative number.
+    :returns: A tuple of the maximum throughput in bytes per second, 0 if
+              the download is not limited, and of the ramp-up period in
+              seconds.
+    """
+    limits = []
+    for key, default in [('download_max_rate', CONF.image_download_max_rate),
+                         ('download_ramp_up', CONF.image_download_ramp_up)]:
+        value = image_info.get(key, default)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = -1
+        if value < 0:
+            msg = ('Image \'{}\' must be a non-negative number, '
+                   'got {}').format(key, image_info.get(key))
+            raise errors.InvalidCommandParamsError(msg)
+        limits.append(value)
+    return limits[0] * 1024, limits[1]
+
+
+_CHECKSUM_ALGORITHMS = ('md5', 'sha256', 'sha512')
+
+
+def _image_checksums(image_info):
+    """Get the checksums an image is verified against.
+
+    The MD5 checksum of the image is always verified. If the image also has
+    a Glance multihash, given by the 'os_hash_algo' and 'os_hash_value' keys
+    of image_info, it is verified as well.
+
+    :param image_info: Image information dictionary.
+    :raises: InvalidCommandParamsError if the hash algorithm of the image is
+             not supported.
+    :returns: A list of (algorithm, hex digest) tuples.
+    """
+    checksums = [('md5', image_info['checksum'])]
+    algorithm = image_info.get('os_hash_algo')
+    if algorithm:
+        if algorithm not in _CHECKSUM_ALGORITHMS:
+            msg = ('Image \'os_hash_algo\' must be one of {}, got '
+                   '{}').format(', '.join(_CHECKSUM_ALGORITHMS), algorithm)
+            raise errors.InvalidCommandParamsError(msg)
+        value = image_info.get('os_hash_value')
+        if not isinstance(value, six.string_types) or not value:
+            raise errors.InvalidCommandParamsError(
+                'Image \'os_hash_value\' must be a non-empty string.')
+        checksums.append((algorithm, value))
+    return checksums
+
+
+def _url_selection(image_info):
+    """Get how to pick the URL to download an image from.
+
+    :param image_info: Image information dictionary.
+    :raises: InvalidCommandParamsError if the URL selection is unknown.
+    :returns: Either 'ordered' or 'fastest'.
+    """
+    selection = image_info.get('url_selection',
+                               CONF.image_download_url_selection)
+    if selection not in ('ordered', 'fastest'):
+        msg = ('Image \'url_selection\' must be either "ordered" or '
+               '"fastest", got {}').format(selection)
+        raise errors.InvalidCommandParamsError(msg)
+    return selection
+
+
+def _is_compressed_format(image_info):
+    """Whether the image is declared to be a compressed raw image.
+
+    Either its 'disk_format' is the compression algorithm, or its
+    'container_format' is 'compressed'. Such images can only be written by
+    streaming and decompressing them onto the device.
+
+    :param image_info: Image information dictionary.
+    """
+    return (image_info.get('disk_format') in compression.MAGIC
+            or image_info.get('container_format') == 'compressed')
+
+
+def _image_compression(image_info, image_download, readinto=False):
+    """Get the compression of a raw image being downloaded.
+
+    :param image_info: Image information dictionary.
+    :param image_download: The ImageDownload of the image, nothing must
+                           have been read from it yet.
+    :param readinto: Whether the image is going to be read with readinto().
+    :raises: ImageFormatError if the image is declared compressed but its
+             compression is not supported.
+    :returns: The compression algorithm of the image, or None if it is not
+              compressed.
+    """
+    disk_format = image_info.get('disk_format')
+    if disk_format in compression.MAGIC:
+        return disk_format
+    algorithm = compression.detect(
+        image_download.peek(compression.MAGIC_SIZE, readinto))
+    if algorithm is None and _is_compressed_format(image_info):
+        raise errors.ImageFormatError(
+            'Unsupported compression of image {}, expected one of {}'.format(
+                image_info['id'], ', '.join(sorted(compression.MAGIC))))
+    return algorithm
 
 
 def _path_to_script(script):
@@ -97,6 +491,94 @@ def _write_partition_image(image, image_info, device):
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
 
 
+def _make_partitions(image_info, device):
+    """Creates the partitions of a partition image, leaving root empty.
+
+    The partitions are laid out like disk_utils.work_on_disk() does, the
+    config drive is streamed onto its partition and the swap and ephemeral
+    partitions are formatted, only the root partition is left for the
+    image to be written to. As its size is not known upfront, the config
+    drive partition has the maximum size of a config drive.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, on which to create the
+                   partitions. Example: '/dev/sda'
+    :raises: InstanceDeployFailure if the partitions cannot be created or
+             the config drive cannot be written.
+    :raises: ImageWriteError if a partitioning command fails.
+    :returns: A dictionary mapping the partition types to their paths.
+    """
+    node_uuid = image_info.get('node_uuid')
+    preserve_ep = image_info['preserve_ephemeral']
+    configdrive = image_info.get('configdrive')
+    boot_option = image_info.get('boot_option', 'netboot')
+    boot_mode = image_info.get('deploy_boot_mode', 'bios')
+    cpu_arch = hardware.dispatch_to_managers('get_cpus').architecture
+    try:
+        # Partitions of the ephemeral partition are kept on a rebuild with
+        # preserve_ephemeral.
+        if not preserve_ep:
+            disk_utils.destroy_disk_metadata(device, node_uuid)
+        partitions = disk_utils.make_partitions(
+            device, image_info['root_mb'], image_info['swap_mb'],
+            image_info['ephemeral_mb'],
+            disk_utils.MAX_CONFIG_DRIVE_SIZE_MB if configdrive else 0,
+            node_uuid, commit=not preserve_ep, boot_option=boot_option,
+            boot_mode=boot_mode,
+            disk_label=image_info.get('disk_label', 'msdos'),
+            cpu_arch=cpu_arch)
+        for part, path in partitions.items():
+            if path and not disk_utils.is_block_device(path):
+                raise exception.InstanceDeployFailure(
+                    '\'{}\' device \'{}\' not found'.format(part, path))
+
+        if boot_mode == 'uefi' and boot_option == 'local':
+            il_utils.mkfs(fs='vfat', path=partitions['efi system partition'],
+                          label='efi-part')
+        if configdrive:
+            _write_configdrive(image_info, device, configdrive,
+                               partition=partitions['configdrive'])
+        if partitions.get('swap'):
+            il_utils.mkfs(fs='swap', path=partitions['swap'], label='swap1')
+        if partitions.get('ephemeral') and not preserve_ep:
+            il_utils.mkfs(fs=image_info['ephemeral_format'],
+                          path=partitions['ephemeral'], label='ephemeral0')
+    except processutils.ProcessExecutionError as e:
+        raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
+    LOG.info('Created the partitions of image %(image)s on %(device)s: '
+             '%(parts)s', {'image': image_info['id'], 'device': device,
+                           'parts': partitions})
+    return partitions
+
+
+def _write_strategy(device):
+    """Picks how to write a whole disk image to a device.
+
+    Unless CONF.image_write_strategy names one, the strategy is picked from
+    the kind of the device, as listed by the hardware managers.
+
+    :param device: The device name, as a string. Example: '/dev/sda'
+    :returns: A key of WRITE_STRATEGIES.
+    """
+    if CONF.image_write_strategy != 'auto':
+        return CONF.image_write_strategy
+    try:
+        block_devices = hardware.dispatch_to_managers('list_block_devices')
+    except (errors.RESTError, processutils.ProcessExecutionError) as e:
+        LOG.warning('Unable to list the block devices to pick how to write '
+                    'to %(device)s: %(err)s', {'device': device, 'err': e})
+        return 'directsync'
+    path = os.path.realpath(device)
+    for block_device in block_devices:
+        if os.path.realpath(block_device.name) != path:
+            continue
+        if os.path.basename(path).startswith('nvme'):
+            return 'nvme'
+        return 'rotational' if block_device.rotational else 'ssd'
+    LOG.debug('Device %s is not a listed block device', device)
+    return 'directsync'
+
+
 def _write_whole_disk_image(image, image_info, device):
     """Writes a whole disk image to the specified device.
 
@@ -108,32 +590,78 @@ def _write_whole_disk_image(image, image_info, device):
 
     :raises: ImageWriteError if the command to write the image encounters an
              error.
+    :returns: A dictionary with the write strategy used and the throughput
+              it achieved.
     """
+    strategy = _write_strategy(device)
+    cache_mode, coroutines, out_of_order = WRITE_STRATEGIES[strategy]
     script = _path_to_script('shell/write_image.sh')
-    command = ['/bin/bash', script, image, device]
-    LOG.info('Writing image with command: {}'.format(' '.join(command)))
+    command = ['/bin/bash', script, image, device, cache_mode,
+               str(coroutines or ''), str(out_of_order).lower()]
+    LOG.info('Writing image with the %(strategy)s strategy, command: '
+             '%(command)s', {'strategy': strategy,
+                             'command': ' '.join(command)})
+    starttime = time.time()
     try:
         stdout, stderr = utils.execute(*command, check_exit_code=[0])
     except processutils.ProcessExecutionError as e:
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
+    seconds = time.time() - starttime
+    size = os.path.getsize(image)
+    stats = {
+        'strategy': strategy,
+        'cache_mode': cache_mode,
+        'coroutines': coroutines,
+        'out_of_order': out_of_order,
+        'bytes': size,
+        'seconds': round(seconds, 3),
+        'bytes_per_second': int(size / seconds) if seconds > 0 else None,
+    }
+    LOG.info('Image %(image)s written to %(device)s at %(rate)s bytes per '
+             'second with the %(strategy)s strategy',
+             {'image': image, 'device': device,
+              'rate': stats['bytes_per_second'], 'strategy': strategy})
+    return stats
+
+
+def _erase_partition_tables(device):
+    """Erases existing GPT and MBR data structures from a device.
+
+    :param device: The device name, as a string. Example: '/dev/sda'
+    :raises: ImageWriteError if the partition tables cannot be erased.
+    """
+    LOG.info('Erasing existing GPT and MBR data structures from %s', device)
+    try:
+        utils.execute('sgdisk', '-Z', device)
+    except processutils.ProcessExecutionError:
+        try:
+            utils.execute('sgdisk', '-o', device)
+        except processutils.ProcessExecutionError as e:
+            raise errors.ImageWriteError(device, e.exit_code, e.stdout,
+                                         e.stderr)
 
 
-def _write_image(image_info, device):
+def _write_image(image_info, device, stats=None):
     """Writes an image to the specified device.
 
     :param image_info: Image information dictionary.
     :param device: The disk name, as a string, on which to store the image.
                    Example: '/dev/sda'
+    :param stats: Optional dictionary the statistics of the write of a
+                  whole disk image are stored into, under 'write'.
     :raises: ImageWriteError if the command to write the image encounters an
              error.
     """
     starttime = time.time()
+    progress.set_stage('write')
     image = _image_location(image_info)
     uuids = {}
     if image_info.get('image_type') == 'partition':
         uuids = _write_partition_image(image, image_info, device)
     else:
-        _write_whole_disk_image(image, image_info, device)
+        write_stats = _write_whole_disk_image(image, image_info, device)
+        if stats is not None:
+            stats['write'] = write_stats
     totaltime = time.time() - starttime
     LOG.info('Image {} written to device {} in {} seconds'.format(
              image, device, totaltime))
@@ -172,15 +700,329 @@ def _message_format(msg, image_info, device, partition_uuids):
     return message
 
 
+class _RangeFetcher(object):
+    """Fetches byte ranges of an image over several concurrent connections.
+
+    The image is split into segments, IMAGE_RANGE_SIZE by default, which are
+    claimed by worker threads in order. Workers never run more than one
+    segment per connection ahead of the consumer, so at most
+    ``connections + 1`` segments are held in memory at any time.
+    """
+
+    def __init__(self, fetch, size, connections, segment_size=None):
+        """Initialize an instance of the _RangeFetcher class.
+
+        :param fetch: A callable accepting a (start, end) tuple of inclusive
+                      byte offsets and returning a list of chunks.
+        :param size: The total size of the image in bytes.
+        :param connections: The number of concurrent connections to use.
+        :param segment_size: The size of the segments in bytes,
+                             IMAGE_RANGE_SIZE if None.
+        """
+        segment_size = segment_size or IMAGE_RANGE_SIZE
+        self._fetch = fetch
+        self._segments = [(start, min(start + segment_size, size) - 1)
+                          for start in six.moves.range(0, size,
+                                                       segment_size)]
+        self._connections = connections
+        self._window = connections + 1
+        self._results = {}
+        self._claimed = 0
+        self._consumed = 0
+        self._error = None
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def _next_segment(self):
+        with self._condition:
+            while (not self._stopped
+                   and self._claimed < len(self._segments)
+                   and self._claimed - self._consumed >= self._window):
+                self._condition.wait()
+            if self._stopped or self._claimed >= len(self._segments):
+                return None
+            index = self._claimed
+            self._claimed += 1
+            return index
+
+    def _worker(self):
+        while True:
+            index = self._next_segment()
+            if index is None:
+                return
+            try:
+                chunks = self._fetch(self._segments[index])
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._results[index] = chunks
+                self._condition.notify_all()
+
+    def __iter__(self):
+        """Yields the chunks of every segment in image order."""
+        threads = []
+        for i in range(min(self._connections, len(self._segments))):
+            thread = threading.Thread(target=self._worker,
+                                      name='image-range-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for index in six.moves.range(len(self._segments)):
+                with self._condition:
+                    while (index not in self._results
+                           and self._error is None):
+                        self._condition.wait()
+                    if index not in self._results:
+                        raise self._error
+                    chunks = self._results.pop(index)
+                    self._consumed = index + 1
+                    self._condition.notify_all()
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
+            for thread in threads:
+                thread.join()
+
+
+class _ImageHasher(object):
+    """Computes the checksums of an image on a separate thread.
+
+    Data is handed over without being copied, as the chunks or the views
+    of the buffers it was downloaded to, and all checksums are computed in a
+    single pass over it. Hashing releases the
+    GIL, so it runs in parallel with downloading and writing the image.
+    Buffers which are reused must not be modified before wait() confirms
+    that their content has been hashed.
+    """
+
+    _END = object()
+
+    def __init__(self, algorithms):
+        """Initialize an instance of the _ImageHasher class.
+
+        :param algorithms: The names of the hashlib algorithms to compute.
+        """
+        self._hashes = dict((algorithm, getattr(hashlib, algorithm)())
+                            for algorithm in set(algorithms))
+        self._queue = six.moves.queue.Queue(maxsize=IMAGE_HASH_QUEUE_SIZE)
+        self._condition = threading.Condition()
+        self._hashed = 0
+        self._thread = None
+        self._hexdigests = None
+
+    def _run(self):
+        while True:
+            view = self._queue.get()
+            if view is self._END:
+                return
+            for checksum in self._hashes.values():
+                checksum.update(view)
+            with self._condition:
+                self._hashed += len(view)
+                self._condition.notify_all()
+
+    def update(self, data):
+        """Queue data to be hashed.
+
+        Blocks when IMAGE_HASH_QUEUE_SIZE chunks are already waiting.
+
+        :param data: A bytes-like object.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='image-checksum')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(data)
+
+    def wait(self, offset):
+        """Wait until the first offset bytes of the image are hashed.
+
+        :param offset: The number of bytes from the start of the image.
+        """
+        with self._condition:
+            while self._hashed < offset:
+                self._condition.wait()
+
+    def hexdigests(self):
+        """Finish hashing and return the checksums.
+
+        No more data may be added afterwards.
+
+        :returns: A dictionary mapping each algorithm to the hex digest.
+        """
+        if self._hexdigests is None:
+            if self._thread is not None:
+                self._queue.put(self._END)
+                self._thread.join()
+            self._hexdigests = dict(
+                (algorithm, checksum.hexdigest())
+                for algorithm, checksum in self._hashes.items())
+        return self._hexdigests
+
+
+class _RateMonitor(object):
+    """Detects a download which stays slower than a minimum rate.
+
+    Only the time spent waiting for the network counts, so that a slow
+    consumer of the image does not look like a slow download.
+    """
+
+    def __init__(self, min_rate, period):
+        """Initialize an instance of the _RateMonitor class.
+
+        :param min_rate: The minimum rate in bytes per second.
+        :param period: The number of seconds the rate has to stay below
+                       min_rate to be considered too slow.
+        """
+        self.min_rate = min_rate
+        self.period = period
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def update(self, count, seconds):
+        """Account for a received chunk.
+
+        :param count: The number of bytes received.
+        :param seconds: The time spent waiting for them.
+        :returns: True if the rate over the last period was too slow.
+        """
+        self._bytes += count
+        self._seconds += seconds
+        if self._seconds < self.period:
+            return False
+        slow = self._bytes < self.min_rate * self._seconds
+        self._bytes = 0
+        self._seconds = 0.0
+        return slow
+
+
+class _TokenBucket(object):
+    """Limits the throughput of a download with a token bucket.
+
+    Tokens, in bytes, are added at the allowed rate up to a bucket of
+    RATE_LIMIT_BURST_SECONDS worth of them, and each chunk received takes
+    its size in tokens, sleeping until the bucket is no longer in debt. The
+    allowed rate rises linearly from a tenth of the maximum during the
+    ramp-up period. The bucket is only updated once per chunk, so its cost
+    does not depend on the throughput.
+    """
+
+    _RAMP_UP_START = 0.1
+
+    def __init__(self, max_rate, ramp_up=0):
+        """Initialize an instance of the _TokenBucket class.
+
+        :param max_rate: The maximum rate in bytes per second.
+        :param ramp_up: The number of seconds the allowed rate takes to
+                        reach max_rate.
+        """
+        self.max_rate = max_rate
+        self.ramp_up = ramp_up
+        self.throttled_seconds = 0.0
+        self._start = self._last = time.time()
+        self._tokens = self._rate(self._start) * RATE_LIMIT_BURST_SECONDS
+
+    def _rate(self, now):
+        elapsed = now - self._start
+        if elapsed >= self.ramp_up:
+            return self.max_rate
+        fraction = elapsed / self.ramp_up
+        return self.max_rate * (self._RAMP_UP_START
+                                + (1 - self._RAMP_UP_START) * fraction)
+
+    def consume(self, count):
+        """Account for a received chunk, waiting if it came too early.
+
+        :param count: The number of bytes received.
+        """
+        now = time.time()
+        rate = self._rate(now)
+        self._tokens = min(rate * RATE_LIMIT_BURST_SECONDS,
+                           self._tokens + (now - self._last) * rate)
+        self._last = now
+        self._tokens -= count
+        if self._tokens < 0:
+            wait = -self._tokens / rate
+            self.throttled_seconds += wait
+            time.sleep(wait)
+
+    def stats(self):
+        """Describe the limit and how much it slowed the download down.
+
+        :returns: A dictionary for the statistics of the image.
+        """
+        return {
+            'max_bytes_per_second': int(self.max_rate),
+            'ramp_up_seconds': self.ramp_up,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+        }
+
+
+def _response_socket(response):
+    """Find the socket the body of a response is received from.
+
+    Relies on the internals of requests, urllib3 and http.client. The body
+    must be received as is from a blocking socket without encryption, and
+    urllib3 must not hold any of it.
+
+    :param response: A requests Response, read from as a stream.
+    :returns: A tuple of the buffered reader of http.client, which may hold
+              the next bytes of the body, and the socket, or None if the
+              body cannot be spliced from the socket.
+    """
+    headers = getattr(response, 'headers', None) or {}
+    if (headers.get('Content-Encoding', 'identity') != 'identity'
+            or headers.get('Transfer-Encoding', 'identity') != 'identity'):
+        return None
+    try:
+        raw = response.raw
+        reader = raw._fp.fp
+        sock = reader.raw._sock
+    except AttributeError:
+        return None
+    if (not isinstance(sock, socket.socket)
+            or isinstance(sock, ssl.SSLSocket)
+            or sock.gettimeout() is not None
+            or not hasattr(reader, 'read1')
+            or len(getattr(raw, '_decoded_buffer', b''))):
+        return None
+    return reader, sock
+
+
 class ImageDownload(object):
     """Helper class that opens a HTTP connection to download an image.
 
     This class opens a HTTP connection to download an image from a URL
     and create an iterator so the image can be downloaded in chunks. The
-    MD5 hash of the image being downloaded is calculated on-the-fly.
+    checksums of the image being downloaded are calculated on-the-fly, on
+    a separate thread.
+
+    If more than one download connection is requested and the server
+    advertises support for byte ranges, the image is instead fetched over
+    several concurrent range requests and reassembled in order.
+
+    Interrupted downloads are resumed from the last received byte with a
+    range request, up to CONF.image_download_retries times per image.
+
+    When the image has several URLs, they can be probed concurrently to
+    download from the fastest one, and a single stream download which
+    stays slower than CONF.image_download_min_rate switches to the next
+    URL.
+
+    The throughput of the download can be limited to
+    CONF.image_download_max_rate.
     """
 
-    def __init__(self, image_info, time_obj=None):
+    def __init__(self, image_info, time_obj=None, track_progress=True):
         """Initialize an instance of the ImageDownload class.
 
         Trys each URL in image_info successively until a URL returns a
@@ -194,15 +1036,48 @@ class ImageDownload(object):
                          download began. Defaults to None. If None, then
                          time.time() will be used to find the start time of
                          the download.
+        :param track_progress: Whether the download is counted in the
+                               progress of the running command.
 
         :raises: ImageDownloadError if starting the image download fails for
                  any reason.
         """
-        self._md5checksum = hashlib.md5()
+        self._hasher = _ImageHasher(
+            [algorithm for algorithm, value in _image_checksums(image_info)])
         self._time = time_obj or time.time()
+        self._image_info = image_info
         self._request = None
+        self._url = None
+        self._range_fetcher = None
+        self._manifest = None
+        self._peers = []
+        # The agents of the wave the chunks are assigned to in turn, None
+        # standing for this agent, unless it does not know its URL.
+        self._wave = None
+        self._peers_started = None
+        self._peers_lock = threading.Lock()
+        self.peer_bytes = 0
+        self._store = None
+        self.store_bytes = 0
+        # Serializes the accounting of ranges streamed concurrently.
+        self._stream_lock = threading.Lock()
+        self._chunks = None
+        # Chunks from the start of the image read by peek() and not
+        # consumed yet.
+        self._head = []
+        self._offset = 0
+        self._retries_left = CONF.image_download_retries
+        self._retry_lock = threading.Lock()
+        self._urls = list(image_info['urls'])
+        if len(self._urls) > 1 and _url_selection(image_info) == 'fastest':
+            self._urls = self._rank_urls(self._urls)
+        self._rate_monitor = None
+        if CONF.image_download_min_rate and len(self._urls) > 1:
+            self._rate_monitor = _RateMonitor(
+                CONF.image_download_min_rate * 1024,
+                CONF.image_download_min_rate_period)
         details = []
-        for url in image_info['urls']:
+        for url in self._urls:
             try:
                 LOG.info("Attempting to download image from {}".format(url))
                 self._request = self._download_file(image_info, url)
@@ -214,94 +1089,2394 @@ class ImageDownload(object):
                 LOG.warning(log_msg)
                 details.append(log_msg)
                 continue
-            else:
-                break
+            else:
+                self._url = url
+                break
+        else:
+            details = '\n '.join(details)
+            raise errors.ImageDownloadError(image_info['id'], details)
+
+        headers = getattr(self._request, 'headers', None) or {}
+        try:
+            self.size = int(headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.size = None
+        self._accepts_ranges = (
+            headers.get('Accept-Ranges', '').strip().lower() == 'bytes'
+            and bool(self.size))
+        # NOTE: Offsets of encoded content do not match the decoded bytes
+        # which are received, so such downloads cannot be resumed.
+        self._resumable = (
+            headers.get('Content-Encoding', 'identity') == 'identity')
+        # Makes sure a resumed download continues the same version of
+        # the image, the server sends all of it otherwise.
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            self._validator = etag
+        else:
+            self._validator = headers.get('Last-Modified')
+        self._validator_url = self._url
+        self._progress = progress.current() if track_progress else None
+        if self._progress is not None:
+            self._progress.start_download(self.size)
+        max_rate, ramp_up = _download_rate_limit(image_info)
+        self.rate_limit = None
+        if max_rate:
+            LOG.info('Limiting the download of image %(image)s to %(rate)d '
+                     'KiB per second after a %(ramp)d seconds ramp-up',
+                     {'image': image_info['id'], 'rate': max_rate / 1024,
+                      'ramp': ramp_up})
+            self.rate_limit = _TokenBucket(max_rate, ramp_up)
+
+        connections = _download_connections(image_info)
+        if connections > 1:
+            self._setup_ranged_download(connections)
+
+    def _probe_url(self, url, results):
+        """Measures how fast a URL delivers the start of the image.
+
+        :param url: The URL to probe.
+        :param results: A dictionary to store the result in, keyed by URL.
+        """
+        start = time.time()
+        received = 0
+        try:
+            resp = self._download_file(self._image_info, url)
+            try:
+                ttfb = time.time() - start
+                for chunk in resp.iter_content(IMAGE_CHUNK_SIZE):
+                    received += len(chunk)
+                    if received >= IMAGE_PROBE_SIZE:
+                        break
+            finally:
+                resp.close()
+        except errors.ImageDownloadError as e:
+            LOG.warning('Probing %(url)s failed: %(err)s',
+                        {'url': url, 'err': e.secondary_message})
+            return
+        except _RESUMABLE_ERRORS as e:
+            LOG.warning('Probing %(url)s failed: %(err)s',
+                        {'url': url, 'err': e})
+            return
+        elapsed = time.time() - start
+        results[url] = {
+            'seconds': elapsed,
+            'ttfb': ttfb,
+            'bytes_per_second': received / max(elapsed - ttfb, 1e-6),
+        }
+
+    def _rank_urls(self, urls):
+        """Orders URLs by how fast they deliver a sample of the image.
+
+        Every URL is probed concurrently by downloading the first
+        IMAGE_PROBE_SIZE bytes of the image, which accounts for both the
+        time to the first byte and the throughput of the server. URLs which
+        fail or do not finish within IMAGE_PROBE_TIMEOUT go last.
+
+        :param urls: The list of URLs of the image.
+        :returns: The list of URLs, fastest first.
+        """
+        results = {}
+        threads = []
+        for i, url in enumerate(urls):
+            thread = threading.Thread(target=self._probe_url,
+                                      args=(url, results),
+                                      name='image-probe-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        deadline = time.time() + IMAGE_PROBE_TIMEOUT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+        probed = dict(results)
+        ranked = sorted(probed, key=lambda url: probed[url]['seconds'])
+        LOG.info('Probed URLs of image %(image)s: %(results)s',
+                 {'image': self._image_info['id'], 'results': probed})
+        return ranked + [url for url in urls if url not in probed]
+
+    def _setup_ranged_download(self, connections):
+        """Switches to ranged downloads if the server supports them.
+
+        :param connections: The number of concurrent connections to use.
+        """
+        if not self._accepts_ranges:
+            LOG.info('Server at %(url)s does not support range requests, '
+                     'downloading image %(image)s over a single stream',
+                     {'url': self._url, 'image': self._image_info['id']})
+            return
+
+        LOG.info('Downloading image %(image)s of %(size)d bytes from %(url)s '
+                 'over %(conn)d connections',
+                 {'image': self._image_info['id'], 'size': self.size,
+                  'url': self._url, 'conn': connections})
+        # The body of the initial request is not needed any more, every
+        # byte is fetched through a range request instead.
+        self._request.close()
+        self._range_fetcher = _RangeFetcher(self._fetch_range, self.size,
+                                            connections)
+
+    def use_peers(self, manifest, image_peers, connections, store=None,
+                  agent_url=None):
+        """Downloads the chunks of the image from peer agents if possible.
+
+        Each chunk, a block of the block-hash manifest of the image, is
+        read from the chunk store, then requested from a peer which holds
+        it, or from the agent of the wave it is assigned to, which is
+        waited for. At most peers.PEER_ATTEMPTS peers are asked for a chunk
+        before the image server. Every chunk is checked against the
+        manifest, and added to the chunk store. Requires the image server
+        to support range requests.
+
+        :param manifest: The block_manifest.Manifest of the image.
+        :param image_peers: The base URLs of the peer agents.
+        :param connections: The number of chunks to download concurrently.
+        :param store: The chunk_store.ChunkStore to use, if any.
+        :param agent_url: The URL of the API of this agent, as its peers
+                          are given it. Chunks are not assigned to agents
+                          if None.
+        """
+        LOG.info('Downloading image %(image)s from %(count)d peers%(store)s '
+                 'and %(url)s over %(conn)d connections',
+                 {'image': self._image_info['id'], 'count': len(image_peers),
+                  'store': ', the chunk store' if store is not None else '',
+                  'url': self._url, 'conn': connections})
+        self._manifest = manifest
+        self._peers = [peers.Peer(url) for url in image_peers]
+        if agent_url is not None and self._peers:
+            by_url = dict((peer.url, peer) for peer in self._peers)
+            by_url.setdefault(agent_url.rstrip('/'), None)
+            self._wave = [by_url[url] for url in sorted(by_url)]
+        self._peers_started = time.time()
+        self._store = store
+        self._request.close()
+        self._range_fetcher = _RangeFetcher(self._fetch_chunk, self.size,
+                                            connections, manifest.block_size)
+
+    def _fetch_chunk(self, byte_range):
+        """Downloads a chunk of the image from a peer or the image server.
+
+        :param byte_range: (start, end) tuple of inclusive byte offsets of a
+                           block of the manifest.
+        :raises: ImageDownloadError if the chunk could not be downloaded
+                 from the image server or does not match the manifest.
+        :returns: A list with the data of the chunk.
+        """
+        index = byte_range[0] // self._manifest.block_size
+        image_id = self._image_info['id']
+        if self._store is not None:
+            data = self._store.get(self._manifest.algorithm,
+                                   self._manifest.blocks[index])
+            if data is not None and self._manifest.matches(index, data):
+                with self._peers_lock:
+                    self.store_bytes += len(data)
+                return [data]
+        asked = []
+        for attempt in range(peers.PEER_ATTEMPTS):
+            peer, wait = self._pick_peer(index, asked)
+            if peer is None:
+                break
+            asked.append(peer)
+            data = self._ask_peer(peer, index, wait)
+            if data is not None:
+                with self._peers_lock:
+                    self.peer_bytes += len(data)
+                self._store_chunk(index, data)
+                return [data]
+
+        data = b''.join(self._fetch_range(byte_range))
+        if not self._manifest.matches(index, data):
+            msg = ('Chunk {} from {} does not match the block manifest of '
+                   'the image').format(index, self._url)
+            raise errors.ImageDownloadError(image_id, msg)
+        self._store_chunk(index, data)
+        return [data]
+
+    def _pick_peer(self, index, asked):
+        """Picks the next peer to ask for a chunk.
+
+        :param index: The index of the chunk.
+        :param asked: The peers already asked for it.
+        :returns: A tuple of the peer, None if the chunk is to be downloaded
+                  from the image server, and whether to wait for the peer
+                  to hold the chunk.
+        """
+        candidates = [peer for peer in self._peers
+                      if not peer.dropped and peer not in asked]
+        if not candidates:
+            return None, False
+        # Spread the chunks over the peers known to hold them.
+        holders = [peer for peer in candidates if peer.available > index]
+        if holders:
+            return holders[index % len(holders)], False
+        if self._wave is None:
+            return candidates[index % len(candidates)], False
+        owner = self._wave[index % len(self._wave)]
+        if owner is None:
+            # Until a peer answered, it may hold the whole image.
+            if any(peer.answered for peer in self._peers):
+                return None, False
+            return candidates[index % len(candidates)], False
+        if owner not in candidates:
+            return None, False
+        return owner, not owner.stalled
+
+    def _ask_peer(self, peer, index, wait):
+        """Requests a chunk of the image from a peer.
+
+        :param peer: The peers.Peer to ask.
+        :param index: The index of the chunk.
+        :param wait: Whether to wait for the peer to hold the chunk, while
+                     it shares the image and up to peers.PEER_WAIT_TIMEOUT.
+        :returns: The data of the chunk, or None if the peer does not hold
+                  it.
+        """
+        image_id = self._image_info['id']
+        deadline = time.time() + peers.PEER_WAIT_TIMEOUT
+        interval = peers.PEER_POLL_INTERVAL
+        while True:
+            with peer.lock:
+                # Another thread may have found it unreachable meanwhile.
+                if peer.dropped:
+                    return None
+                try:
+                    data = peers.fetch_chunk(peer, image_id, index,
+                                             self._manifest)
+                except requests.exceptions.RequestException as e:
+                    LOG.warning('Not using peer %(peer)s for image %(image)s '
+                                'any more: %(err)s',
+                                {'peer': peer.url, 'image': image_id,
+                                 'err': e})
+                    peer.dropped = True
+                    return None
+            if data is not None or not wait or peer.stalled:
+                return data
+            now = time.time()
+            if (not peer.sharing and now - self._peers_started
+                    > peers.PEER_START_TIMEOUT):
+                return None
+            if now >= deadline:
+                LOG.warning('Peer %(peer)s did not get chunk %(index)d of '
+                            'image %(image)s in %(timeout)d seconds, not '
+                            'waiting for it any more',
+                            {'peer': peer.url, 'index': index,
+                             'image': image_id,
+                             'timeout': peers.PEER_WAIT_TIMEOUT})
+                peer.stalled = True
+                return None
+            time.sleep(interval)
+            interval = min(2 * interval, peers.PEER_POLL_MAX_INTERVAL)
+
+    def _store_chunk(self, index, data):
+        if self._store is not None:
+            self._store.put(self._manifest.algorithm,
+                            self._manifest.blocks[index], data)
+
+    def stream_range(self, start, end):
+        """Streams part of the image over a separate connection.
+
+        Several parts may be streamed concurrently, each by its own thread.
+        The data is not included in the checksum of the image, but counts
+        towards the progress and the rate limit of the download. Only
+        available if supports_ranges() returns True.
+
+        :param start: The offset of the first byte to read.
+        :param end: The offset of the last byte to read, inclusive.
+        :raises: ImageDownloadError if the range could not be downloaded
+                 completely.
+        :returns: A generator yielding the chunks of the range.
+        """
+        for chunk in self._range_chunks((start, end)):
+            with self._stream_lock:
+                if self._progress is not None:
+                    self._progress.downloaded_bytes += len(chunk)
+                if self.rate_limit is not None:
+                    self.rate_limit.consume(len(chunk))
+            yield chunk
+
+    def supports_ranges(self):
+        """Whether parts of the image can be read with read_range().
+
+        :returns: True if the server supports byte range requests.
+        """
+        return self._accepts_ranges
+
+    def read_range(self, offset, length):
+        """Reads part of the image over a separate connection.
+
+        The data is not included in the checksum of the image. Only
+        available if supports_ranges() returns True.
+
+        :param offset: The offset of the first byte to read.
+        :param length: The number of bytes to read. Reads past the end of
+                       the image are truncated.
+        :raises: ImageDownloadError if the range could not be downloaded.
+        :returns: The requested bytes.
+        """
+        end = min(offset + length, self.size) - 1
+        if end < offset:
+            return b''
+        return b''.join(self._fetch_range((offset, end)))
+
+    def _download_file(self, image_info, url, byte_range=None,
+                       if_range=None):
+        """Opens a download stream for the given URL.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string to request the image from.
+        :param byte_range: Optional (start, end) tuple of inclusive byte
+                           offsets to request instead of the whole image.
+                           An end of None requests the rest of the image.
+        :param if_range: Optional ETag or Last-Modified value the image
+                         must still match for the range to be sent.
+
+        :raises: ImageDownloadError if the download stream was not started
+                 properly.
+        """
+        no_proxy = image_info.get('no_proxy')
+        if no_proxy:
+            os.environ['no_proxy'] = no_proxy
+        proxies = image_info.get('proxies', {})
+        verify, cert = utils.get_ssl_client_options(CONF)
+        if byte_range is None:
+            expected = 200
+            resp = requests.get(url, stream=True, proxies=proxies,
+                                verify=verify, cert=cert)
+        else:
+            expected = 206
+            start, end = byte_range
+            headers = {'Range': 'bytes={}-{}'.format(
+                start, '' if end is None else end)}
+            if if_range:
+                headers['If-Range'] = if_range
+            resp = requests.get(url, stream=True, proxies=proxies,
+                                verify=verify, cert=cert, headers=headers)
+        if resp.status_code != expected:
+            msg = ('Received status code {} from {}, expected {}. Response '
+                   'body: {}').format(resp.status_code, url, expected,
+                                      resp.text)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        return resp
+
+    def _retry_url(self, attempt, error):
+        """Picks the URL to retry a failed part of the download from.
+
+        The first attempt goes to the URL which failed, every further one
+        to the next URL of the image. Each call uses up one retry of the
+        budget shared by the whole download.
+
+        :param attempt: The number of attempts made so far to recover from
+                        this failure.
+        :param error: The error which interrupted the download.
+        :raises: ImageDownloadError if the retry budget is exhausted.
+        :returns: The URL to retry from.
+        """
+        with self._retry_lock:
+            if self._retries_left <= 0:
+                msg = ('Giving up after {} retries. Last error: {}').format(
+                    CONF.image_download_retries, error)
+                raise errors.ImageDownloadError(self._image_info['id'], msg)
+            self._retries_left -= 1
+            urls = self._urls
+            index = urls.index(self._url) if self._url in urls else 0
+            return urls[(index + attempt) % len(urls)]
+
+    def _if_range(self, url):
+        """The validator to send with a range request to the given URL."""
+        return self._validator if url == self._validator_url else None
+
+    def _fetch_range(self, byte_range):
+        """Downloads a single byte range of the image.
+
+        A range which is interrupted is retried from where it stopped.
+
+        :param byte_range: (start, end) tuple of inclusive byte offsets.
+        :raises: ImageDownloadError if the range could not be downloaded
+                 completely.
+        :returns: A list of chunks making up the requested range.
+        """
+        return list(self._range_chunks(byte_range))
+
+    def _range_chunks(self, byte_range):
+        """Yields the chunks of a byte range of the image as they arrive.
+
+        A range which is interrupted is retried from where it stopped.
+
+        :param byte_range: (start, end) tuple of inclusive byte offsets.
+        :raises: ImageDownloadError if the range could not be downloaded
+                 completely.
+        """
+        start, end = byte_range
+        url = self._url
+        attempt = 0
+        while True:
+            try:
+                resp = self._download_file(self._image_info, url,
+                                           byte_range=(start, end),
+                                           if_range=self._if_range(url))
+                try:
+                    for chunk in resp.iter_content(IMAGE_CHUNK_SIZE):
+                        start += len(chunk)
+                        yield chunk
+                finally:
+                    resp.close()
+            except errors.ImageDownloadError as e:
+                error = e.secondary_message
+            except _RESUMABLE_ERRORS as e:
+                error = ('Failed to download range {}-{} from {}. Error: '
+                         '{}').format(start, end, url, e)
+            else:
+                if start == end + 1:
+                    return
+                received = start - byte_range[0]
+                error = ('Received {} bytes for range {}-{} from {}, '
+                         'expected {}').format(received, byte_range[0], end,
+                                               url,
+                                               end - byte_range[0] + 1)
+                if start > end + 1:
+                    raise errors.ImageDownloadError(self._image_info['id'],
+                                                    error)
+            url = self._retry_url(attempt, error)
+            attempt += 1
+            LOG.warning('Retrying range %(start)d-%(end)d of image %(image)s '
+                        'from %(url)s: %(err)s',
+                        {'start': start, 'end': end, 'url': url,
+                         'image': self._image_info['id'], 'err': error})
+
+    def _resume(self, error):
+        """Reopens the image stream at the current offset after a failure.
+
+        :param error: The error which interrupted the download.
+        :raises: ImageDownloadError if the download cannot be resumed.
+        """
+        self._request.close()
+        if not self._resumable:
+            msg = ('Download from {} failed after {} bytes and cannot be '
+                   'resumed. Error: {}').format(self._url, self._offset,
+                                                error)
+            raise errors.ImageDownloadError(self._image_info['id'], msg)
+
+        attempt = 0
+        while True:
+            url = self._retry_url(attempt, error)
+            attempt += 1
+            LOG.warning('Resuming download of image %(image)s at byte '
+                        '%(offset)d from %(url)s after error: %(err)s',
+                        {'image': self._image_info['id'],
+                         'offset': self._offset, 'url': url, 'err': error})
+            try:
+                self._request = self._download_file(
+                    self._image_info, url, byte_range=(self._offset, None),
+                    if_range=self._if_range(url))
+            except errors.ImageDownloadError as e:
+                error = e.secondary_message
+            except _RESUMABLE_ERRORS as e:
+                error = e
+            else:
+                self._url = url
+                return
+
+    def _check_complete(self):
+        """Checks whether the whole image has been received.
+
+        :returns: None if so, otherwise an error message.
+        """
+        if self.size is not None and self._offset < self.size:
+            return 'Connection closed after {} of {} bytes'.format(
+                self._offset, self.size)
+
+    def _failover(self, count, seconds):
+        """Switches a slow single stream download to the next URL.
+
+        The current stream is only closed once the next URL has responded,
+        a download which cannot switch carries on where it is.
+
+        :param count: The number of bytes just received.
+        :param seconds: The time spent waiting for them.
+        :returns: True if the download switched to another URL.
+        """
+        if (self._rate_monitor is None or not self._resumable
+                or not self._rate_monitor.update(count, seconds)):
+            return False
+        reason = ('Throughput from {} stayed below {} bytes per second for '
+                  '{} seconds').format(self._url, self._rate_monitor.min_rate,
+                                       self._rate_monitor.period)
+        LOG.warning('%(reason)s, switching to another URL at byte '
+                    '%(offset)d', {'reason': reason, 'offset': self._offset})
+        for attempt in six.moves.range(1, len(self._urls)):
+            try:
+                url = self._retry_url(attempt, reason)
+            except errors.ImageDownloadError:
+                LOG.warning('No retries left to switch to another URL')
+                return False
+            try:
+                request = self._download_file(
+                    self._image_info, url, byte_range=(self._offset, None),
+                    if_range=self._if_range(url))
+            except errors.ImageDownloadError as e:
+                LOG.warning('Cannot switch to %(url)s: %(err)s',
+                            {'url': url, 'err': e.secondary_message})
+                continue
+            except _RESUMABLE_ERRORS as e:
+                LOG.warning('Cannot switch to %(url)s: %(err)s',
+                            {'url': url, 'err': e})
+                continue
+            LOG.info('Switched download of image %(image)s to %(url)s',
+                     {'image': self._image_info['id'], 'url': url})
+            self._request.close()
+            self._request = request
+            self._url = url
+            return True
+        return False
+
+    def _timed_chunks(self):
+        """Yields the chunks of the stream with the time spent on each."""
+        chunks = iter(self._request.iter_content(IMAGE_CHUNK_SIZE))
+        while True:
+            start = time.time()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk, time.time() - start
+
+    def _stream_chunks(self):
+        """Yields the chunks of a single stream download, resuming it."""
+        while True:
+            error = None
+            try:
+                for chunk, seconds in self._timed_chunks():
+                    self._offset += len(chunk)
+                    yield chunk
+                    if self._failover(len(chunk), seconds):
+                        break
+                else:
+                    error = self._check_complete()
+                    if error is None:
+                        return
+            except _RESUMABLE_ERRORS as e:
+                error = e
+            if error is not None:
+                self._resume(error)
+
+    def supports_readinto(self):
+        """Whether the image can be read directly into caller's buffers.
+
+        :returns: True if readinto() may be used for this download.
+        """
+        if self._range_fetcher is not None:
+            return False
+        headers = getattr(self._request, 'headers', None) or {}
+        # NOTE: The raw stream bypasses content decoding done by requests.
+        if headers.get('Content-Encoding', 'identity') != 'identity':
+            return False
+        return hasattr(getattr(self._request, 'raw', None), 'readinto')
+
+    def readinto(self, buf):
+        """Downloads the next part of the image into a buffer.
+
+        Avoids allocating a new object for every chunk of the image. Only
+        available if supports_readinto() returns True, and not to be mixed
+        with iterating over this object. The buffer is hashed in the
+        background, it must not be modified until wait_hashed() returns
+        for the offset of its end.
+
+        :param buf: A writable buffer, e.g. a memoryview.
+        :returns: The number of bytes read, 0 at the end of the image.
+        """
+        if self._head:
+            chunk = self._head.pop(0)
+            count = min(len(buf), len(chunk))
+            buf[:count] = chunk[:count]
+            if count < len(chunk):
+                self._head.insert(0, chunk[count:])
+            return count
+        while True:
+            start = time.time()
+            try:
+                count = self._request.raw.readinto(buf)
+            except _RESUMABLE_ERRORS as e:
+                error = e
+            else:
+                if count:
+                    break
+                error = self._check_complete()
+                if error is None:
+                    break
+            self._resume(error)
+        if count:
+            self._offset += count
+            self._hasher.update(buf[:count])
+            if self._progress is not None:
+                self._progress.downloaded_bytes += count
+            self._failover(count, time.time() - start)
+            if self.rate_limit is not None:
+                self.rate_limit.consume(count)
+        return count
+
+    def peek(self, size, readinto=False):
+        """Returns the start of the image without consuming it.
+
+        The bytes returned are still produced by iterating over this object
+        or by readinto() afterwards.
+
+        :param size: The number of bytes wanted.
+        :param readinto: Whether to read them with readinto(), only if
+                         supports_readinto() returns True.
+        :returns: At least size bytes from the start of the image, or the
+                  whole image if it is smaller.
+        """
+        if not self._head and not self._offset:
+            if readinto:
+                chunks = self._readinto_chunks()
+            else:
+                chunks = self._hashed_chunks()
+            head = []
+            for chunk in chunks:
+                head.append(chunk)
+                if sum(len(c) for c in head) >= size:
+                    break
+            self._head = head
+        if not self._head:
+            return b''
+        return self._head[0][:0].join(self._head)
+
+    def _readinto_chunks(self):
+        while True:
+            # A new buffer each time, readinto() hashes it in the background.
+            buf = bytearray(IMAGE_ALIGNMENT)
+            count = self.readinto(buf)
+            if not count:
+                return
+            yield bytes(buf[:count])
+
+    def supports_splice(self):
+        """Whether the image can be moved to a file with splice_into().
+
+        :returns: True if the image is downloaded over a single plain HTTP
+                  connection of known length which can be spliced from.
+        """
+        if (not splice.available() or self._range_fetcher is not None
+                or not self.size):
+            return False
+        return _response_socket(self._request) is not None
+
+    def splice_into(self, fd, on_data=None):
+        """Moves the image to a file descriptor with splice.
+
+        The image is moved from the socket of the download to a pipe, and
+        from the pipe to fd, without being copied to user space. The data
+        is duplicated with tee into a second pipe, which is read to compute
+        the checksums of the image. Interrupted downloads are resumed, over
+        a regular stream if the new response cannot be spliced. Only
+        available if supports_splice() returns True, and not to be mixed
+        with other ways of reading the image.
+
+        :param fd: A file descriptor open for writing, e.g. of a device.
+        :param on_data: Optional callable receiving the data of the image in
+                        order, which must not be kept after it returns.
+        :raises: ImageDownloadError if the image download fails.
+        :raises: EnvironmentError if the image cannot be written to fd.
+        :returns: The number of bytes written.
+        """
+        position = 0
+        # Read by peek(), their data is already hashed.
+        while self._head:
+            chunk = self._head.pop(0)
+            self._write_received(fd, chunk, position, on_data)
+            position += len(chunk)
+
+        pipes = splice.pipe(SPLICE_PIPE_SIZE) + splice.pipe(SPLICE_PIPE_SIZE)
+        buf = bytearray(SPLICE_PIPE_SIZE)
+        try:
+            while self._offset < self.size:
+                if _response_socket(self._request) is None:
+                    LOG.info('Streaming the rest of image %(image)s from '
+                             '%(url)s without splice',
+                             {'image': self._image_info['id'],
+                              'url': self._url})
+                    for chunk in self._hash_chunks(self._stream_chunks()):
+                        self._write_received(fd, chunk,
+                                             self._offset - len(chunk),
+                                             on_data)
+                    break
+                error = self._splice_response(fd, pipes, buf, on_data)
+                if error is not None:
+                    self._resume(error)
+        finally:
+            for pipe_fd in pipes:
+                os.close(pipe_fd)
+        self.wait_hashed(self._offset)
+        return self._offset
+
+    def _write_received(self, fd, data, position, on_data):
+        """Writes data received in user space to fd."""
+        _pwrite(fd, data, position)
+        if on_data is not None:
+            on_data(data)
+        if self._progress is not None:
+            self._progress.written_bytes += len(data)
+
+    def _splice_response(self, fd, pipes, buf, on_data):
+        """Splices the body of the current response into fd.
+
+        :param fd: The file descriptor to write the image to.
+        :param pipes: The read and write ends of the pipe the data goes
+                      through, then of the pipe its copy goes through.
+        :param buf: The buffer to read the copy of the data into.
+        :param on_data: Optional callable receiving the data of the image.
+        :returns: None if the whole image is received or the download
+                  switched to another URL, otherwise the error which
+                  interrupted it.
+        """
+        reader, sock = _response_socket(self._request)
+        try:
+            # The start of the body may be buffered by http.client already.
+            data = reader.read1(IMAGE_CHUNK_SIZE)
+        except _RESUMABLE_ERRORS as e:
+            return e
+        if data:
+            self._offset += len(data)
+            for chunk in self._hash_chunks([data]):
+                self._write_received(fd, chunk, self._offset - len(chunk),
+                                     on_data)
+
+        data_read, data_write, copy_read, copy_write = pipes
+        copy = io.FileIO(copy_read, 'rb', closefd=False)
+        view = memoryview(buf)
+        while self._offset < self.size:
+            start = time.time()
+            try:
+                count = splice.splice(sock.fileno(), data_write,
+                                      self.size - self._offset,
+                                      flags=(splice.SPLICE_F_MOVE
+                                             | splice.SPLICE_F_MORE))
+            except _RESUMABLE_ERRORS as e:
+                return e
+            if not count:
+                return self._check_complete()
+            seconds = time.time() - start
+            pending = count
+            while pending:
+                duplicated = splice.tee(data_read, copy_write, pending)
+                moved = 0
+                while moved < duplicated:
+                    moved += splice.splice(data_read, fd, duplicated - moved,
+                                           offset_out=self._offset + moved)
+                hashed = 0
+                while hashed < duplicated:
+                    # The buffer is reused once its last content is hashed.
+                    self.wait_hashed(self._offset)
+                    size = copy.readinto(
+                        view[:min(len(view), duplicated - hashed)])
+                    self._hasher.update(view[:size])
+                    if on_data is not None:
+                        on_data(view[:size])
+                    self._offset += size
+                    hashed += size
+                pending -= duplicated
+            if self._progress is not None:
+                self._progress.downloaded_bytes += count
+                self._progress.written_bytes += count
+            if self.rate_limit is not None:
+                self.rate_limit.consume(count)
+            if self._failover(count, seconds):
+                return None
+        return None
+
+    def close(self):
+        """Closes the download stream without reading the rest of it."""
+        if self._request is not None:
+            self._request.close()
+
+    def _hashed_chunks(self):
+        """Returns the chunks of the image, hashing them on the way."""
+        if self._chunks is None:
+            if self._range_fetcher is not None:
+                chunks = iter(self._range_fetcher)
+            else:
+                chunks = self._stream_chunks()
+            self._chunks = self._hash_chunks(chunks)
+        return self._chunks
+
+    def _hash_chunks(self, chunks):
+        for chunk in chunks:
+            self._hasher.update(chunk)
+            if self._progress is not None:
+                self._progress.downloaded_bytes += len(chunk)
+            if self.rate_limit is not None:
+                self.rate_limit.consume(len(chunk))
+            yield chunk
+
+    def __iter__(self):
+        """Downloads and returns the next chunk of the image.
+
+        :returns: A chunk of the image. Size of chunk is IMAGE_CHUNK_SIZE
+                  which is a constant in this module.
+        """
+        while self._head:
+            yield self._head.pop(0)
+        for chunk in self._hashed_chunks():
+            yield chunk
+
+    def wait_hashed(self, offset):
+        """Waits until the image has been hashed up to an offset.
+
+        :param offset: The number of bytes from the start of the image.
+        """
+        self._hasher.wait(offset)
+
+    def hexdigests(self):
+        """Computes and returns the checksums of the downloaded image.
+
+        Note that the checksums are not the true checksums of the image
+        until the download has been fully completed through this object.
+
+        :returns: A dictionary mapping the name of each algorithm from
+                  image_info to the checksum of the image, as a string in
+                  hexadecimal.
+        """
+        return self._hasher.hexdigests()
+
+    def md5sum(self):
+        """Computes and returns the md5 checksum of the downloaded image.
+
+        Note that md5sum will not return the true checksum of the image until
+        the download has been fully completed through this object's
+        iterator inferface.
+
+        :returns: The md5 checksum of the image as a string in hexadecimal.
+        """
+        return self.hexdigests()['md5']
+
+
+class _DecompressedImage(object):
+    """Decompresses an image while it is being downloaded.
+
+    Iterating yields the decompressed image in chunks of at most
+    IMAGE_CHUNK_SIZE bytes. The checksums of the download remain those of
+    the compressed image, as served.
+    """
+
+    def __init__(self, image_download, algorithm):
+        """Initialize an instance of the _DecompressedImage class.
+
+        :param image_download: An ImageDownload object.
+        :param algorithm: The compression of the image, one of the
+                          algorithms of the compression module.
+        """
+        self._image_download = image_download
+        self.algorithm = algorithm
+        self.compressed_bytes = 0
+
+    def supports_readinto(self):
+        return False
+
+    def _compressed_chunks(self):
+        for chunk in self._image_download:
+            self.compressed_bytes += len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        return compression.decompress(self._compressed_chunks(),
+                                      self.algorithm, IMAGE_CHUNK_SIZE)
+
+
+class _AlignedImageReader(object):
+    """Reads an image into a ring of reusable page-aligned buffers.
+
+    Iterating yields memoryviews into the buffers instead of new bytes
+    objects. A buffer is reused once every ``buffer_count`` chunks, so the
+    consumer must be done with a view before that many more chunks have
+    been read, which a _ImageStreamPipeline with a queue of at most
+    ``buffer_count - 2`` chunks guarantees. Every chunk but the last one is
+    a multiple of IMAGE_ALIGNMENT in size, and the chunk size adapts to the
+    measured download throughput.
+    """
+
+    def __init__(self, image_download, buffer_count):
+        """Initialize an instance of the _AlignedImageReader class.
+
+        :param image_download: An ImageDownload or _DecompressedImage
+                               object.
+        :param buffer_count: The number of buffers in the ring.
+        """
+        self._wait_hashed = None
+        if image_download.supports_readinto():
+            self._readinto = image_download.readinto
+            # The buffers are hashed in the background, see readinto().
+            self._wait_hashed = image_download.wait_hashed
+        else:
+            self._readinto = _ChunkReader(image_download).readinto
+        # NOTE: Anonymous mmaps are always page aligned.
+        self._buffers = [mmap.mmap(-1, IMAGE_MAX_CHUNK_SIZE)
+                         for i in range(buffer_count)]
+        self.chunk_size = IMAGE_CHUNK_SIZE
+
+    def _fill(self, view):
+        """Read until the view is full or the image is complete."""
+        filled = 0
+        while filled < len(view):
+            count = self._readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        return filled
+
+    def __iter__(self):
+        index = 0
+        offset = 0
+        # The image offset at the end of each buffer's current content.
+        ends = [0] * len(self._buffers)
+        while True:
+            slot = index % len(self._buffers)
+            if self._wait_hashed is not None:
+                self._wait_hashed(ends[slot])
+            view = memoryview(self._buffers[slot])
+            start = time.time()
+            filled = self._fill(view[:self.chunk_size])
+            elapsed = time.time() - start
+            offset += filled
+            ends[slot] = offset
+            if filled:
+                yield view[:filled]
+            if filled < self.chunk_size:
+                return
+            self.chunk_size = _next_chunk_size(self.chunk_size, elapsed)
+            index += 1
+
+
+class _ChunkReader(object):
+    """Adapts an iterable of chunks to the readinto() interface."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readinto(self, buf):
+        if not len(self._pending):
+            self._pending = memoryview(next(self._chunks, b''))
+        count = min(len(buf), len(self._pending))
+        buf[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+def _next_chunk_size(chunk_size, elapsed):
+    """Pick the size of the next chunk from the time taken by the last one.
+
+    :param chunk_size: The size of the last chunk in bytes.
+    :param elapsed: The time, in seconds, it took to read the last chunk.
+    :returns: A size, aligned to IMAGE_ALIGNMENT, that should take about
+              IMAGE_CHUNK_TARGET_TIME seconds to read. It grows or shrinks
+              by at most a factor of two at a time.
+    """
+    if elapsed > 0:
+        wanted = int(chunk_size * IMAGE_CHUNK_TARGET_TIME / elapsed)
+    else:
+        wanted = IMAGE_MAX_CHUNK_SIZE
+    wanted = max(chunk_size // 2, min(chunk_size * 2, wanted))
+    wanted -= wanted % IMAGE_ALIGNMENT
+    return max(IMAGE_MIN_CHUNK_SIZE, min(IMAGE_MAX_CHUNK_SIZE, wanted))
+
+
+class _DirectIOWriter(object):
+    """Writes an image to a device bypassing the page cache.
+
+    All writes but the last one must be a multiple of IMAGE_ALIGNMENT in
+    size and come from aligned buffers. The unaligned tail of the image,
+    which O_DIRECT cannot write, goes through the page cache instead.
+    """
+
+    def __init__(self, device):
+        """Initialize an instance of the _DirectIOWriter class.
+
+        :param device: The device name, as a string, to write to.
+        :raises: OSError if the device cannot be opened with O_DIRECT.
+        """
+        self._device = device
+        self._fd = os.open(device, os.O_WRONLY | _O_DIRECT)
+        self._offset = 0
+        self._tail_written = False
+
+    @classmethod
+    def open(cls, device):
+        """Open a device for direct I/O if it supports it.
+
+        :param device: The device name, as a string, to write to.
+        :returns: A _DirectIOWriter, or None if the device does not
+                  support direct I/O.
+        """
+        if not _O_DIRECT:
+            LOG.warning('Direct I/O is not supported on this platform')
+            return None
+        try:
+            return cls(device)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.warning('Device %(dev)s does not support direct I/O, '
+                        'writing through the page cache: %(err)s',
+                        {'dev': device, 'err': e})
+            return None
+
+    def _write_all(self, fd, view):
+        while len(view):
+            count = os.write(fd, view)
+            view = view[count:]
+            self._offset += count
+
+    def write(self, data):
+        if self._tail_written:
+            raise IOError('Cannot write to {} past the unaligned end of the '
+                          'image'.format(self._device))
+        view = memoryview(data)
+        aligned = len(view) - len(view) % IMAGE_ALIGNMENT
+        if aligned:
+            self._write_all(self._fd, view[:aligned])
+        if aligned < len(view):
+            fd = os.open(self._device, os.O_WRONLY)
+            try:
+                os.lseek(fd, self._offset, os.SEEK_SET)
+                self._write_all(fd, view[aligned:])
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._tail_written = True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._offset = os.lseek(self._fd, offset, whence)
+        return self._offset
+
+    def flush(self):
+        # Nothing is buffered, writes reach the device at once.
+        pass
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        try:
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _pwrite(fd, data, offset):
+    """Write all of data to a file descriptor at the given offset.
+
+    :param fd: An open file descriptor.
+    :param data: The bytes, or a buffer, to write.
+    :param offset: The offset to write the data at.
+    """
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            count = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            count = os.write(fd, view)
+        view = view[count:]
+        offset += count
+
+
+def _pread(fd, length, offset):
+    """Read from a file descriptor at the given offset.
+
+    :param fd: An open file descriptor.
+    :param length: The number of bytes to read.
+    :param offset: The offset to read from.
+    :returns: The bytes read, fewer than length only at the end of the file.
+    """
+    chunks = []
+    while length:
+        if hasattr(os, 'pread'):
+            data = os.pread(fd, length, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, length)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+        offset += len(data)
+    return b''.join(chunks)
+
+
+def _range_ioctl(fd, request, offset, length):
+    """Run a BLKZEROOUT or BLKDISCARD ioctl on a range of a device.
+
+    :param fd: An open file descriptor of the device.
+    :param request: The ioctl request, BLKZEROOUT or BLKDISCARD.
+    :param offset: The offset of the range, in bytes.
+    :param length: The length of the range, in bytes.
+    :returns: True if the ioctl succeeded, False otherwise.
+    """
+    try:
+        fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+        return True
+    except (IOError, OSError) as e:
+        LOG.debug('ioctl %(req)#x of %(len)d bytes at %(off)d failed: '
+                  '%(err)s', {'req': request, 'len': length, 'off': offset,
+                              'err': e})
+        return False
+
+
+def _zero_range(fd, offset, length):
+    """Zero a range of a device.
+
+    Uses the BLKZEROOUT ioctl, which lets the device zero the range
+    without transferring any data where supported, and writes zeros
+    otherwise.
+
+    :param fd: An open file descriptor of the device.
+    :param offset: The offset of the range, in bytes.
+    :param length: The length of the range, in bytes.
+    """
+    if _range_ioctl(fd, BLKZEROOUT, offset, length):
+        return
+
+    zeros = bytes(bytearray(min(length, IMAGE_CHUNK_SIZE)))
+    end = offset + length
+    while offset < end:
+        count = min(len(zeros), end - offset)
+        _pwrite(fd, zeros[:count], offset)
+        offset += count
+
+
+def _queue_attribute(device, attribute):
+    """Read an attribute of the request queue of a device from sysfs.
+
+    :param device: The device name, as a string.
+    :param attribute: The name of the attribute, e.g. 'nr_requests'.
+    :returns: The value of the attribute as a string, None if it cannot be
+              read.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    path = '/sys/block/{}/queue/{}'.format(name, attribute)
+    if os.path.exists('/sys/class/block/{}/partition'.format(name)):
+        # Partitions share the request queue of their disk.
+        path = '/sys/class/block/{}/../queue/{}'.format(name, attribute)
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _discard_zeroes_data(device):
+    """Check whether discarded blocks of a device are read back as zeros.
+
+    :param device: The device name, as a string.
+    :returns: True if the device guarantees that discarded blocks read as
+              zeros, False otherwise.
+    """
+    return _queue_attribute(device, 'discard_zeroes_data') == '1'
+
+
+_ZEROS = {}
+
+
+def _is_zero(data):
+    """Check whether a block of data is all zeros.
+
+    The data is compared in place against a zero filled bytes object of
+    the same length. On Python 3, bytes.startswith() takes any bytes-like
+    object and runs at memcmp speed, unlike comparing memoryviews which is
+    done item by item. On Python 2, str.startswith() only takes strings,
+    but comparing a memoryview with a string is done with memcmp.
+
+    :param data: A bytes-like object.
+    :returns: True if every byte of data is zero.
+    """
+    length = len(data)
+    zeros = _ZEROS.get(length)
+    if zeros is None:
+        zeros = _ZEROS.setdefault(length, bytes(bytearray(length)))
+    if six.PY2:
+        return data == zeros
+    return zeros.startswith(data)
+
+
+def _release(view):
+    """Release the buffer of a memoryview, if the Python version can.
+
+    memoryview.release() only exists from Python 3.2. Python 2 lets the
+    underlying object be closed while views of it exist.
+    """
+    if not six.PY2:
+        view.release()
+
+
+class _SparseWriter(object):
+    """Skips writing the all-zero blocks of a raw image.
+
+    Wraps a writer with write, seek and fileno methods. Runs of zero
+    blocks are skipped over and zeroed with BLKZEROOUT, so that only the
+    actual data of the image is transferred to the device. When the device
+    guarantees that discarded blocks read as zeros, the whole range of the
+    image is discarded upfront and zero blocks are not touched at all.
+    """
+
+    def __init__(self, writer, device, size=None):
+        """Initialize an instance of the _SparseWriter class.
+
+        :param writer: The writer of the device, positioned at its start.
+        :param device: The device name, as a string, being written to.
+        :param size: The size of the image in bytes, if known.
+        """
+        self._writer = writer
+        self._offset = 0
+        self._zero_start = None
+        self.written_bytes = 0
+        self.skipped_bytes = 0
+        self.zero_mode = 'zeroout'
+        if (size and _discard_zeroes_data(device)
+                and _range_ioctl(writer.fileno(), BLKDISCARD, 0, size)):
+            self.zero_mode = 'discard'
+
+    def _skip(self, length):
+        if self._zero_start is None:
+            self._zero_start = self._offset
+        self._offset += length
+        self.skipped_bytes += length
+
+    def _end_zeros(self):
+        if self._zero_start is None:
+            return
+        start, length = self._zero_start, self._offset - self._zero_start
+        self._zero_start = None
+        if self.zero_mode == 'discard':
+            self._writer.seek(self._offset, os.SEEK_SET)
+            return
+        if _range_ioctl(self._writer.fileno(), BLKZEROOUT, start, length):
+            self._writer.seek(self._offset, os.SEEK_SET)
+            return
+        # Write the zeros after all, from a page aligned buffer so that
+        # direct I/O writers can use it.
+        self._writer.seek(start, os.SEEK_SET)
+        zeros = mmap.mmap(-1, min(length, IMAGE_MAX_CHUNK_SIZE))
+        try:
+            view = memoryview(zeros)
+            while length:
+                count = min(len(view), length)
+                self._writer.write(view[:count])
+                length -= count
+            _release(view)
+        finally:
+            zeros.close()
+
+    def _write(self, view):
+        self._end_zeros()
+        self._writer.write(view)
+        self._offset += len(view)
+        self.written_bytes += len(view)
+
+    def write(self, data):
+        view = memoryview(data)
+        if _is_zero(view):
+            self._skip(len(view))
+            return
+        data_start = None
+        for start in range(0, len(view), SPARSE_BLOCK_SIZE):
+            block = view[start:start + SPARSE_BLOCK_SIZE]
+            if not _is_zero(block):
+                if data_start is None:
+                    data_start = start
+                continue
+            if data_start is not None:
+                self._write(view[data_start:start])
+                data_start = None
+            self._skip(len(block))
+        if data_start is not None:
+            self._write(view[data_start:])
+
+    def flush(self):
+        """Zero the zero blocks at the end of the image, if any."""
+        self._end_zeros()
+
+    @property
+    def stats(self):
+        total = self.written_bytes + self.skipped_bytes
+        return {'skipped_bytes': self.skipped_bytes,
+                'skipped_ratio': (float(self.skipped_bytes) / total
+                                  if total else 0.0),
+                'zero_mode': self.zero_mode}
+
+
+class _RangeDigester(object):
+    """Computes a CRC32 of every range of an image as it is written.
+
+    Wraps the write callable of a writer receiving the image in order. CRC32
+    is cheap enough to keep up with the writes, and only has to detect data
+    which is not read back from the device as it was written.
+    """
+
+    def __init__(self, write, range_size):
+        """Initialize an instance of the _RangeDigester class.
+
+        :param write: A callable accepting a chunk of the image.
+        :param range_size: The size of the ranges, a multiple of
+                           IMAGE_ALIGNMENT.
+        """
+        self._write = write
+        self.range_size = range_size
+        self.digests = []
+        self.size = 0
+        self._crc = 0
+        self._filled = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        start = 0
+        while start < len(view):
+            count = min(len(view) - start, self.range_size - self._filled)
+            self._crc = zlib.crc32(view[start:start + count], self._crc)
+            self._filled += count
+            start += count
+            if self._filled == self.range_size:
+                self._end_range()
+        self.size += len(view)
+        self._write(data)
+
+    def _end_range(self):
+        self.digests.append(self._crc & 0xffffffff)
+        self._crc = 0
+        self._filled = 0
+
+    def flush(self):
+        """Complete the digest of the last range of the image."""
+        if self._filled:
+            self._end_range()
+
+    @classmethod
+    def combine(cls, digesters):
+        """Join the digests of consecutive parts of an image.
+
+        :param digesters: The flushed _RangeDigester of every part, in
+                          order. All of them but the last must cover a
+                          multiple of the same range size.
+        :returns: A _RangeDigester holding the digests of the whole image.
+        """
+        combined = cls(None, digesters[0].range_size)
+        for digester in digesters:
+            combined.digests.extend(digester.digests)
+            combined.size += digester.size
+        return combined
+
+
+class _SharingWriter(object):
+    """Shares the chunks of an image with peers as they are written."""
+
+    def __init__(self, write, flush, shared_images, image_id, block_size):
+        """Initialize an instance of the _SharingWriter class.
+
+        :param write: A callable accepting a chunk of the image, which
+                      receives the image in order.
+        :param flush: A callable writing out what the file the image is
+                      shared from buffers, so that peers can read it.
+        :param shared_images: The peers.SharedImages the image is shared
+                              through.
+        :param image_id: The ID of the image.
+        :param block_size: The size of the chunks of the image shared.
+        """
+        self._write = write
+        self._flush = flush
+        self._shared_images = shared_images
+        self._image_id = image_id
+        self._block_size = block_size
+        self._written = 0
+
+    def write(self, data):
+        self._write(data)
+        self._flush()
+        self._written += len(data)
+        self._shared_images.update(self._image_id,
+                                   self._written // self._block_size)
+
+
+class _StoringWriter(object):
+    """Adds the chunks of an image to the chunk store as they are written.
+
+    Used for images without a block manifest, which is built meanwhile.
+    """
+
+    def __init__(self, write, store):
+        """Initialize an instance of the _StoringWriter class.
+
+        :param write: A callable accepting a chunk of the image, which
+                      receives the image in order.
+        :param store: The chunk_store.ChunkStore to add the chunks to.
+        """
+        self._write = write
+        self._store = store
+        self._builder = block_manifest.Builder(chunk_store.CHUNK_SIZE)
+
+    def _put(self, blocks):
+        for digest, block in blocks:
+            self._store.put(self._builder.algorithm, digest, block)
+
+    def write(self, data):
+        self._write(data)
+        self._put(self._builder.update(data))
+
+    def finish(self):
+        """Stores the last chunk.
+
+        :returns: The block_manifest.Manifest of the image, None if it is
+                  empty.
+        """
+        blocks, manifest = self._builder.finish()
+        self._put(blocks)
+        return manifest
+
+
+class _DeviceStream(object):
+    """The writers an image is streamed through onto one device."""
+
+    def __init__(self, device, writer, image_info, size):
+        """Initialize an instance of the _DeviceStream class.
+
+        :param device: The name of the device.
+        :param writer: The file object of the device, open for writing.
+        :param image_info: Image information dictionary.
+        :param size: The size of the image written, None if unknown.
+        """
+        self.device = device
+        self.sparse = None
+        self.digester = None
+        self.write = writer.write
+        if image_info.get('stream_sparse', False):
+            self.sparse = _SparseWriter(writer, device, size)
+            self.write = self.sparse.write
+        if image_info.get('verify_writes', CONF.image_verify_writes):
+            self.digester = _RangeDigester(self.write, VERIFY_RANGE_SIZE)
+            self.write = self.digester.write
+
+    def finish(self):
+        """Write out the data held back by the writers."""
+        if self.sparse is not None:
+            self.sparse.flush()
+        if self.digester is not None:
+            self.digester.flush()
+
+
+class _FanOutWriter(object):
+    """Writes every chunk of an image to several devices concurrently.
+
+    Each device has its own writer thread. write() returns once all of
+    them are done with the chunk, as chunks may be views into buffers the
+    reader reuses. A device failing does not stop the others, its error is
+    kept in ``errors``.
+    """
+
+    _FINISH = object()
+    _END = object()
+
+    def __init__(self, streams):
+        """Initialize an instance of the _FanOutWriter class.
+
+        :param streams: The _DeviceStream objects of the devices.
+        """
+        self._streams = streams
+        self._queues = [six.moves.queue.Queue(maxsize=1) for s in streams]
+        self._done = six.moves.queue.Queue()
+        # Device name to the exception writing to it failed with.
+        self.errors = {}
+        self._threads = []
+        for index, stream in enumerate(streams):
+            thread = threading.Thread(target=self._run,
+                                      args=(stream, self._queues[index]),
+                                      name='image-write-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, stream, queue):
+        while True:
+            item = queue.get()
+            if item is self._END:
+                return
+            if stream.device not in self.errors:
+                try:
+                    if item is self._FINISH:
+                        stream.finish()
+                    else:
+                        stream.write(item)
+                except Exception as e:
+                    LOG.error('Unable to write image to device %(dev)s: '
+                              '%(err)s', {'dev': stream.device, 'err': e})
+                    self.errors[stream.device] = e
+            self._done.put(None)
+
+    def _dispatch(self, item):
+        for queue in self._queues:
+            queue.put(item)
+        for queue in self._queues:
+            self._done.get()
+
+    def write(self, data):
+        """Write a chunk to every device which has not failed.
+
+        :raises: The error of the first device if all of them failed.
+        """
+        self._dispatch(data)
+        if len(self.errors) == len(self._streams):
+            raise self.errors[self._streams[0].device]
+
+    def finish(self):
+        """Finish writing to every device and stop the writer threads."""
+        try:
+            self._dispatch(self._FINISH)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the writer threads."""
+        threads, self._threads = self._threads, []
+        if threads:
+            for queue in self._queues:
+                queue.put(self._END)
+        for thread in threads:
+            thread.join()
+
+
+def _open_unbuffered(device):
+    """Open a device for reading, bypassing the page cache if possible.
+
+    :param device: The device name, as a string.
+    :returns: A tuple of the file descriptor and whether it uses direct I/O.
+    """
+    if _O_DIRECT:
+        try:
+            return os.open(device, os.O_RDONLY | _O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    fd = os.open(device, os.O_RDONLY)
+    # Drop what is cached so that the data is read from the device.
+    os.fsync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return fd, False
+
+
+def _read_back_ranges(device, digester, first, last, mismatches,
+                      checksums=None):
+    """Reads ranges of an image back from a device and checks them.
+
+    :param device: The device name, as a string.
+    :param digester: The _RangeDigester the image was written through.
+    :param first: The index of the first range to check.
+    :param last: The index after the last range to check.
+    :param mismatches: A list to add an (index, CRC32) tuple to for every
+                       range which does not match.
+    :param checksums: Optional hashlib objects to update with the data read,
+                      only when reading the ranges of the whole image.
+    """
+    fd, direct = _open_unbuffered(device)
+    buf = mmap.mmap(-1, IMAGE_MAX_CHUNK_SIZE)
+    try:
+        reader = io.FileIO(fd, 'rb', closefd=False)
+        view = memoryview(buf)
+        for index in six.moves.range(first, last):
+            offset = index * digester.range_size
+            length = min(digester.range_size, digester.size - offset)
+            os.lseek(fd, offset, os.SEEK_SET)
+            crc = 0
+            while length > 0:
+                # Direct I/O reads whole aligned blocks, past the end of
+                # the image if needed.
+                size = min(len(view), length)
+                size += -size % IMAGE_ALIGNMENT
+                count = reader.readinto(view[:size])
+                if not count:
+                    break
+                crc = zlib.crc32(view[:min(count, length)], crc)
+                for checksum in checksums or ():
+                    checksum.update(view[:min(count, length)])
+                length -= count
+            crc &= 0xffffffff
+            if length > 0 or crc != digester.digests[index]:
+                mismatches.append((index, crc))
+        _release(view)
+    finally:
+        buf.close()
+        os.close(fd)
+
+
+def _check_read_back(image_info, device, digester, mismatches):
+    """Fails if ranges of an image were not read back as they were written.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string.
+    :param digester: The _RangeDigester the image was written through.
+    :param mismatches: The (index, CRC32) tuples of the ranges which do not
+                       match.
+    :raises: ImageChecksumError if there are any.
+    """
+    if not mismatches:
+        return
+    index, crc = min(mismatches)
+    offset = index * digester.range_size
+    location = '{} bytes {}-{} ({} of {} ranges differ)'.format(
+        device, offset,
+        min(offset + digester.range_size, digester.size) - 1,
+        len(mismatches), len(digester.digests))
+    LOG.error('Image %(image)s was not read back from %(location)s as '
+              'it was written', {'image': image_info['id'],
+                                 'location': location})
+    raise errors.ImageChecksumError(
+        image_info['id'], location,
+        '{:08x}'.format(digester.digests[index]), '{:08x}'.format(crc))
+
+
+def _verify_written_image(image_info, device, digester, workers):
+    """Reads an image back from a device and compares it with what was written.
+
+    Each thread reads its own contiguous part of the image, bypassing the
+    page cache when the device supports direct I/O.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string.
+    :param digester: The _RangeDigester the image was written through.
+    :param workers: The number of threads reading the device.
+    :raises: ImageChecksumError if part of the image does not match.
+    :returns: A dictionary with the duration and throughput of the
+              verification.
+    """
+    starttime = time.time()
+    count = len(digester.digests)
+    workers = max(1, min(workers, count))
+    mismatches = []
+    failures = []
+
+    def _verify(first, last):
+        try:
+            _read_back_ranges(device, digester, first, last, mismatches)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=_verify,
+                                args=(number * count // workers,
+                                      (number + 1) * count // workers),
+                                name='image-verify-{}'.format(number))
+               for number in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    _check_read_back(image_info, device, digester, mismatches)
+
+    seconds = time.time() - starttime
+    return {
+        'bytes': digester.size,
+        'seconds': round(seconds, 3),
+        'bytes_per_second': int(digester.size / seconds) if seconds else None,
+        'workers': workers,
+    }
+
+
+def _region_writers(image_info, device, size):
+    """Picks the number of threads writing regions of an image to a device.
+
+    Every thread is expected to keep REGION_WRITER_QUEUE_DEPTH requests of
+    the device queue busy, so that the deep queues of NVMe devices get more
+    of them, up to CONF.image_region_max_writers. Rotational disks, and
+    devices whose queue is unknown, are written sequentially.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string.
+    :param size: The size of the image in bytes.
+    :returns: The number of region writers, 1 to write the image
+              sequentially.
+    """
+    if not image_info.get('region_writes', CONF.image_region_writes):
+        return 1
+    if _queue_attribute(device, 'rotational') != '0':
+        LOG.debug('Writing image %(image)s sequentially to %(dev)s, which '
+                  'is rotational or unknown', {'image': image_info['id'],
+                                               'dev': device})
+        return 1
+    try:
+        depth = int(_queue_attribute(device, 'nr_requests'))
+    except (TypeError, ValueError):
+        LOG.debug('Unknown queue depth of %s, writing image %s '
+                  'sequentially', device, image_info['id'])
+        return 1
+    # Every region spans whole ranges of VERIFY_RANGE_SIZE.
+    ranges = -(-size // VERIFY_RANGE_SIZE)
+    writers = min(CONF.image_region_max_writers,
+                  depth // REGION_WRITER_QUEUE_DEPTH, ranges)
+    LOG.debug('Picked %(writers)d region writers for image %(image)s on '
+              '%(dev)s with a queue depth of %(depth)d',
+              {'writers': writers, 'image': image_info['id'], 'dev': device,
+               'depth': depth})
+    return max(1, writers)
+
+
+def _write_regions(image_info, image_download, device, writers):
+    """Writes a raw image to a device as regions written in parallel.
+
+    The image is split into contiguous regions spanning whole ranges of
+    VERIFY_RANGE_SIZE, one per writer. Every writer thread downloads its
+    region over its own range request and writes it with pwrite, computing
+    the CRC32 of every range it writes, like a _RangeDigester.
+
+    :param image_info: Image information dictionary.
+    :param image_download: The ImageDownload of the image, which must
+                           support range requests.
+    :param device: The device name, as a string.
+    :param writers: The number of regions written in parallel.
+    :raises: ImageDownloadError if a region cannot be downloaded or
+             written.
+    :returns: A _RangeDigester holding the CRC32 of every range of the
+              image.
+    """
+    size = image_download.size
+    ranges = -(-size // VERIFY_RANGE_SIZE)
+    regions = []
+    for number in range(writers):
+        first = number * ranges // writers
+        last = (number + 1) * ranges // writers
+        regions.append((first * VERIFY_RANGE_SIZE,
+                        min(last * VERIFY_RANGE_SIZE, size)))
+    digesters = [None] * writers
+    failures = []
+    current = progress.current()
+    lock = threading.Lock()
+    fd = os.open(device, os.O_WRONLY)
+
+    def _write_region(number, start, end):
+        offset = [start]
+
+        def _write(data):
+            _pwrite(fd, data, offset[0])
+            offset[0] += len(data)
+            if current is not None:
+                with lock:
+                    current.written_bytes += len(data)
+
+        digester = _RangeDigester(_write, VERIFY_RANGE_SIZE)
+        chunks = image_download.stream_range(start, end - 1)
+        try:
+            for chunk in chunks:
+                if failures:
+                    return
+                digester.write(chunk)
+            digester.flush()
+            digesters[number] = digester
+        except Exception as e:
+            failures.append(e)
+        finally:
+            chunks.close()
+
+    threads = [threading.Thread(target=_write_region,
+                                args=(number, start, end),
+                                name='image-region-{}'.format(number))
+               for number, (start, end) in enumerate(regions)]
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not failures:
+            os.fsync(fd)
+    except EnvironmentError as e:
+        failures.append(e)
+    finally:
+        os.close(fd)
+
+    if failures:
+        if isinstance(failures[0], errors.ImageDownloadError):
+            raise failures[0]
+        msg = 'Unable to write image to device {}. Error: {}'.format(
+            device, failures[0])
+        raise errors.ImageDownloadError(image_info['id'], msg)
+    return _RangeDigester.combine(digesters)
+
+
+def _verify_regions(image_info, device, digester):
+    """Reads an image written as regions back and verifies it.
+
+    The checksums of the image cannot be computed while its regions are
+    written out of order, so the image is read back from the device once,
+    in order, both to compute them and to compare every range with the
+    CRC32 computed while writing it.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string.
+    :param digester: The _RangeDigester holding the CRC32 of every range
+                     of the image.
+    :raises: ImageChecksumError if a range was not read back as it was
+             written, or the image does not match its checksum.
+    :returns: A dictionary with the duration and throughput of the
+              verification.
+    """
+    starttime = time.time()
+    checksums = dict((algorithm, getattr(hashlib, algorithm)())
+                     for algorithm, value in _image_checksums(image_info))
+    mismatches = []
+    _read_back_ranges(device, digester, 0, len(digester.digests),
+                      mismatches, list(checksums.values()))
+    _check_read_back(image_info, device, digester, mismatches)
+    _verify_image(image_info, device,
+                  dict((algorithm, checksum.hexdigest())
+                       for algorithm, checksum in checksums.items()))
+    seconds = time.time() - starttime
+    return {
+        'bytes': digester.size,
+        'seconds': round(seconds, 3),
+        'bytes_per_second': int(digester.size / seconds) if seconds else None,
+        'workers': 1,
+    }
+
+
+class _Qcow2DeviceWriter(object):
+    """Converts a sequentially streamed qcow2 image onto a device.
+
+    The location of every data cluster is known upfront from the L1 and L2
+    tables, so the clusters are picked out of the stream as it goes by and
+    written to their offset on the virtual disk. Everything else, including
+    the metadata, is skipped without being buffered.
+    """
+
+    def __init__(self, header, clusters, fd):
+        """Initialize an instance of the _Qcow2DeviceWriter class.
+
+        :param header: The qcow2.Header of the image.
+        :param clusters: A list of qcow2.Cluster tuples for the image.
+        :param fd: An open file descriptor of the target device.
+        """
+        self._header = header
+        self._clusters = sorted(clusters, key=lambda c: c.host_offset)
+        self._next = 0
+        self._fd = fd
+        self._buffer = bytearray()
+        # Offset in the image of the first byte in the buffer
+        self._buffer_start = 0
+
+    def _write_cluster(self, cluster, data):
+        if cluster.kind == qcow2.COMPRESSED:
+            data = self._header.decompress(data)
+        _pwrite(self._fd, memoryview(data)[:cluster.guest_length],
+                cluster.guest_offset)
+
+    def _flush(self, final=False):
+        buffer_end = self._buffer_start + len(self._buffer)
+        while self._next < len(self._clusters):
+            cluster = self._clusters[self._next]
+            cluster_end = cluster.host_offset + cluster.host_length
+            if cluster_end > buffer_end:
+                # NOTE: Compressed clusters at the end of the image may be
+                # shorter than their descriptor claims.
+                if not (final and cluster.kind == qcow2.COMPRESSED
+                        and cluster.host_offset < buffer_end):
+                    break
+            start = cluster.host_offset - self._buffer_start
+            self._write_cluster(
+                cluster, self._buffer[start:start + cluster.host_length])
+            self._next += 1
+
+        # Keep only what the next cluster may need. Compressed clusters may
+        # share bytes with the previous cluster, so go by the start offset.
+        if self._next < len(self._clusters):
+            keep_from = min(self._clusters[self._next].host_offset,
+                            buffer_end)
+        else:
+            keep_from = buffer_end
+        del self._buffer[:keep_from - self._buffer_start]
+        self._buffer_start = keep_from
+
+    def write(self, chunk):
+        """Consume the next chunk of the image.
+
+        :param chunk: The next bytes of the image.
+        """
+        chunk_end = self._buffer_start + len(self._buffer) + len(chunk)
+        if (not self._buffer
+                and (self._next >= len(self._clusters)
+                     or chunk_end <= self._clusters[self._next].host_offset)):
+            # Nothing of interest in this chunk
+            self._buffer_start = chunk_end
+            return
+        self._buffer += chunk
+        self._flush()
+
+    def close(self):
+        """Finish the conversion.
+
+        :raises: ImageFormatError if the image ended before all of its
+                 clusters were read.
+        """
+        self._flush(final=True)
+        if self._next < len(self._clusters):
+            raise errors.ImageFormatError(
+                'qcow2 image is truncated, cluster at offset {} is '
+                'missing'.format(self._clusters[self._next].host_offset))
+
+
+def _holes(clusters, size):
+    """Find the ranges of a virtual disk not covered by any cluster.
+
+    :param clusters: A list of qcow2.Cluster tuples.
+    :param size: The size of the virtual disk.
+    :returns: A list of (offset, length) tuples.
+    """
+    holes = []
+    position = 0
+    for cluster in sorted(clusters, key=lambda c: c.guest_offset):
+        if cluster.guest_offset > position:
+            holes.append((position, cluster.guest_offset - position))
+        position = max(position, cluster.guest_offset + cluster.guest_length)
+    if position < size:
+        holes.append((position, size - position))
+    return holes
+
+
+class _ImageStreamPipeline(object):
+    """Overlaps downloading an image with writing it out.
+
+    A reader thread pulls chunks from the download into a bounded queue
+    while the calling thread drains the queue into the writer, so the
+    network and the disk are kept busy at the same time. The queue bound
+    provides backpressure: when the writer falls behind the reader blocks
+    instead of buffering the image in memory.
+    """
+
+    _POLL_INTERVAL = 0.1
+    _END = object()
+
+    def __init__(self, chunks, queue_size):
+        """Initialize an instance of the _ImageStreamPipeline class.
+
+        :param chunks: An iterable yielding chunks of the image, e.g. an
+                       ImageDownload object.
+        :param queue_size: The maximum number of chunks buffered between
+                           the reader and the writer.
+        """
+        self._chunks = chunks
+        self._queue = six.moves.queue.Queue(maxsize=queue_size)
+        self._progress = progress.current()
+        self._stopped = threading.Event()
+        self._error = None
+        self._read_time = 0.0
+        self._read_stall = 0.0
+
+    def _put(self, item):
+        """Queue an item, giving up if the writer has stopped.
+
+        :returns: The time spent waiting for space in the queue.
+        """
+        start = time.time()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=self._POLL_INTERVAL)
+                break
+            except six.moves.queue.Full:
+                continue
+        return time.time() - start
+
+    def _read(self):
+        chunks = iter(self._chunks)
+        try:
+            while not self._stopped.is_set():
+                start = time.time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                self._read_time += time.time() - start
+                self._read_stall += self._put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            if self._stopped.is_set() and hasattr(chunks, 'close'):
+                chunks.close()
+            self._put(self._END)
+
+    def run(self, write):
+        """Stream the whole image into the given writer.
+
+        :param write: A callable accepting a chunk of the image.
+        :raises: Any exception raised while downloading or writing.
+        :returns: A dictionary with the throughput and stall time of the
+                  download and write stages.
+        """
+        starttime = time.time()
+        write_time = write_stall = 0.0
+        size = 0
+        reader = threading.Thread(target=self._read,
+                                  name='image-stream-reader')
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                start = time.time()
+                chunk = self._queue.get()
+                write_stall += time.time() - start
+                if chunk is self._END:
+                    break
+                start = time.time()
+                write(chunk)
+                write_time += time.time() - start
+                size += len(chunk)
+                if self._progress is not None:
+                    self._progress.written_bytes += len(chunk)
+        finally:
+            self._stopped.set()
+            reader.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return {
+            'bytes': size,
+            'seconds': round(time.time() - starttime, 3),
+            'download': _stage_stats(size, self._read_time,
+                                     self._read_stall),
+            'write': _stage_stats(size, write_time, write_stall),
+            # The stage waiting on the other one is not the bottleneck.
+            'bottleneck': ('network' if write_stall > self._read_stall
+                           else 'disk'),
+        }
+
+
+def _stage_stats(size, busy_time, stall_time):
+    """Summarize the work done by one stage of an image stream.
+
+    :param size: The number of bytes handled by the stage.
+    :param busy_time: The time, in seconds, the stage spent working.
+    :param stall_time: The time, in seconds, the stage spent waiting on
+                       the other stage.
+    :returns: A dictionary describing the stage.
+    """
+    return {
+        'seconds': round(busy_time, 3),
+        'stall_seconds': round(stall_time, 3),
+        'bytes_per_second': int(size / busy_time) if busy_time else None,
+    }
+
+
+def _verify_image(image_info, image_location, checksums):
+    """Verifies the checksums of the local images match expectations.
+
+    If this function does not raise ImageChecksumError then it is very likely
+    that the local copy of the image was transmitted and stored correctly.
+
+    :param image_info: Image information dictionary.
+    :param image_location: The location of the local image.
+    :param checksums: The computed checksums of the local image, as a
+                      dictionary mapping algorithm names to hex digests, or
+                      just the MD5 checksum as a string.
+    :raises: ImageChecksumError if a checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+    """
+    if isinstance(checksums, six.string_types):
+        checksums = {'md5': checksums}
+    for algorithm, expected in _image_checksums(image_info):
+        checksum = checksums.get(algorithm)
+        LOG.debug('Verifying image at {} against {} checksum '
+                  '{}'.format(image_location, algorithm.upper(), checksum))
+        if checksum != expected:
+            LOG.error(errors.ImageChecksumError.details_str.format(
+                image_location, image_info['id'], expected, checksum))
+            raise errors.ImageChecksumError(image_location, image_info['id'],
+                                            expected, checksum)
+
+
+def _fetch_block_manifest(image_info):
+    """Downloads the block-hash manifest of an image.
+
+    :param image_info: Image information dictionary.
+    :returns: A block_manifest.Manifest, or None if the image has none.
+    """
+    if image_info.get('block_manifest_url'):
+        urls = [image_info['block_manifest_url']]
+    else:
+        urls = [url + BLOCK_MANIFEST_SUFFIX for url in image_info['urls']]
+    no_proxy = image_info.get('no_proxy')
+    if no_proxy:
+        os.environ['no_proxy'] = no_proxy
+    proxies = image_info.get('proxies', {})
+    verify, cert = utils.get_ssl_client_options(CONF)
+    for url in urls:
+        try:
+            resp = requests.get(url, proxies=proxies, verify=verify,
+                                cert=cert)
+            if resp.status_code != 200:
+                LOG.info('No block manifest for image %(image)s at %(url)s: '
+                         'received status code %(code)s',
+                         {'image': image_info['id'], 'url': url,
+                          'code': resp.status_code})
+                continue
+            return block_manifest.Manifest(resp.content)
+        except (requests.exceptions.RequestException,
+                errors.ImageFormatError) as e:
+            LOG.warning('Unable to get the block manifest of image '
+                        '%(image)s from %(url)s: %(err)s',
+                        {'image': image_info['id'], 'url': url, 'err': e})
+    return None
+
+
+def _device_size(device):
+    """Get the size of a device in bytes."""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def _changed_blocks(device, manifest, workers):
+    """Compares a device with the block-hash manifest of an image.
+
+    The blocks are read and hashed by several threads in parallel.
+
+    :param device: The device name, as a string, holding the previous image.
+    :param manifest: The block_manifest.Manifest of the new image.
+    :param workers: The number of threads reading the device.
+    :raises: OSError if the device cannot be read.
+    :returns: The indexes of the blocks whose content on the device differs
+              from the image, in ascending order.
+    """
+    indexes = iter(six.moves.range(manifest.block_count))
+    changed = []
+    failures = []
+    lock = threading.Lock()
+
+    def _scan():
+        try:
+            fd = os.open(device, os.O_RDONLY)
+            try:
+                while not failures:
+                    with lock:
+                        index = next(indexes, None)
+                    if index is None:
+                        return
+                    offset, length = manifest.block_range(index)
+                    if not manifest.matches(index,
+                                            _pread(fd, length, offset)):
+                        with lock:
+                            changed.append(index)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=_scan,
+                                name='image-scan-{}'.format(number))
+               for number in range(min(workers, manifest.block_count))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    return sorted(changed)
+
+
+def _target_devices(image_info):
+    """Get the devices an image is written to.
+
+    :param image_info: Image information dictionary. Its optional
+                       'target_devices' key lists device names or
+                       dictionaries of root device hints.
+    :raises: DeviceNotFound if no device matches some root device hints.
+    :raises: InvalidCommandParamsError if several targets are the same
+             device.
+    :returns: A list of device names, the OS install device if the image
+              has no target devices.
+    """
+    targets = image_info.get('target_devices')
+    if not targets:
+        return [hardware.dispatch_to_managers('get_os_install_device')]
+    block_devices = None
+    devices = []
+    for target in targets:
+        if isinstance(target, dict):
+            if block_devices is None:
+                block_devices = [
+                    dev.serialize() for dev in
+                    hardware.dispatch_to_managers('list_block_devices')]
+            device = _match_root_device_hints(block_devices, target)
         else:
-            details = '\n '.join(details)
-            raise errors.ImageDownloadError(image_info['id'], details)
+            device = target
+        if device in devices:
+            raise errors.InvalidCommandParamsError(
+                'Image target devices {} resolve to device {} more than '
+                'once'.format(targets, device))
+        devices.append(device)
+    return devices
 
-    def _download_file(self, image_info, url):
-        """Opens a download stream for the given URL.
 
-        :param image_info: Image information dictionary.
-        :param url: The URL string to request the image from.
+def _match_root_device_hints(block_devices, hints):
+    """Find the device matching root device hints.
 
-        :raises: ImageDownloadError if the download stream was not started
-                 properly.
-        """
-        no_proxy = image_info.get('no_proxy')
-        if no_proxy:
-            os.environ['no_proxy'] = no_proxy
-        proxies = image_info.get('proxies', {})
-        verify, cert = utils.get_ssl_client_options(CONF)
-        resp = requests.get(url, stream=True, proxies=proxies,
-                            verify=verify, cert=cert)
-        if resp.status_code != 200:
-            msg = ('Received status code {} from {}, expected 200. Response '
-                   'body: {}').format(resp.status_code, url, resp.text)
-            raise errors.ImageDownloadError(image_info['id'], msg)
-        return resp
+    The hints are matched here rather than by get_os_install_device(), so
+    that hardware managers keep its signature.
 
-    def __iter__(self):
-        """Downloads and returns the next chunk of the image.
+    :param block_devices: The serialized block devices of the node.
+    :param hints: A dictionary of root device hints.
+    :raises: DeviceNotFound if no device matches the hints.
+    :returns: The name of the device.
+    """
+    try:
+        device = il_utils.match_root_device_hints(block_devices, hints)
+    except ValueError as e:
+        raise errors.DeviceNotFound(
+            'No devices could be found using the root device hints '
+            '{} because they failed to validate. Error: {}'.format(hints, e))
+    if not device:
+        raise errors.DeviceNotFound(
+            'No suitable device was found for deployment using these '
+            'hints {}'.format(hints))
+    LOG.info('Picked target device %(dev)s based on root device hints '
+             '%(hints)s', {'dev': device['name'], 'hints': hints})
+    return device['name']
 
-        :returns: A chunk of the image. Size of chunk is IMAGE_CHUNK_SIZE
-                  which is a constant in this module.
-        """
-        for chunk in self._request.iter_content(IMAGE_CHUNK_SIZE):
-            self._md5checksum.update(chunk)
-            yield chunk
 
-    def md5sum(self):
-        """Computes and returns the md5 checksum of the downloaded image.
+def _disk_name(device):
+    """Get the name of the disk of a device.
 
-        Note that md5sum will not return the true checksum of the image until
-        the download has been fully completed through this object's
-        iterator inferface.
+    :param device: The device name, e.g. '/dev/sda2'.
+    :returns: The name of the disk, e.g. 'sda'.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    sys_path = os.path.realpath('/sys/class/block/{}'.format(name))
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        return os.path.basename(os.path.dirname(sys_path))
+    return name
 
-        :returns: The md5 checksum of the image as a string in hexadecimal.
-        """
-        return self._md5checksum.hexdigest()
 
+def _chunk_store(devices):
+    """Get the chunk store, unless it is on a device an image is written to.
 
-def _verify_image(image_info, image_location, checksum):
-    """Verifies the checksum of the local images matches expectations.
+    :param devices: The device names the image is written to.
+    :returns: The chunk_store.ChunkStore, None if there is none or it
+              cannot be used.
+    """
+    store = chunk_store.get_store()
+    if store is None:
+        return None
+    try:
+        disk = _disk_of(store.path)
+    except OSError as e:
+        LOG.warning('Not using the chunk store %(path)s: %(err)s',
+                    {'path': store.path, 'err': e})
+        return None
+    for device in devices:
+        if disk is not None and disk == _disk_name(device):
+            LOG.warning('Not using the chunk store %(path)s, which is on '
+                        'the install device %(dev)s',
+                        {'path': store.path, 'dev': device})
+            return None
+    return store
 
-    If this function does not raise ImageChecksumError then it is very likely
-    that the local copy of the image was transmitted and stored correctly.
+
+def _manifest_key(image_info):
+    """Get the key of the manifest of an image in the chunk store.
 
     :param image_info: Image information dictionary.
-    :param image_location: The location of the local image.
-    :param checksum: The computed checksum of the local image.
-    :raises: ImageChecksumError if the checksum of the local image does not
-             match the checksum as reported by glance in image_info.
+    :returns: A file name unique to the image and its checksum.
+    """
+    checksum = image_info.get('os_hash_value') or image_info['checksum']
+    return hashlib.sha256('{}\n{}'.format(
+        image_info['id'], checksum).encode('utf-8')).hexdigest()
+
+
+def _setup_peers(image_download, image_info, store=None, agent_url=None):
+    """Prepares downloading an image from peer agents and sharing it.
+
+    :param image_download: The ImageDownload of the image, nothing must
+                           have been read from it yet.
+    :param image_info: Image information dictionary.
+    :param store: The chunk_store.ChunkStore to read chunks of the image
+                  from and to add them to, if any.
+    :param agent_url: The URL of the API of this agent, if known.
+    :returns: The block_manifest.Manifest of the image, or None if the image
+              is neither downloaded from peers or the chunk store nor shared
+              with peers.
     """
-    LOG.debug('Verifying image at {} against MD5 checksum '
-              '{}'.format(image_location, checksum))
-    if checksum != image_info['checksum']:
-        LOG.error(errors.ImageChecksumError.details_str.format(
-            image_location, image_info['id'],
-            image_info['checksum'], checksum))
-        raise errors.ImageChecksumError(image_location, image_info['id'],
-                                        image_info['checksum'], checksum)
+    image_peers = image_info.get('peers', [])
+    if not image_peers and not CONF.image_peer_sharing and store is None:
+        return None
+    manifest = _fetch_block_manifest(image_info)
+    if store is not None:
+        if manifest is None:
+            manifest = store.load_manifest(_manifest_key(image_info))
+        else:
+            store.save_manifest(_manifest_key(image_info), manifest)
+    if manifest is None:
+        return None
+    if manifest.size != image_download.size:
+        LOG.warning('The block manifest of image %(image)s is for %(man)d '
+                    'bytes but the image has %(size)s, not sharing it with '
+                    'peers', {'image': image_info['id'],
+                              'man': manifest.size,
+                              'size': image_download.size})
+        return None
+    if image_peers or store is not None:
+        if image_download.supports_ranges():
+            image_download.use_peers(manifest, image_peers,
+                                     _download_connections(image_info),
+                                     store=store, agent_url=agent_url)
+        else:
+            LOG.warning('Server does not support range requests, not '
+                        'downloading image %s from peers or the chunk store',
+                        image_info['id'])
+    return manifest
 
 
-def _download_image(image_info):
+def _fetch_image(image_info, device=None):
     """Downloads the specified image to the local file system.
 
     :param image_info: Image information dictionary.
+    :param device: The install device the image will be written to, if
+                   known. The image is never cached on it.
+    :raises: ImageStagingError if there is no room to cache the image, before
+             downloading any of it.
     :raises: ImageDownloadError if the image download fails for any reason.
     :raises: ImageChecksumError if the downloaded image's checksum does not
              match the one reported in image_info.
+    :returns: The block_manifest.Manifest of the image if it can be shared
+              with peers, None otherwise.
     """
     starttime = time.time()
-    image_location = _image_location(image_info)
+    progress.set_stage('download')
     image_download = ImageDownload(image_info, time_obj=starttime)
+    try:
+        _check_image_fits(image_info,
+                          _image_virtual_size(image_info, image_download),
+                          [device] if device else [])
+        image_location = _stage_image(image_info, image_download.size,
+                                      device)
+    except (errors.ImageStagingError, errors.InvalidCommandParamsError):
+        image_download.close()
+        raise
+    store = _chunk_store([device] if device else [])
+    manifest = _setup_peers(image_download, image_info, store)
 
+    storing = None
     with open(image_location, 'wb') as f:
+        write = f.write
+        if store is not None and manifest is None:
+            storing = _StoringWriter(write, store)
+            write = storing.write
         try:
             for chunk in image_download:
-                f.write(chunk)
+                write(chunk)
+            built_manifest = storing.finish() if storing else None
         except Exception as e:
             msg = 'Unable to write image to {}. Error: {}'.format(
                 image_location, str(e))
@@ -310,7 +3485,251 @@ def _download_image(image_info):
     totaltime = time.time() - starttime
     LOG.info("Image downloaded from {} in {} seconds".format(image_location,
                                                              totaltime))
-    _verify_image(image_info, image_location, image_download.md5sum())
+    if image_download.store_bytes:
+        LOG.info('Read %(bytes)d bytes of image %(image)s from the chunk '
+                 'store', {'bytes': image_download.store_bytes,
+                           'image': image_info['id']})
+    _verify_image(image_info, image_location, image_download.hexdigests())
+    if built_manifest is not None:
+        store.save_manifest(_manifest_key(image_info), built_manifest)
+    return manifest
+
+
+class _Prefetch(object):
+    """A download of an image in the background, before it is deployed.
+
+    The image is cached like by _fetch_image, at the lower throughput of
+    CONF.image_prefetch_max_rate if set. Progress is not tracked, the
+    thread runs no command.
+    """
+
+    def __init__(self, image_info):
+        self.image_info = dict(image_info)
+        if (CONF.image_prefetch_max_rate
+                and 'download_max_rate' not in image_info):
+            self.image_info['download_max_rate'] = (
+                CONF.image_prefetch_max_rate)
+        self.manifest = None
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run,
+            name='image-prefetch-{}'.format(image_info['id']))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        starttime = time.time()
+        try:
+            device = _target_devices(self.image_info)[0]
+        except errors.RESTError as e:
+            LOG.debug('Prefetching image %(image)s without knowing the '
+                      'install device: %(err)s',
+                      {'image': self.image_info['id'], 'err': e})
+            device = None
+        try:
+            self.manifest = _fetch_image(self.image_info, device)
+        except Exception as e:
+            LOG.warning('Prefetching image %(image)s failed: %(err)s',
+                        {'image': self.image_info['id'], 'err': e})
+            self.error = e
+        else:
+            LOG.info('Prefetched image %(image)s in %(time).1f seconds',
+                     {'image': self.image_info['id'],
+                      'time': time.time() - starttime})
+
+    def wait(self, image_info, device=None):
+        """Waits for the prefetch to end and checks whether it can be used.
+
+        :param image_info: Image information dictionary of the deployment.
+        :param device: The install device the image will be written to, if
+                       known.
+        :returns: True if the prefetched image is cached and matches
+                  image_info, False if it has to be downloaded again.
+        """
+        if self._thread.is_alive():
+            LOG.info('Waiting for the prefetch of image %s to complete',
+                     image_info['id'])
+        self._thread.join()
+        if self.error is not None:
+            return False
+        if _image_checksums(image_info) != _image_checksums(self.image_info):
+            LOG.warning('Image %s was prefetched with other checksums, '
+                        'downloading it again', image_info['id'])
+            return False
+        location = _image_location(image_info)
+        try:
+            disk = _disk_of(location)
+        except OSError as e:
+            LOG.warning('Prefetched image %(image)s is gone from '
+                        '%(location)s: %(err)s',
+                        {'image': image_info['id'], 'location': location,
+                         'err': e})
+            return False
+        if (device is not None
+                and disk == os.path.basename(os.path.realpath(device))):
+            LOG.warning('Image %(image)s was prefetched on the install '
+                        'device %(dev)s, downloading it again',
+                        {'image': image_info['id'], 'dev': device})
+            return False
+        return True
+
+
+# Prefetches of images, by image ID.
+_PREFETCHES = {}
+_PREFETCHES_LOCK = threading.Lock()
+
+
+def _start_prefetch(image_info):
+    """Starts prefetching an image unless it already is.
+
+    :param image_info: Image information dictionary.
+    :returns: The _Prefetch of the image.
+    """
+    with _PREFETCHES_LOCK:
+        prefetch = _PREFETCHES.get(image_info['id'])
+        if prefetch is None:
+            LOG.info('Prefetching image %s', image_info['id'])
+            prefetch = _PREFETCHES[image_info['id']] = _Prefetch(image_info)
+            prefetch.start()
+    return prefetch
+
+
+def _is_prefetched(image_info):
+    """Checks whether an image is being or has been prefetched.
+
+    :param image_info: Image information dictionary.
+    """
+    with _PREFETCHES_LOCK:
+        return image_info['id'] in _PREFETCHES
+
+
+def _download_image(image_info, device=None):
+    """Downloads the specified image to the local file system.
+
+    If the image is being prefetched, the prefetch is waited for instead,
+    and the image is only downloaded again if the prefetch failed or cannot
+    be used.
+
+    :param image_info: Image information dictionary.
+    :param device: The install device the image will be written to, if
+                   known. The image is never cached on it.
+    :raises: ImageStagingError if there is no room to cache the image, before
+             downloading any of it.
+    :raises: ImageDownloadError if the image download fails for any reason.
+    :raises: ImageChecksumError if the downloaded image's checksum does not
+             match the one reported in image_info.
+    :returns: The block_manifest.Manifest of the image if it can be shared
+              with peers, None otherwise.
+    """
+    with _PREFETCHES_LOCK:
+        prefetch = _PREFETCHES.pop(image_info['id'], None)
+    if prefetch is not None:
+        progress.set_stage('download')
+        # The prefetch caches the image at the same location, it has to
+        # end before the image is downloaded again.
+        if prefetch.wait(image_info, device):
+            LOG.info('Using the prefetched image %s', image_info['id'])
+            return prefetch.manifest
+    return _fetch_image(image_info, device)
+
+
+def _node_image_info(node):
+    """Builds the image information of the image of a node.
+
+    :param node: The node, as received at lookup.
+    :returns: Image information dictionary, None if the instance
+              information of the node does not name an image to download.
+    """
+    instance_info = node.get('instance_info') or {}
+    source = instance_info.get('image_source')
+    url = instance_info.get('image_url')
+    checksum = instance_info.get('image_checksum')
+    if not (source and url and checksum):
+        return None
+    image_info = {
+        'id': source.split('/')[-1],
+        'urls': [url],
+        'checksum': checksum,
+        'node_uuid': node.get('uuid'),
+    }
+    for key, info_key in (('image_disk_format', 'disk_format'),
+                          ('image_container_format', 'container_format'),
+                          ('image_os_hash_algo', 'os_hash_algo'),
+                          ('image_os_hash_value', 'os_hash_value')):
+        if instance_info.get(key):
+            image_info[info_key] = instance_info[key]
+    return image_info
+
+
+def _write_configdrive(image_info, device, configdrive, partition=None,
+                       extra_devices=()):
+    """Streams a config drive onto its partition of a device.
+
+    A config drive given as a URL is downloaded like an image, with the
+    proxies and download settings of the image, but without counting it in
+    the progress of the image. It is downloaded once, and kept in memory
+    when it is written to several devices.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string.
+    :param configdrive: The config drive as a URL or as gzip compressed,
+                        base64 encoded content.
+    :param partition: The config drive partition, if already created.
+    :param extra_devices: The names of other devices to write the config
+                          drive to, at the end of each device.
+    :raises: InstanceDeployFailure if the config drive cannot be downloaded
+             or written.
+    """
+    # Will use dummy value of 'local' for 'node_uuid', if it is not
+    # available. This is to handle scenario wherein new IPA is being used
+    # with older version of Ironic that did not pass 'node_uuid' in
+    # 'image_info'
+    node_uuid = image_info.get('node_uuid', 'local')
+    try:
+        if il_utils.is_http_url(configdrive):
+            download_info = {'id': 'configdrive', 'urls': [configdrive],
+                             'checksum': None, 'download_connections': 1}
+            for key in ('no_proxy', 'proxies', 'download_max_rate',
+                        'download_ramp_up'):
+                if key in image_info:
+                    download_info[key] = image_info[key]
+            chunks = ImageDownload(download_info, track_progress=False)
+            if extra_devices:
+                chunks = _read_configdrive(chunks, node_uuid)
+        for target in [device] + list(extra_devices):
+            if not il_utils.is_http_url(configdrive):
+                chunks = config_drive.text_chunks(configdrive)
+            config_drive.write_partition(node_uuid, target, chunks,
+                                         partition=partition)
+            # The other devices get a new partition at their end.
+            partition = None
+    except errors.ImageDownloadError as e:
+        msg = ('Can\'t download the configdrive content for node {} from '
+               '\'{}\'. Reason: {}').format(node_uuid, configdrive,
+                                            e.secondary_message)
+        raise exception.InstanceDeployFailure(msg)
+
+
+def _read_configdrive(chunks, node_uuid):
+    """Read the whole content of a config drive in memory.
+
+    :returns: The list of the chunks of the content.
+    """
+    # NOTE: Base64 encoding and compression headers can make valid content
+    # larger than the config drive itself, but never twice as large.
+    content = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > 2 * config_drive.MAX_SIZE:
+            raise exception.InstanceDeployFailure(
+                'Config drive size exceeds maximum limit of {}MiB for '
+                'node {}.'.format(disk_utils.MAX_CONFIG_DRIVE_SIZE_MB,
+                                  node_uuid))
+        content.append(chunk)
+    return content
 
 
 def _validate_image_info(ext, image_info=None, **kwargs):
@@ -341,6 +3760,34 @@ def _validate_image_info(ext, image_info=None, **kwargs):
         raise errors.InvalidCommandParamsError(
             'Image \'checksum\' must be a non-empty string.')
 
+    if 'download_connections' in image_info:
+        _download_connections(image_info)
+
+    _download_rate_limit(image_info)
+
+    if 'url_selection' in image_info:
+        _url_selection(image_info)
+
+    targets = image_info.get('target_devices', [])
+    if (not isinstance(targets, list)
+            or not all(isinstance(target, (dict, six.string_types))
+                       for target in targets)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_devices\' must be a list of device names or '
+            'root device hints.')
+    if len(targets) > 1 and image_info.get('image_type') == 'partition':
+        raise errors.InvalidCommandParamsError(
+            'Partition images can only be written to one device.')
+
+    image_peers = image_info.get('peers', [])
+    if (not isinstance(image_peers, list)
+            or not all(isinstance(peer, six.string_types)
+                       for peer in image_peers)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'peers\' must be a list of agent URLs.')
+
+    _image_checksums(image_info)
+
 
 class StandbyExtension(base.BaseAgentExtension):
     """Extension which adds stand-by related functionality to agent."""
@@ -352,54 +3799,653 @@ class StandbyExtension(base.BaseAgentExtension):
         super(StandbyExtension, self).__init__(agent=agent)
 
         self.cached_image_id = None
+        self.image_device = None
         self.partition_uuids = None
+        self.image_stats = None
+        self.shared_images = peers.SharedImages()
+
+    def _agent_url(self):
+        """Get the URL of the API of this agent, as its peers are given it.
 
-    def _cache_and_write_image(self, image_info, device):
+        :returns: The URL, or None if the agent address is not known.
+        """
+        address = getattr(self.agent, 'advertise_address', None)
+        if address is None or address.hostname is None:
+            return None
+        return peers.agent_url(address.hostname, address.port)
+
+    def _cache_and_write_image(self, image_info, device, extra_devices=None):
         """Cache an image and write it to a local device.
 
         :param image_info: Image information dictionary.
         :param device: The disk name, as a string, on which to store the
                        image.  Example: '/dev/sda'
+        :param extra_devices: A list of other disk names the cached image is
+                              written to as well.
 
+        :raises: ImageStagingError if there is no room to cache the image and
+                 it cannot be streamed onto the device either.
         :raises: ImageDownloadError if the image download fails for any reason.
         :raises: ImageChecksumError if the downloaded image's checksum does not
                   match the one reported in image_info.
         :raises: ImageWriteError if writing the image fails.
         """
-        _download_image(image_info)
-        self.partition_uuids = _write_image(image_info, device)
+        if (_is_compressed_format(image_info)
+                and self._stream_image_onto_device(image_info, device,
+                                                   extra_devices)):
+            self.cached_image_id = image_info['id']
+            return
+        try:
+            manifest = _download_image(image_info, device)
+        except errors.ImageStagingError as e:
+            if not self._stream_image_onto_device(image_info, device,
+                                                  extra_devices):
+                raise
+            LOG.warning('Streamed image %(image)s onto %(device)s instead of '
+                        'caching it: %(err)s', {'image': image_info['id'],
+                                                'device': device,
+                                                'err': e.secondary_message})
+        else:
+            stats = {}
+            self.partition_uuids = _write_image(image_info, device,
+                                                stats=stats)
+            if extra_devices:
+                stats['devices'] = {device: dict(stats)}
+            for extra_device in extra_devices or []:
+                stats['devices'][extra_device] = {}
+                _write_image(image_info, extra_device,
+                             stats=stats['devices'][extra_device])
+            if stats:
+                self.image_stats = stats
+            if manifest is not None and CONF.image_peer_sharing:
+                self.shared_images.share(image_info['id'], manifest,
+                                         _image_location(image_info))
         self.cached_image_id = image_info['id']
 
-    def _stream_raw_image_onto_device(self, image_info, device):
+    def _stream_image_onto_device(self, image_info, device,
+                                  extra_devices=None):
+        """Streams an image onto a device if its format allows.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :param extra_devices: A list of other disk names the image is
+                              streamed onto as well.
+        :returns: True if the image was streamed, False if it cannot be.
+        """
+        disk_format = image_info.get('disk_format')
+        raw = disk_format == 'raw' or _is_compressed_format(image_info)
+        if image_info.get('image_type') == 'partition':
+            if raw and not extra_devices:
+                self._stream_partition_image_onto_device(image_info, device)
+                return True
+            return False
+        self.partition_uuids = {}
+        if raw:
+            self._stream_raw_image_onto_device(image_info, device,
+                                               extra_devices)
+            return True
+        if disk_format == 'qcow2' and not extra_devices:
+            return self._stream_qcow2_image_onto_device(image_info, device)
+        return False
+
+    def _stream_partition_image_onto_device(self, image_info, device):
+        """Streams a raw partition image into its root partition.
+
+        The partitions are created first, then the image is streamed into
+        the root partition like a whole disk image onto a device, with the
+        same checksum verification and zero skipping, without caching it.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to create the
+                       partitions.  Example: '/dev/sda'
+
+        :raises: InstanceDeployFailure if the partitions cannot be created.
+        :raises: ImageWriteError if a partitioning command fails.
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+        """
+        partitions = _make_partitions(image_info, device)
+        root = partitions['root']
+        self._stream_raw_image_onto_device(image_info, root)
+
+        uuids = {
+            'root uuid': root,
+            'efi system partition uuid': partitions.get(
+                'efi system partition'),
+        }
+        if partitions.get('PReP Boot partition'):
+            uuids['PReP Boot partition uuid'] = partitions[
+                'PReP Boot partition']
+        try:
+            for key, path in uuids.items():
+                if path:
+                    uuids[key] = disk_utils.block_uuid(path)
+        except processutils.ProcessExecutionError as e:
+            raise errors.ImageWriteError(root, e.exit_code, e.stdout,
+                                         e.stderr)
+        self.partition_uuids = dict(uuids, partitions=partitions)
+
+    def _stream_raw_image_onto_device(self, image_info, device,
+                                      extra_devices=None):
         """Streams raw image data to specified local device.
 
+        Images compressed with gzip, xz or zstd are decompressed on the fly,
+        their compression is detected from their first bytes unless their
+        'disk_format' names it.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :param extra_devices: A list of other disk names the same download
+                              is written to concurrently, each by its own
+                              thread.
+
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageFormatError if a compressed image cannot be
+                 decompressed.
+        :raises: ImageChecksumError if the checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+        """
+        devices = [device] + list(extra_devices or [])
+        starttime = time.time()
+        progress.set_stage('stream')
+        image_download = ImageDownload(image_info, time_obj=starttime)
+        try:
+            _check_image_fits(image_info,
+                              _image_virtual_size(image_info,
+                                                  image_download),
+                              devices)
+        except errors.InvalidCommandParamsError:
+            image_download.close()
+            raise
+        store = _chunk_store(devices)
+        manifest = _setup_peers(image_download, image_info, store,
+                                agent_url=self._agent_url())
+
+        writers = []
+        direct_io = image_info.get('stream_direct_io',
+                                   CONF.image_stream_direct_io)
+        try:
+            if direct_io:
+                for dev in devices:
+                    writer = _DirectIOWriter.open(dev)
+                    if writer is None:
+                        # All the devices are written the same chunks, so
+                        # they are all written through the page cache.
+                        direct_io = False
+                        break
+                    writers.append(writer)
+                if not direct_io:
+                    for writer in writers:
+                        writer.close()
+                    writers = []
+            algorithm = _image_compression(
+                image_info, image_download,
+                direct_io and image_download.supports_readinto())
+        except Exception:
+            for writer in writers:
+                writer.close()
+            raise
+
+        # Regions are written out of order, and spliced data is never seen
+        # in order by the agent, which the manifests of peers and of the
+        # chunk store are not built for.
+        plain = (algorithm is None and len(devices) == 1
+                 and manifest is None and store is None)
+        region_writers = 1
+        if plain and image_download.supports_ranges():
+            region_writers = _region_writers(image_info, device,
+                                             image_download.size)
+        if region_writers > 1:
+            for writer in writers:
+                writer.close()
+            self._write_image_regions(image_info, image_download, device,
+                                      region_writers, starttime)
+            return
+        if plain and image_info.get('stream_splice',
+                                    CONF.image_stream_splice):
+            if image_download.supports_splice():
+                for writer in writers:
+                    writer.close()
+                self._splice_image(image_info, image_download, device,
+                                   starttime)
+                return
+            LOG.info('Image %s cannot be spliced, it is not downloaded over '
+                     'a single plain HTTP connection', image_info['id'])
+
+        source = image_download
+        size = image_download.size
+        if algorithm is not None:
+            LOG.info('Decompressing %(algo)s compressed image %(image)s '
+                     'while streaming it', {'algo': algorithm,
+                                            'image': image_info['id']})
+            source = _DecompressedImage(image_download, algorithm)
+            size = None
+
+        if direct_io:
+            # Keep the memory used by the larger aligned chunks in line with
+            # the configured queue size.
+            queue_size = max(1, CONF.image_write_queue_size
+                             * IMAGE_CHUNK_SIZE // IMAGE_MAX_CHUNK_SIZE)
+            reader = _AlignedImageReader(source, queue_size + 2)
+            pipeline = _ImageStreamPipeline(reader, queue_size)
+        else:
+            pipeline = _ImageStreamPipeline(source,
+                                            CONF.image_write_queue_size)
+            writers = [open(dev, 'wb+') for dev in devices]
+
+        # The manifest is the one of the compressed image.
+        share = (manifest is not None and algorithm is None
+                 and CONF.image_peer_sharing)
+        files = []
+        streams = []
+        fan_out = None
+        try:
+            for writer in writers:
+                files.append(writer.__enter__())
+            streams = [_DeviceStream(dev, f, image_info, size)
+                       for dev, f in zip(devices, files)]
+            write = streams[0].write
+            if len(streams) > 1:
+                fan_out = _FanOutWriter(streams)
+                write = fan_out.write
+            if share:
+                self.shared_images.share(image_info['id'], manifest,
+                                         device, available=0)
+                write = _SharingWriter(write, files[0].flush,
+                                       self.shared_images, image_info['id'],
+                                       manifest.block_size).write
+            storing = None
+            # The chunks of compressed images are not the ones written.
+            if store is not None and manifest is None and algorithm is None:
+                storing = _StoringWriter(write, store)
+                write = storing.write
+            stats = pipeline.run(write)
+            built_manifest = storing.finish() if storing else None
+            if fan_out is not None:
+                fan_out.finish()
+            else:
+                streams[0].finish()
+        except errors.ImageFormatError:
+            self.shared_images.unshare(image_info['id'])
+            raise
+        except Exception as e:
+            self.shared_images.unshare(image_info['id'])
+            msg = 'Unable to write image to device {}. Error: {}'.format(
+                  ', '.join(devices), str(e))
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        finally:
+            if fan_out is not None:
+                fan_out.close()
+            for writer in writers[:len(files)]:
+                writer.__exit__(None, None, None)
+            for writer in writers[len(files):]:
+                writer.close()
+
+        if fan_out is not None and fan_out.errors:
+            self.shared_images.unshare(image_info['id'])
+            msg = 'Unable to write image to {} of {} devices: {}'.format(
+                len(fan_out.errors), len(devices),
+                '; '.join('{}: {}'.format(dev, fan_out.errors[dev])
+                          for dev in devices if dev in fan_out.errors))
+            raise errors.ImageDownloadError(image_info['id'], msg)
+
+        if algorithm is not None:
+            stats['compression'] = algorithm
+            stats['compressed_bytes'] = source.compressed_bytes
+        if image_info.get('peers') and manifest is not None:
+            stats['peer_bytes'] = image_download.peer_bytes
+        if store is not None:
+            stats['store_bytes'] = image_download.store_bytes
+        if image_download.rate_limit is not None:
+            stats['rate_limit'] = image_download.rate_limit.stats()
+        for stream in streams:
+            if stream.sparse is not None:
+                LOG.info('Skipped writing %(skipped)d zero bytes '
+                         '(%(ratio).1f%%) of image %(image)s on %(dev)s', {
+                             'skipped': stream.sparse.skipped_bytes,
+                             'ratio': (100 * stream.sparse.stats[
+                                 'skipped_ratio']),
+                             'image': image_info['id'],
+                             'dev': stream.device})
+        if streams[0].sparse is not None:
+            stats['sparse'] = streams[0].sparse.stats
+
+        totaltime = time.time() - starttime
+        LOG.info("Image streamed onto device {} in {} "
+                 "seconds".format(', '.join(devices), totaltime))
+        LOG.debug('Image stream statistics for %(image)s: %(stats)s',
+                  {'image': image_info['id'], 'stats': stats})
+        device_stats = {}
+        progress.set_stage('verify')
+        try:
+            # Verify if the checksum of the streamed image is correct
+            _verify_image(image_info, device, image_download.hexdigests())
+            for stream in streams:
+                device_stats[stream.device] = {}
+                if stream.sparse is not None:
+                    device_stats[stream.device]['sparse'] = (
+                        stream.sparse.stats)
+                if stream.digester is None:
+                    continue
+                verify = _verify_written_image(
+                    image_info, stream.device, stream.digester,
+                    CONF.image_verify_workers)
+                device_stats[stream.device]['verify'] = verify
+                LOG.info('Read image %(image)s back from device %(dev)s in '
+                         '%(time).1f seconds with %(workers)d threads',
+                         {'image': image_info['id'], 'dev': stream.device,
+                          'time': verify['seconds'],
+                          'workers': verify['workers']})
+        except Exception:
+            self.shared_images.unshare(image_info['id'])
+            raise
+        if built_manifest is not None:
+            store.save_manifest(_manifest_key(image_info), built_manifest)
+        if 'verify' in device_stats[device]:
+            stats['verify'] = device_stats[device]['verify']
+        if len(devices) > 1:
+            stats['devices'] = device_stats
+        if share:
+            self.shared_images.share(image_info['id'], manifest, device)
+        self.image_stats = stats
+
+    def _write_image_regions(self, image_info, image_download, device,
+                             writers, starttime):
+        """Writes a raw image to a device as regions written in parallel.
+
+        :param image_info: Image information dictionary.
+        :param image_download: The ImageDownload of the image, which must
+                               support range requests.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :param writers: The number of regions written in parallel.
+        :param starttime: The time the download of the image started at.
+
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the image read back from the device
+                 does not match what was written or its checksum.
+        """
+        # Every region is fetched over its own range request.
+        image_download.close()
+        current = progress.current()
+        if current is not None:
+            current.start_download(image_download.size)
+        LOG.info('Writing image %(image)s to %(dev)s as %(count)d regions '
+                 'in parallel', {'image': image_info['id'], 'dev': device,
+                                 'count': writers})
+        digester = _write_regions(image_info, image_download, device,
+                                  writers)
+        seconds = time.time() - starttime
+        stats = {
+            'bytes': digester.size,
+            'seconds': round(seconds, 3),
+            'bytes_per_second': (int(digester.size / seconds)
+                                 if seconds else None),
+            'regions': writers,
+        }
+        if image_download.rate_limit is not None:
+            stats['rate_limit'] = image_download.rate_limit.stats()
+        LOG.info('Image written to device %(dev)s as %(count)d regions in '
+                 '%(time).1f seconds', {'dev': device, 'count': writers,
+                                        'time': seconds})
+
+        progress.set_stage('verify')
+        stats['verify'] = _verify_regions(image_info, device, digester)
+        LOG.info('Read image %(image)s back from device %(dev)s in '
+                 '%(time).1f seconds', {'image': image_info['id'],
+                                        'dev': device,
+                                        'time': stats['verify']['seconds']})
+        self.image_stats = stats
+
+    def _splice_image(self, image_info, image_download, device, starttime):
+        """Moves a raw image from its download to a device with splice.
+
+        :param image_info: Image information dictionary.
+        :param image_download: The ImageDownload of the image, which must
+                               support splice.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :param starttime: The time the download of the image started at.
+
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the checksum of the image does not
+                 match the checksum as reported by glance in image_info.
+        """
+        LOG.info('Splicing image %(image)s onto device %(dev)s',
+                 {'image': image_info['id'], 'dev': device})
+        digester = None
+        if image_info.get('verify_writes', CONF.image_verify_writes):
+            # The data is already on the device, only its CRC32s are needed.
+            digester = _RangeDigester(lambda data: None, VERIFY_RANGE_SIZE)
+        fd = os.open(device, os.O_WRONLY)
+        try:
+            size = image_download.splice_into(
+                fd, digester.write if digester is not None else None)
+            os.fsync(fd)
+        except EnvironmentError as e:
+            msg = 'Unable to write image to device {}. Error: {}'.format(
+                device, e)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        finally:
+            os.close(fd)
+        seconds = time.time() - starttime
+        stats = {
+            'bytes': size,
+            'seconds': round(seconds, 3),
+            'bytes_per_second': int(size / seconds) if seconds else None,
+            'splice': True,
+        }
+        if image_download.rate_limit is not None:
+            stats['rate_limit'] = image_download.rate_limit.stats()
+        LOG.info('Image spliced onto device %(dev)s in %(time).1f seconds',
+                 {'dev': device, 'time': seconds})
+
+        progress.set_stage('verify')
+        _verify_image(image_info, device, image_download.hexdigests())
+        if digester is not None:
+            digester.flush()
+            stats['verify'] = _verify_written_image(
+                image_info, device, digester, CONF.image_verify_workers)
+        self.image_stats = stats
+
+    def _stream_qcow2_image_onto_device(self, image_info, device):
+        """Converts a qcow2 image to raw while streaming it to a device.
+
+        The L1 and L2 tables are fetched first with range requests, then the
+        image is streamed once, writing every data cluster to its offset on
+        the device as it goes by. Unallocated clusters are not written but
+        zeroed on the device. This replaces both caching the image and
+        converting it with qemu-img.
+
         :param image_info: Image information dictionary.
         :param device: The disk name, as a string, on which to store the
                        image.  Example: '/dev/sda'
 
         :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageFormatError if the image is not a supported qcow2 image.
         :raises: ImageChecksumError if the checksum of the local image does not
              match the checksum as reported by glance in image_info.
+        :raises: ImageWriteError if the device cannot be prepared.
+        :returns: False if the image server does not support range requests
+                  and the image has to be cached instead, True otherwise.
         """
         starttime = time.time()
+        progress.set_stage('stream')
         image_download = ImageDownload(image_info, time_obj=starttime)
+        if not image_download.supports_ranges():
+            LOG.warning('Server does not support range requests, cannot '
+                        'stream qcow2 image %s', image_info['id'])
+            image_download.close()
+            return False
 
-        with open(device, 'wb+') as f:
+        header = qcow2.Header(image_download.read_range(0,
+                                                        qcow2.HEADER_SIZE))
+        try:
+            _check_image_fits(image_info, header.virtual_size, [device])
+        except errors.InvalidCommandParamsError:
+            image_download.close()
+            raise
+        l2_offsets = header.parse_l1_table(image_download.read_range(
+            header.l1_table_offset, header.l1_table_length))
+        clusters = []
+        for index, l2_offset in enumerate(l2_offsets):
+            if l2_offset:
+                clusters.extend(header.parse_l2_table(
+                    image_download.read_range(l2_offset, header.cluster_size),
+                    index))
+        LOG.info('Streaming qcow2 image %(image)s with a virtual size of '
+                 '%(size)d bytes and %(count)d data clusters onto %(dev)s',
+                 {'image': image_info['id'], 'size': header.virtual_size,
+                  'count': len(clusters), 'dev': device})
+
+        _erase_partition_tables(device)
+        fd = os.open(device, os.O_WRONLY)
+        try:
+            writer = _Qcow2DeviceWriter(header, clusters, fd)
+            pipeline = _ImageStreamPipeline(image_download,
+                                            CONF.image_write_queue_size)
             try:
-                for chunk in image_download:
-                    f.write(chunk)
+                stats = pipeline.run(writer.write)
             except Exception as e:
                 msg = 'Unable to write image to device {}. Error: {}'.format(
                       device, str(e))
                 raise errors.ImageDownloadError(image_info['id'], msg)
+            writer.close()
+
+            holes = _holes(clusters, header.virtual_size)
+            for offset, length in holes:
+                _zero_range(fd, offset, length)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
+        stats['virtual_size'] = header.virtual_size
+        stats['zeroed_bytes'] = sum(length for offset, length in holes)
         totaltime = time.time() - starttime
-        LOG.info("Image streamed onto device {} in {} "
+        LOG.info("qcow2 image streamed onto device {} in {} "
                  "seconds".format(device, totaltime))
-        # Verify if the checksum of the streamed image is correct
-        _verify_image(image_info, device, image_download.md5sum())
+        progress.set_stage('verify')
+        _verify_image(image_info, device, image_download.hexdigests())
+        self.image_stats = stats
+        return True
+
+    def _delta_write_image(self, image_info, device):
+        """Writes only the blocks of a raw image which differ on a device.
+
+        The device is compared with the block-hash manifest of the image,
+        and the blocks which differ are downloaded with range requests and
+        written in place. The whole device range of the image is then read
+        back to verify the checksums of the image.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+
+        :raises: ImageDownloadError if the changed blocks cannot be
+                 downloaded or written.
+        :returns: False if the image has to be written in full instead,
+                  True otherwise.
+        """
+        starttime = time.time()
+        manifest = _fetch_block_manifest(image_info)
+        if manifest is None:
+            return False
+
+        image_download = ImageDownload(image_info, time_obj=starttime)
+        # Only ranges of the image are needed.
+        image_download.close()
+        if not image_download.supports_ranges():
+            LOG.warning('Server does not support range requests, cannot '
+                        'delta deploy image %s', image_info['id'])
+            return False
+        if image_download.size != manifest.size:
+            LOG.warning('The block manifest of image %(image)s is for %(man)d '
+                        'bytes but the image has %(size)s, cannot delta '
+                        'deploy it', {'image': image_info['id'],
+                                      'man': manifest.size,
+                                      'size': image_download.size})
+            return False
+        if _device_size(device) < manifest.size:
+            LOG.warning('Device %(dev)s is smaller than image %(image)s',
+                        {'dev': device, 'image': image_info['id']})
+            return False
 
-    @base.async_command('cache_image', _validate_image_info)
+        progress.set_stage('scan')
+        changed = _changed_blocks(device, manifest,
+                                  CONF.image_delta_scan_workers)
+        scan_time = time.time() - starttime
+        LOG.info('%(changed)d of the %(count)d blocks of image %(image)s '
+                 'differ on device %(dev)s, compared in %(time).1f seconds',
+                 {'changed': len(changed), 'count': manifest.block_count,
+                  'image': image_info['id'], 'dev': device,
+                  'time': scan_time})
+
+        ranges = manifest.ranges(changed, IMAGE_RANGE_SIZE)
+        current = progress.current()
+        if current is not None:
+            current.start_download(sum(length for offset, length in ranges))
+        progress.set_stage('stream')
+        fetched = 0
+        fd = os.open(device, os.O_WRONLY)
+        try:
+            for offset, length in ranges:
+                data = image_download.read_range(offset, length)
+                try:
+                    _pwrite(fd, data, offset)
+                except EnvironmentError as e:
+                    msg = ('Unable to write image to device {}. Error: '
+                           '{}').format(device, e)
+                    raise errors.ImageDownloadError(image_info['id'], msg)
+                fetched += len(data)
+                if current is not None:
+                    current.downloaded_bytes = current.written_bytes = fetched
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        progress.set_stage('verify')
+
+        hasher = _ImageHasher([algorithm for algorithm, value
+                               in _image_checksums(image_info)])
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            for offset in six.moves.range(0, manifest.size,
+                                          IMAGE_CHUNK_SIZE):
+                hasher.update(_pread(
+                    fd, min(IMAGE_CHUNK_SIZE, manifest.size - offset),
+                    offset))
+        finally:
+            os.close(fd)
+        try:
+            _verify_image(image_info, device, hasher.hexdigests())
+        except errors.ImageChecksumError:
+            LOG.warning('Delta deploy of image %s does not match its '
+                        'checksum, the block manifest may be stale. '
+                        'Writing the whole image instead', image_info['id'])
+            return False
+
+        totaltime = time.time() - starttime
+        LOG.info('Image %(image)s delta deployed onto device %(dev)s in '
+                 '%(time).1f seconds, %(fetched)d bytes downloaded',
+                 {'image': image_info['id'], 'dev': device,
+                  'time': totaltime, 'fetched': fetched})
+        self.image_stats = {
+            'bytes': fetched,
+            'seconds': round(totaltime, 3),
+            'delta': {
+                'block_size': manifest.block_size,
+                'blocks': manifest.block_count,
+                'changed_blocks': len(changed),
+                'scan_seconds': round(scan_time, 3),
+            },
+        }
+        return True
+
+    @base.async_command('cache_image', _validate_image_info,
+                        track_progress=True)
     def cache_image(self, image_info=None, force=False):
         """Asynchronously caches specified image to the local OS device.
 
@@ -414,14 +4460,16 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: ImageWriteError if writing the image fails.
         """
         LOG.debug('Caching image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _target_devices(image_info)
+        device = devices[0]
 
         msg = 'image ({}) already present on device {} '
 
         if self.cached_image_id != image_info['id'] or force:
             LOG.debug('Already had %s cached, overwriting',
                       self.cached_image_id)
-            self._cache_and_write_image(image_info, device)
+            self._cache_and_write_image(image_info, device, devices[1:])
+            self.image_device = device
             msg = 'image ({}) cached to device {} '
 
         result_msg = _message_format(msg, image_info, device,
@@ -430,7 +4478,45 @@ class StandbyExtension(base.BaseAgentExtension):
         LOG.info(result_msg)
         return result_msg
 
-    @base.async_command('prepare_image', _validate_image_info)
+    @base.sync_command('prefetch_image', _validate_image_info)
+    def prefetch_image(self, image_info=None):
+        """Starts downloading an image in the background.
+
+        A later cache_image or prepare_image command for the same image uses
+        the prefetched image, waiting for its download to complete if needed.
+        Compressed images are always streamed, they are not prefetched.
+
+        :param image_info: Image information dictionary.
+        :returns: A message describing what is done.
+        """
+        if self.cached_image_id == image_info['id']:
+            msg = 'image ({}) already cached'
+        elif _is_compressed_format(image_info):
+            msg = 'image ({}) is streamed, not prefetched'
+        else:
+            _start_prefetch(image_info)
+            msg = 'prefetching image ({})'
+        result_msg = msg.format(image_info['id'])
+        LOG.info(result_msg)
+        return result_msg
+
+    def prefetch_node_image(self, node):
+        """Prefetches the image named by the instance information of a node.
+
+        :param node: The node, as received at lookup.
+        """
+        image_info = _node_image_info(node)
+        if image_info is None:
+            LOG.debug('Node %s names no image to prefetch', node.get('uuid'))
+            return
+        try:
+            self.prefetch_image(image_info=image_info)
+        except errors.InvalidCommandParamsError as e:
+            LOG.warning('Cannot prefetch the image of node %(node)s: '
+                        '%(err)s', {'node': node.get('uuid'), 'err': e})
+
+    @base.async_command('prepare_image', _validate_image_info,
+                        track_progress=True)
     def prepare_image(self,
                       image_info=None,
                       configdrive=None):
@@ -455,38 +4541,75 @@ class StandbyExtension(base.BaseAgentExtension):
              large to store on the given device.
         """
         LOG.debug('Preparing image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _target_devices(image_info)
+        device = devices[0]
+        extra_devices = devices[1:]
 
         disk_format = image_info.get('disk_format')
         stream_raw_images = image_info.get('stream_raw_images', False)
         # don't write image again if already cached
         if self.cached_image_id != image_info['id']:
+            self.image_stats = None
             if self.cached_image_id is not None:
                 LOG.debug('Already had %s cached, overwriting',
                           self.cached_image_id)
 
-            if (stream_raw_images and disk_format == 'raw'
+            stream_qcow2_images = image_info.get('stream_qcow2_images',
+                                                 CONF.image_stream_qcow2)
+            delta_deploy = image_info.get('delta_deploy',
+                                          CONF.image_delta_deploy)
+            if _is_prefetched(image_info):
+                LOG.debug('Image %s is prefetched, writing it from the '
+                          'cache', image_info['id'])
+                stream_raw_images = stream_qcow2_images = False
+                delta_deploy = False
+            streamed = False
+            if (delta_deploy and disk_format == 'raw' and not extra_devices
                     and image_info.get('image_type') != 'partition'):
-                self._stream_raw_image_onto_device(image_info, device)
-            else:
-                self._cache_and_write_image(image_info, device)
+                streamed = self._delta_write_image(image_info, device)
+            if streamed:
+                LOG.debug('Image %s was delta deployed', image_info['id'])
+            elif ((stream_raw_images and disk_format == 'raw'
+                    or _is_compressed_format(image_info))
+                    and image_info.get('image_type') != 'partition'):
+                self._stream_raw_image_onto_device(image_info, device,
+                                                   extra_devices)
+                streamed = True
+            elif ((stream_raw_images and disk_format == 'raw'
+                    or _is_compressed_format(image_info))
+                    and image_info.get('image_type') == 'partition'):
+                self._stream_partition_image_onto_device(image_info, device)
+                streamed = True
+            elif (stream_qcow2_images and disk_format == 'qcow2'
+                    and not extra_devices
+                    and image_info.get('image_type') != 'partition'):
+                streamed = self._stream_qcow2_image_onto_device(image_info,
+                                                                device)
+            if not streamed:
+                self._cache_and_write_image(image_info, device,
+                                            extra_devices)
+            self.image_device = device
 
         # the configdrive creation is taken care by ironic-lib's
         # work_on_disk().
         if image_info.get('image_type') != 'partition':
             if configdrive is not None:
-                # Will use dummy value of 'local' for 'node_uuid',
-                # if it is not available. This is to handle scenario
-                # wherein new IPA is being used with older version
-                # of Ironic that did not pass 'node_uuid' in 'image_info'
-                node_uuid = image_info.get('node_uuid', 'local')
-                disk_utils.create_config_drive_partition(node_uuid,
-                                                         device,
-                                                         configdrive)
+                progress.set_stage('configdrive')
+                _write_configdrive(image_info, device, configdrive,
+                                   extra_devices=extra_devices)
+        if extra_devices:
+            LOG.info('Image %(image)s was also written to %(devices)s',
+                     {'image': image_info['id'],
+                      'devices': ', '.join(extra_devices)})
         msg = 'image ({}) written to device {} '
         result_msg = _message_format(msg, image_info, device,
                                      self.partition_uuids)
         LOG.info(result_msg)
+        if self.image_stats:
+            # NOTE: Ironic parses the 'result' string for the root UUID,
+            # keep it formatted exactly like a plain string result.
+            return {'result': 'prepare_image: {}'.format(result_msg),
+                    'image_stats': self.image_stats}
         return result_msg
 
     def _run_shutdown_command(self, command):
@@ -519,9 +4642,49 @@ class StandbyExtension(base.BaseAgentExtension):
         except processutils.ProcessExecutionError as e:
             raise errors.SystemRebootError(e.exit_code, e.stdout, e.stderr)
 
+    def _kexec_image(self):
+        """Boots the deployed image with kexec.
+
+        The kernel of the image is loaded from its root file system, then
+        only the device the image was written to is flushed before booting
+        the kernel, skipping the firmware of the machine.
+
+        Only returns if the image cannot be booted with kexec, the system
+        has to be rebooted instead.
+        """
+        device = self.image_device
+        if device is None:
+            LOG.info('No image was written, cannot boot it with kexec')
+            return
+        root = (self.partition_uuids or {}).get('partitions', {}).get('root')
+        try:
+            if root:
+                partitions = [root]
+            else:
+                kexec.rescan(device)
+                partitions = kexec.partitions_of(device)
+            if not kexec.load(partitions):
+                LOG.info('No kernel found on %s, cannot boot the image with '
+                         'kexec', device)
+                return
+            LOG.info('Flushing device %s', device)
+            kexec.flush_device(device)
+            LOG.info('Booting the deployed image with kexec')
+            kexec.execute()
+        except (processutils.ProcessExecutionError, EnvironmentError) as e:
+            LOG.warning('Cannot boot the image on %(dev)s with kexec, '
+                        'rebooting instead: %(err)s', {'dev': device,
+                                                       'err': e})
+
     @base.async_command('run_image')
     def run_image(self):
-        """Runs image on agent's system via reboot."""
+        """Runs image on agent's system via kexec or reboot.
+
+        The image is booted with kexec if CONF.image_kexec is set and its
+        kernel is found, otherwise the system is rebooted.
+        """
+        if CONF.image_kexec:
+            self._kexec_image()
         LOG.info('Rebooting system')
         self._run_shutdown_command('reboot')
 
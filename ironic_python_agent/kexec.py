@@ -0,0 +1,297 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Booting a deployed OS with kexec instead of rebooting the machine.
+
+The kernel, initramfs and kernel command line of the deployed OS are found
+on its file systems, mounted read-only, in this order:
+
+* Boot Loader Specification entries in /boot/loader/entries,
+* the /vmlinuz and /initrd.img links of Debian based distributions,
+* the most recent /boot/vmlinuz-<version> kernel and its initramfs.
+
+The command line comes from the boot entry, /etc/kernel/cmdline or the GRUB
+configuration, and defaults to mounting the root file system read-only.
+Command lines using GRUB variables are ignored, they cannot be expanded.
+"""
+
+import fcntl
+import glob
+import os
+import re
+import shutil
+import tempfile
+
+from ironic_lib import disk_utils
+from oslo_concurrency import processutils
+from oslo_log import log
+
+from ironic_python_agent import utils
+
+LOG = log.getLogger(__name__)
+
+BLKFLSBUF = 0x1261
+
+# Symbolic links followed when resolving a path of the deployed OS.
+MAX_LINKS = 8
+
+_GRUB_CONFIGS = ('boot/grub2/grub.cfg', 'boot/grub/grub.cfg', 'grub2/grub.cfg',
+                 'grub/grub.cfg')
+_GRUB_LINUX = re.compile(r'^\s*linux(?:16|efi)?\s+(\S+)\s*(.*)$',
+                         re.MULTILINE)
+_INITRD_NAMES = ('initramfs-{}.img', 'initrd.img-{}', 'initrd-{}')
+
+
+def _resolve(root, path):
+    """Resolve a path of the OS mounted at root.
+
+    :param root: The mount point of the file system.
+    :param path: A path relative to root, absolute symbolic links being
+                 resolved relative to root too.
+    :returns: The full path of the file, None if it does not exist.
+    """
+    for _ in range(MAX_LINKS):
+        full_path = os.path.join(root, path.lstrip('/'))
+        if not os.path.islink(full_path):
+            return full_path if os.path.isfile(full_path) else None
+        target = os.readlink(full_path)
+        path = os.path.join(os.path.dirname(path), target)
+    return None
+
+
+def _boot_file(root, path):
+    """Resolve a path of a boot entry, on the root or a /boot file system.
+
+    :param root: The mount point of the file system.
+    :param path: The path from the boot entry.
+    :returns: The full path of the file, None if it does not exist.
+    """
+    return _resolve(root, path) or _resolve(root, 'boot/' + path.lstrip('/'))
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _usable(cmdline):
+    return cmdline if cmdline and '$' not in cmdline else None
+
+
+def _version_key(path):
+    """Sort key ordering paths by the versions they contain."""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def _bls_entry(root):
+    """Find the most recent Boot Loader Specification entry.
+
+    :param root: The mount point of the file system.
+    :returns: A (kernel, initrd, cmdline) tuple, None if there is none.
+    """
+    entries = (glob.glob(os.path.join(root, 'boot/loader/entries/*.conf'))
+               + glob.glob(os.path.join(root, 'loader/entries/*.conf')))
+    for path in sorted(entries, key=_version_key, reverse=True):
+        keys = {}
+        for line in _read(path).splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                keys.setdefault(fields[0], fields[1].strip())
+        kernel = keys.get('linux') and _boot_file(root, keys['linux'])
+        if kernel:
+            initrd = keys.get('initrd') and _boot_file(root, keys['initrd'])
+            return kernel, initrd or None, _usable(keys.get('options'))
+    return None
+
+
+def _linked_entry(root):
+    """Find the kernel and initramfs linked from / or /boot.
+
+    :param root: The mount point of the file system.
+    :returns: A (kernel, initrd, cmdline) tuple, None if there is none.
+    """
+    kernel = _boot_file(root, 'vmlinuz')
+    if kernel:
+        return kernel, _boot_file(root, 'initrd.img'), None
+    return None
+
+
+def _versioned_entry(root):
+    """Find the most recent versioned kernel and its initramfs.
+
+    :param root: The mount point of the file system.
+    :returns: A (kernel, initrd, cmdline) tuple, None if there is none.
+    """
+    kernels = [path for path in glob.glob(os.path.join(root, 'boot',
+                                                       'vmlinuz-*'))
+               + glob.glob(os.path.join(root, 'vmlinuz-*'))
+               if 'rescue' not in path and os.path.isfile(path)]
+    if not kernels:
+        return None
+    kernel = max(kernels, key=_version_key)
+    version = os.path.basename(kernel)[len('vmlinuz-'):]
+    initrds = [os.path.join(os.path.dirname(kernel), name.format(version))
+               for name in _INITRD_NAMES]
+    initrd = next((path for path in initrds if os.path.isfile(path)), None)
+    return kernel, initrd, None
+
+
+def _configured_cmdline(root, kernel):
+    """Find the kernel command line configured on a file system.
+
+    :param root: The mount point of the file system.
+    :param kernel: The full path of the kernel.
+    :returns: The command line, None if none is configured.
+    """
+    path = _resolve(root, 'etc/kernel/cmdline')
+    if path:
+        return _usable(_read(path).strip())
+    for config in _GRUB_CONFIGS:
+        path = _resolve(root, config)
+        if not path:
+            continue
+        for image, args in _GRUB_LINUX.findall(_read(path)):
+            if os.path.basename(image) == os.path.basename(kernel):
+                return _usable(args.strip())
+    return None
+
+
+def find_boot_entry(root):
+    """Find what to boot on the file system of a deployed OS.
+
+    :param root: The mount point of the file system.
+    :returns: None if there is no kernel on the file system, otherwise a
+              (kernel, initrd, cmdline) tuple of the full path of the
+              kernel, the full path of the initramfs or None, and the kernel
+              command line or None if it is unknown.
+    """
+    for finder in (_bls_entry, _linked_entry, _versioned_entry):
+        entry = finder(root)
+        if entry is not None:
+            kernel, initrd, cmdline = entry
+            return (kernel, initrd,
+                    cmdline or _configured_cmdline(root, kernel))
+    return None
+
+
+def rescan(device):
+    """Make the kernel re-read the partition table of a device.
+
+    :param device: The device name, e.g. '/dev/sda'.
+    """
+    try:
+        utils.execute('partx', '-u', device, attempts=3, delay_on_retry=True)
+        utils.execute('udevadm', 'settle')
+    except processutils.ProcessExecutionError:
+        LOG.warning("Couldn't re-read the partition table on device %s",
+                    device)
+
+
+def partitions_of(device):
+    """List the partitions of a device.
+
+    :param device: The device name, e.g. '/dev/sda'.
+    :returns: The device names of the partitions, by partition number.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    partitions = []
+    pattern = '/sys/class/block/{0}/{0}*/partition'.format(name)
+    for path in glob.glob(pattern):
+        number = int(_read(path).strip())
+        partitions.append((number, '/dev/' + os.path.basename(
+            os.path.dirname(path))))
+    return [partition for number, partition in sorted(partitions)]
+
+
+def _load_from(partition):
+    """Load the kernel of the OS deployed on a partition.
+
+    :param partition: The device name of the partition.
+    :raises: ProcessExecutionError if kexec fails to load the kernel.
+    :returns: True if the kernel is loaded, False if there is none.
+    """
+    mount_dir = tempfile.mkdtemp()
+    try:
+        try:
+            utils.execute('mount', '-o', 'ro', partition, mount_dir)
+        except processutils.ProcessExecutionError as e:
+            LOG.debug('Cannot mount %(part)s: %(err)s',
+                      {'part': partition, 'err': e})
+            return False
+        try:
+            entry = find_boot_entry(mount_dir)
+            if entry is None:
+                return False
+            kernel, initrd, cmdline = entry
+            if cmdline is None:
+                if not os.path.isdir(os.path.join(mount_dir, 'etc')):
+                    LOG.debug('No kernel command line on %s, which is not a '
+                              'root file system', partition)
+                    return False
+                cmdline = 'root=UUID={} ro'.format(
+                    disk_utils.block_uuid(partition))
+            LOG.info('Loading kernel %(kernel)s from %(part)s with initramfs '
+                     '%(initrd)s and command line "%(cmdline)s"',
+                     {'kernel': os.path.relpath(kernel, mount_dir),
+                      'part': partition,
+                      'initrd': initrd and os.path.relpath(initrd, mount_dir),
+                      'cmdline': cmdline})
+            args = ['kexec', '--load', kernel,
+                    '--command-line={}'.format(cmdline)]
+            if initrd:
+                args.append('--initrd={}'.format(initrd))
+            utils.execute(*args)
+            return True
+        finally:
+            utils.execute('umount', mount_dir)
+    finally:
+        shutil.rmtree(mount_dir, ignore_errors=True)
+
+
+def load(partitions):
+    """Load the kernel of the OS deployed on the first partition holding one.
+
+    :param partitions: The device names of the partitions to look at.
+    :raises: ProcessExecutionError if kexec fails to load a kernel.
+    :returns: True if a kernel is loaded, False if none is found.
+    """
+    for partition in partitions:
+        if _load_from(partition):
+            return True
+    return False
+
+
+def flush_device(device):
+    """Flush the data written to a device and its partitions.
+
+    Unlike sync, only the page cache of the device is written back, and the
+    device is asked to flush its own write cache.
+
+    :param device: The device name, e.g. '/dev/sda'.
+    :raises: EnvironmentError if a device cannot be flushed.
+    """
+    for path in [device] + partitions_of(device):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            fcntl.ioctl(fd, BLKFLSBUF)
+        finally:
+            os.close(fd)
+
+
+def execute():
+    """Boot the loaded kernel, returning only if it fails.
+
+    :raises: ProcessExecutionError if kexec fails.
+    """
+    utils.execute('kexec', '--exec')
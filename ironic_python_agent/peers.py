@@ -0,0 +1,229 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sharing of images between agents deploying them.
+
+Agents holding a verified image, or the leading chunks of an image they are
+writing, serve them to their peers through the agent API at
+``/v1/images/<image ID>/<chunk index>``. The chunks of an image are the
+blocks of its block-hash manifest (see block_manifest), which always comes
+from the image server, so every chunk received from a peer is checked
+against it before being used.
+
+Every answer for a shared image, including a 404, tells how many leading
+chunks of it the agent holds, so that downloading agents know which peers
+to ask. The chunks of an image are also assigned to the agents of a wave
+in turn, by the sorted URLs of their API: the agent a chunk is assigned to
+downloads it from the image server, and the other agents wait for it to be
+available there. However large the wave, every chunk is downloaded from
+the image server about once.
+"""
+
+import threading
+
+from oslo_log import log
+import requests
+
+from ironic_python_agent import netutils
+
+LOG = log.getLogger(__name__)
+
+# Seconds to wait for a peer to send a chunk.
+PEER_TIMEOUT = 10
+
+# The number of peers asked for a chunk before the image server.
+PEER_ATTEMPTS = 2
+
+# Seconds to wait for the agent a chunk is assigned to to hold it.
+PEER_WAIT_TIMEOUT = 60
+
+# Seconds to wait for an agent to start sharing the image at all.
+PEER_START_TIMEOUT = 10
+
+# Seconds between two requests for a chunk a peer does not hold yet, at
+# first and at most.
+PEER_POLL_INTERVAL = 0.01
+PEER_POLL_MAX_INTERVAL = 0.5
+
+# The header telling how many leading chunks of an image an agent holds.
+AVAILABLE_HEADER = 'X-Available-Chunks'
+
+
+class _SharedImage(object):
+
+    def __init__(self, manifest, path, available):
+        self.manifest = manifest
+        self.path = path
+        self.available = available
+
+
+class SharedImages(object):
+    """The images, or parts of images, an agent serves to its peers."""
+
+    def __init__(self):
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def share(self, image_id, manifest, path, available=None):
+        """Start serving the chunks of an image.
+
+        :param image_id: The ID of the image.
+        :param manifest: The block_manifest.Manifest of the image.
+        :param path: The file or device holding the image, from its start.
+        :param available: The number of leading chunks of the image which
+                          are already held, all of them if None.
+        """
+        if available is None:
+            available = manifest.block_count
+        with self._lock:
+            self._images[image_id] = _SharedImage(manifest, path, available)
+
+    def update(self, image_id, available):
+        """Update the number of leading chunks of an image which are held.
+
+        :param image_id: The ID of the image.
+        :param available: The number of leading chunks held.
+        """
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is not None:
+                image.available = max(image.available, available)
+
+    def unshare(self, image_id):
+        """Stop serving the chunks of an image.
+
+        :param image_id: The ID of the image.
+        """
+        with self._lock:
+            self._images.pop(image_id, None)
+
+    def available(self, image_id):
+        """Get the number of leading chunks of an image which are held.
+
+        :param image_id: The ID of the image.
+        :returns: The number of chunks, or None if the image is not shared.
+        """
+        with self._lock:
+            image = self._images.get(image_id)
+            return image.available if image is not None else None
+
+    def read_chunk(self, image_id, index):
+        """Read a chunk of an image to send to a peer.
+
+        :param image_id: The ID of the image.
+        :param index: The index of the chunk.
+        :returns: The data of the chunk, or None if it is not held.
+        """
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is None or not 0 <= index < image.available:
+                return None
+            offset, length = image.manifest.block_range(index)
+            path = image.path
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            LOG.warning('Chunk %(index)d of image %(image)s is truncated '
+                        'in %(path)s', {'index': index, 'image': image_id,
+                                        'path': path})
+            return None
+        return data
+
+
+def agent_url(hostname, port):
+    """Get the URL of the API of an agent, as given to its peers.
+
+    :param hostname: The address the agent advertises.
+    :param port: The port the agent advertises.
+    """
+    return 'http://{}:{}'.format(netutils.wrap_ipv6(hostname), port)
+
+
+class Peer(object):
+    """A peer agent chunks of an image are downloaded from.
+
+    Requests to a peer are made one at a time, the agent API serves them
+    one at a time anyway, so that a peer found unreachable is not asked
+    again by another thread.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        # The number of leading chunks of the image the peer held at its
+        # last answer.
+        self.available = 0
+        # Whether the peer answered a request, and that it shares the
+        # image.
+        self.answered = False
+        self.sharing = False
+        # Whether the peer was unreachable and is not used any more.
+        self.dropped = False
+        # Whether the peer did not get a chunk in time and is not waited
+        # for any more.
+        self.stalled = False
+        self.lock = threading.Lock()
+
+
+def chunk_url(peer, image_id, index):
+    """Get the URL of a chunk of an image on a peer.
+
+    :param peer: The base URL of the peer agent, e.g. http://10.0.0.5:9999
+    :param image_id: The ID of the image.
+    :param index: The index of the chunk.
+    """
+    return '{}/v1/images/{}/{}'.format(peer.rstrip('/'), image_id, index)
+
+
+def _update_available(peer, resp):
+    peer.answered = True
+    available = resp.headers.get(AVAILABLE_HEADER)
+    if available is None:
+        return
+    try:
+        available = int(available)
+    except ValueError:
+        return
+    peer.sharing = True
+    peer.available = available
+
+
+def fetch_chunk(peer, image_id, index, manifest):
+    """Download a chunk of an image from a peer.
+
+    The number of leading chunks the peer holds is updated from its answer.
+    Not thread safe, the lock of the peer must be held.
+
+    :param peer: The Peer to download from.
+    :param image_id: The ID of the image.
+    :param index: The index of the chunk.
+    :param manifest: The block_manifest.Manifest of the image, the chunk
+                     is checked against it.
+    :raises: requests.exceptions.RequestException if the peer cannot be
+             reached.
+    :returns: The data of the chunk, or None if the peer does not have it.
+    """
+    resp = requests.get(chunk_url(peer.url, image_id, index),
+                        timeout=PEER_TIMEOUT)
+    try:
+        _update_available(peer, resp)
+        if resp.status_code != 200:
+            return None
+        data = resp.content
+    finally:
+        resp.close()
+    if not manifest.matches(index, data):
+        LOG.warning('Chunk %(index)d of image %(image)s received from peer '
+                    '%(peer)s does not match the block manifest',
+                    {'index': index, 'image': image_id, 'peer': peer.url})
+        return None
+    return data
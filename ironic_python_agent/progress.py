@@ -0,0 +1,121 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Live progress of long-running agent commands.
+
+The agent runs one command at a time. While a command tracking its progress
+runs, its Progress object is returned by current() in the thread running
+the command, so that the code doing the work can update it wherever it
+runs, while work done in the background, such as image prefetches, does
+not. The byte counters are each updated by a single thread without
+locking, snapshot() reads them all at once and derives the throughput and
+the remaining time from them.
+"""
+
+import collections
+import threading
+import time
+
+# Seconds of history the current throughput is computed over.
+RATE_WINDOW = 5.0
+
+_local = threading.local()
+
+
+class Progress(object):
+    """The progress of a command downloading and writing an image."""
+
+    def __init__(self):
+        self.stage = None
+        self.total_bytes = None
+        self.downloaded_bytes = 0
+        self.written_bytes = 0
+        self._started = time.time()
+        self._download_started = self._started
+        # (time, downloaded bytes) samples taken by snapshot().
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+
+    def start_download(self, total_bytes):
+        """Start counting the bytes of a new download.
+
+        :param total_bytes: The size of the download, None if unknown.
+        """
+        with self._lock:
+            self.total_bytes = total_bytes
+            self.downloaded_bytes = 0
+            self.written_bytes = 0
+            self._download_started = time.time()
+            self._samples.clear()
+
+    def snapshot(self):
+        """Get the current progress.
+
+        :returns: A dictionary with the active stage, the byte counters, the
+                  current and average download throughput in bytes per
+                  second and the estimated number of seconds left, the
+                  values which cannot be computed yet being None.
+        """
+        now = time.time()
+        with self._lock:
+            downloaded = self.downloaded_bytes
+            total = self.total_bytes
+            self._samples.append((now, downloaded))
+            while (len(self._samples) > 2
+                   and now - self._samples[1][0] >= RATE_WINDOW):
+                self._samples.popleft()
+            first_time, first_bytes = self._samples[0]
+            download_time = now - self._download_started
+
+        current = average = eta = None
+        if now > first_time:
+            current = int((downloaded - first_bytes) / (now - first_time))
+        if download_time > 0:
+            average = int(downloaded / download_time)
+        if total is not None and current:
+            eta = round(max(0, total - downloaded) / float(current), 1)
+        return {
+            'stage': self.stage,
+            'elapsed_seconds': round(now - self._started, 1),
+            'total_bytes': total,
+            'downloaded_bytes': downloaded,
+            'written_bytes': self.written_bytes,
+            'bytes_per_second': current,
+            'average_bytes_per_second': average,
+            'eta_seconds': eta,
+        }
+
+
+def current():
+    """Get the progress of the command run by this thread, if it tracks it.
+
+    :returns: A Progress object, or None.
+    """
+    return getattr(_local, 'progress', None)
+
+
+def set_current(progress):
+    """Set the progress of the command run by this thread.
+
+    :param progress: A Progress object, or None once the command is done.
+    """
+    _local.progress = progress
+
+
+def set_stage(stage):
+    """Set the active stage of the command being run, if it tracks it.
+
+    :param stage: A short name of the stage, e.g. 'download'.
+    """
+    progress = current()
+    if progress is not None:
+        progress.stage = stage
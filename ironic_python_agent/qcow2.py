@@ -0,0 +1,206 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsing of qcow2 image metadata.
+
+Only what is needed to convert an image to raw while it is being streamed
+is supported: the header, the L1 and L2 tables and the location of the
+guest data. Images with backing files, encryption, external data files or
+extended L2 entries are rejected.
+
+See https://git.qemu.org/?p=qemu.git;a=blob;f=docs/interop/qcow2.txt
+"""
+
+import collections
+import struct
+import zlib
+
+from ironic_python_agent import errors
+
+MAGIC = b'QFI\xfb'
+# Large enough for both the version 2 and version 3 header fields used here.
+HEADER_SIZE = 104
+
+_HEADER_V2 = struct.Struct('>4sIQIIQIIQQIIQ')
+_HEADER_V3 = struct.Struct('>QQQII')
+
+_OFFSET_MASK = 0x00fffffffffffe00
+_L2_COMPRESSED = 1 << 62
+_L2_ZERO = 1
+
+_INCOMPAT_DATA_FILE = 1 << 2
+_INCOMPAT_COMPRESSION_TYPE = 1 << 3
+_INCOMPAT_EXTENDED_L2 = 1 << 4
+_INCOMPAT_UNSUPPORTED = (_INCOMPAT_DATA_FILE | _INCOMPAT_COMPRESSION_TYPE
+                         | _INCOMPAT_EXTENDED_L2)
+
+DATA = 'data'
+COMPRESSED = 'compressed'
+
+Cluster = collections.namedtuple(
+    'Cluster', ['guest_offset', 'guest_length', 'host_offset', 'host_length',
+                'kind'])
+"""A cluster of guest data stored in the image.
+
+:param guest_offset: Offset of the cluster on the virtual disk.
+:param guest_length: Number of bytes of the cluster within the virtual disk.
+:param host_offset: Offset of the cluster data in the image file.
+:param host_length: Number of bytes to read from the image file. For
+                    compressed clusters this may extend past the data.
+:param kind: Either DATA or COMPRESSED.
+"""
+
+
+def is_qcow2(data):
+    """Check whether the start of an image is a qcow2 header.
+
+    :param data: The first bytes of the image.
+    :returns: True if the image is a qcow2 image.
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def virtual_size(data):
+    """Get the virtual size of a qcow2 image from its header.
+
+    Unlike Header, this does not check whether the image is supported.
+
+    :param data: At least the first HEADER_SIZE bytes of the image.
+    :returns: The virtual size in bytes, None if the data does not start
+              with a qcow2 header.
+    """
+    if len(data) < _HEADER_V2.size or not is_qcow2(data):
+        return None
+    return _HEADER_V2.unpack_from(data)[5]
+
+
+class Header(object):
+    """The header of a qcow2 image."""
+
+    def __init__(self, data):
+        """Parse a qcow2 header.
+
+        :param data: At least the first HEADER_SIZE bytes of the image, or
+                     the whole image if it is smaller.
+        :raises: ImageFormatError if the header is not a supported qcow2
+                 header.
+        """
+        if len(data) < _HEADER_V2.size or not is_qcow2(data):
+            raise errors.ImageFormatError('Not a qcow2 image')
+
+        (_magic, self.version, backing_file_offset, _backing_file_size,
+         self.cluster_bits, self.virtual_size, crypt_method, self.l1_size,
+         self.l1_table_offset, _refcount_table_offset,
+         _refcount_table_clusters, _nb_snapshots,
+         _snapshots_offset) = _HEADER_V2.unpack_from(data)
+
+        incompatible_features = 0
+        if self.version == 3:
+            if len(data) < _HEADER_V2.size + _HEADER_V3.size:
+                raise errors.ImageFormatError('Truncated qcow2 header')
+            incompatible_features = _HEADER_V3.unpack_from(
+                data, _HEADER_V2.size)[0]
+        elif self.version != 2:
+            raise errors.ImageFormatError(
+                'Unsupported qcow2 version {}'.format(self.version))
+
+        if not 9 <= self.cluster_bits <= 21:
+            raise errors.ImageFormatError(
+                'Invalid qcow2 cluster bits {}'.format(self.cluster_bits))
+        if backing_file_offset:
+            raise errors.ImageFormatError(
+                'qcow2 images with a backing file are not supported')
+        if crypt_method:
+            raise errors.ImageFormatError(
+                'Encrypted qcow2 images are not supported')
+        if incompatible_features & _INCOMPAT_UNSUPPORTED:
+            raise errors.ImageFormatError(
+                'Unsupported qcow2 incompatible features {:#x}'.format(
+                    incompatible_features & _INCOMPAT_UNSUPPORTED))
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+
+    @property
+    def l1_table_length(self):
+        """The size of the L1 table in bytes."""
+        return self.l1_size * 8
+
+    def parse_l1_table(self, data):
+        """Parse the L1 table of the image.
+
+        :param data: The l1_table_length bytes of the L1 table.
+        :raises: ImageFormatError if the table is truncated.
+        :returns: A list with the offset of each L2 table in the image, 0 for
+                  L2 tables which are not allocated.
+        """
+        if len(data) < self.l1_table_length:
+            raise errors.ImageFormatError('Truncated qcow2 L1 table')
+        entries = struct.unpack_from('>{}Q'.format(self.l1_size), data)
+        return [entry & _OFFSET_MASK for entry in entries]
+
+    def parse_l2_table(self, data, l1_index):
+        """Parse an L2 table of the image.
+
+        Unallocated and zero clusters are not returned, they read as zeros.
+
+        :param data: The cluster_size bytes of the L2 table.
+        :param l1_index: The index of the table in the L1 table.
+        :raises: ImageFormatError if the table is truncated.
+        :returns: A list of Cluster tuples for the clusters holding data.
+        """
+        if len(data) < self.cluster_size:
+            raise errors.ImageFormatError('Truncated qcow2 L2 table')
+        entries = struct.unpack_from('>{}Q'.format(self.l2_entries), data)
+        first = l1_index * self.l2_entries
+        # Compressed cluster descriptors, see "Compressed Clusters
+        # Descriptor" in the specification.
+        csize_shift = 62 - (self.cluster_bits - 8)
+        csize_mask = (1 << (self.cluster_bits - 8)) - 1
+
+        clusters = []
+        for index, entry in enumerate(entries):
+            guest_offset = (first + index) * self.cluster_size
+            if guest_offset >= self.virtual_size:
+                break
+            guest_length = min(self.cluster_size,
+                               self.virtual_size - guest_offset)
+            if entry & _L2_COMPRESSED:
+                host_offset = entry & ((1 << csize_shift) - 1)
+                sectors = ((entry >> csize_shift) & csize_mask) + 1
+                host_length = sectors * 512 - (host_offset & 511)
+                clusters.append(Cluster(guest_offset, guest_length,
+                                        host_offset, host_length,
+                                        COMPRESSED))
+            elif entry & _OFFSET_MASK and not entry & _L2_ZERO:
+                clusters.append(Cluster(guest_offset, guest_length,
+                                        entry & _OFFSET_MASK, guest_length,
+                                        DATA))
+        return clusters
+
+    def decompress(self, data):
+        """Decompress the data of a compressed cluster.
+
+        :param data: The compressed data, possibly followed by unrelated
+                     bytes.
+        :raises: ImageFormatError if the data cannot be decompressed.
+        :returns: The cluster_size bytes of the cluster.
+        """
+        try:
+            cluster = zlib.decompressobj(-12).decompress(data,
+                                                         self.cluster_size)
+        except zlib.error as e:
+            raise errors.ImageFormatError(
+                'Invalid compressed qcow2 cluster: {}'.format(e))
+        if len(cluster) != self.cluster_size:
+            raise errors.ImageFormatError('Truncated compressed qcow2 cluster')
+        return cluster
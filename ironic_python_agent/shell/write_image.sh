@@ -22,13 +22,19 @@ log() {
 
 usage() {
     [[ -z "$1" ]] || echo -e "USAGE ERROR: $@\n"
-    echo "`basename $0`: IMAGEFILE DEVICE"
+    echo "`basename $0`: IMAGEFILE DEVICE [CACHE_MODE [COROUTINES [OUT_OF_ORDER]]]"
     echo "  - This script images DEVICE with IMAGEFILE"
+    echo "  - CACHE_MODE is the qemu-img cache mode, directsync by default"
+    echo "  - COROUTINES is the number of concurrent qemu-img writes"
+    echo "  - OUT_OF_ORDER allows qemu-img to write out of order if true"
     exit 1
 }
 
 IMAGEFILE="$1"
 DEVICE="$2"
+CACHE_MODE="${3:-directsync}"
+COROUTINES="$4"
+OUT_OF_ORDER="$5"
 
 [[ -f $IMAGEFILE ]] || usage "$IMAGEFILE (IMAGEFILE) is not a file"
 [[ -b $DEVICE ]] || usage "$DEVICE (DEVICE) is not a block device"
@@ -38,11 +44,16 @@ DEVICE="$2"
 log "Erasing existing GPT and MBR data structures from ${DEVICE}"
 sgdisk -Z $DEVICE || sgdisk -o $DEVICE
 
-log "Imaging $IMAGEFILE to $DEVICE"
+CONVERT_OPTS=(-t "$CACHE_MODE")
+[[ -z "$COROUTINES" ]] || CONVERT_OPTS+=(-m "$COROUTINES")
+[[ "$OUT_OF_ORDER" != "true" ]] || CONVERT_OPTS+=(-W)
+
+log "Imaging $IMAGEFILE to $DEVICE with options ${CONVERT_OPTS[*]}"
 
 # limit the memory usage for qemu-img to 1 GiB
 ulimit -v 1048576
-qemu-img convert -t directsync -O host_device $IMAGEFILE $DEVICE
+qemu-img convert "${CONVERT_OPTS[@]}" -O host_device $IMAGEFILE $DEVICE
+# Single flush of whatever the cache mode left in the page cache
 sync
 
 log "${DEVICE} imaged successfully!"
@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Moving data between file descriptors without copying it to user space.
+
+splice(2) moves data between a pipe and another file descriptor, such as a
+socket or a block device, and tee(2) duplicates the data held by a pipe
+into another pipe without consuming it. Both are Linux specific. There is
+no binding of tee in the os module, and os.splice only exists from Python
+3.10, so both are called from the C library with ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+# From linux/fcntl.h: F_LINUX_SPECIFIC_BASE + 7
+F_SETPIPE_SZ = 1031
+
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _splice = _LIBC.splice
+    _tee = _LIBC.tee
+except (OSError, AttributeError):
+    _splice = _tee = None
+else:
+    _splice.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+    _splice.restype = ctypes.c_ssize_t
+    _tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t,
+                     ctypes.c_uint)
+    _tee.restype = ctypes.c_ssize_t
+
+
+def available():
+    """Whether splice and tee can be called on this system."""
+    return _splice is not None and _tee is not None
+
+
+def _call(func, *args):
+    while True:
+        result = func(*args)
+        if result >= 0:
+            return result
+        error = ctypes.get_errno()
+        if error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+
+
+def splice(fd_in, fd_out, count, offset_out=None, flags=SPLICE_F_MOVE):
+    """Move data from one file descriptor to another, one being a pipe.
+
+    :param fd_in: The file descriptor to read from.
+    :param fd_out: The file descriptor to write to.
+    :param count: The maximum number of bytes to move.
+    :param offset_out: The offset to write at in fd_out, which must not be
+                       a pipe, or None to write at its current position.
+    :param flags: SPLICE_F_* flags.
+    :raises: OSError if the data cannot be moved.
+    :returns: The number of bytes moved, 0 at the end of fd_in.
+    """
+    offset = None
+    if offset_out is not None:
+        offset = ctypes.byref(ctypes.c_longlong(offset_out))
+    return _call(_splice, fd_in, None, fd_out, offset, count, flags)
+
+
+def tee(fd_in, fd_out, count):
+    """Duplicate data from a pipe into another pipe without consuming it.
+
+    :param fd_in: The read end of the pipe holding the data.
+    :param fd_out: The write end of the pipe to copy the data to.
+    :param count: The maximum number of bytes to duplicate.
+    :raises: OSError if the data cannot be duplicated.
+    :returns: The number of bytes duplicated, from the start of the data
+              held by fd_in.
+    """
+    return _call(_tee, fd_in, fd_out, count, 0)
+
+
+def pipe(size):
+    """Create a pipe, growing it to hold size bytes if allowed.
+
+    :param size: The wanted capacity of the pipe in bytes.
+    :returns: A tuple of the read and write file descriptors of the pipe.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        # Limited by /proc/sys/fs/pipe-max-size, the default capacity is
+        # only less efficient.
+        pass
+    return read_fd, write_fd
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 import mock
 from stevedore import extension
 
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
+from ironic_python_agent import progress
 from ironic_python_agent.tests.unit import base as test_base
 
 
@@ -170,6 +173,40 @@ class TestExtensionDecorators(test_base.IronicAgentTest):
         self.assertIsNone(result.command_result)
         self.agent.force_heartbeat.assert_called_once_with()
 
+    def test_async_command_progress(self):
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def execute_method():
+            progress.set_stage('download')
+            progress.current().start_download(100)
+            progress.current().downloaded_bytes = 42
+            started.set()
+            proceed.wait()
+            return 'done'
+
+        result = base.AsyncCommandResult('fake_async_command', {},
+                                         execute_method,
+                                         track_progress=True).start()
+        started.wait()
+        snapshot = result.serialize()['command_result']['progress']
+        self.assertIsNone(result.command_result)
+        self.assertEqual('download', snapshot['stage'])
+        self.assertEqual(100, snapshot['total_bytes'])
+        self.assertEqual(42, snapshot['downloaded_bytes'])
+        proceed.set()
+        result.join()
+
+        self.assertEqual({'result': 'fake_async_command: done'},
+                         result.serialize()['command_result'])
+        self.assertIsNone(progress.current())
+
+    def test_async_command_no_progress(self):
+        result = self.extension.execute('fake_async_command', param='v1')
+        self.assertIsNone(result.progress)
+        result.join()
+        self.assertIsNone(progress.current())
+
     def test_async_command_name(self):
         self.assertEqual(
             'other_async_name',
@@ -12,15 +12,49 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import hashlib
+import io
 import os
-
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+from ironic_lib import exception
 import mock
 from oslo_concurrency import processutils
+import psutil
+import requests
+import six
 
+from ironic_python_agent import block_manifest
+from ironic_python_agent import chunk_store
+from ironic_python_agent import config_drive
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import standby
 from ironic_python_agent import hardware
+from ironic_python_agent import kexec
+from ironic_python_agent import peers
+from ironic_python_agent import progress
+from ironic_python_agent import qcow2
+from ironic_python_agent import splice
 from ironic_python_agent.tests.unit import base
+from ironic_python_agent.tests.unit import test_block_manifest
+from ironic_python_agent.tests.unit import test_qcow2
+
+
+def _block_devices():
+    return [
+        hardware.BlockDevice(name='/dev/sda', model='TinyUSB Drive',
+                             size=3116853504, rotational=False,
+                             serial='serial0'),
+        hardware.BlockDevice(name='/dev/sdb', model='Another Model',
+                             size=10737418240, rotational=True,
+                             serial='serial1'),
+    ]
 
 
 def _build_fake_image_info():
@@ -55,6 +89,27 @@ def _build_fake_partition_image_info():
         'deploy_boot_mode': 'bios'}
 
 
+def _fake_ranged_get(content, accept_ranges='bytes', truncate_at=None):
+    """Build a fake requests.get serving content with range support."""
+    def fake_get(url, headers=None, **kwargs):
+        response = mock.Mock()
+        if headers is None:
+            response.status_code = 200
+            response.headers = {'Accept-Ranges': accept_ranges,
+                                'Content-Length': str(len(content))}
+            response.iter_content.return_value = [content]
+            return response
+        start, end = headers['Range'][len('bytes='):].split('-')
+        start, end = int(start), int(end)
+        response.status_code = 206
+        if truncate_at is not None and start >= truncate_at:
+            response.iter_content.return_value = []
+        else:
+            response.iter_content.return_value = [content[start:end + 1]]
+        return response
+    return fake_get
+
+
 class TestStandbyExtension(base.IronicAgentTest):
     def setUp(self):
         super(TestStandbyExtension, self).setUp()
@@ -119,18 +174,29 @@ class TestStandbyExtension(base.IronicAgentTest):
         location = standby._image_location(image_info)
         self.assertEqual('/tmp/fake_id', location)
 
+    @mock.patch.object(os.path, 'getsize', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_image(self, execute_mock, open_mock):
+    def test_write_image(self, execute_mock, open_mock, dispatch_mock,
+                         getsize_mock):
         image_info = _build_fake_image_info()
         device = '/dev/sda'
         location = standby._image_location(image_info)
         script = standby._path_to_script('shell/write_image.sh')
-        command = ['/bin/bash', script, location, device]
+        command = ['/bin/bash', script, location, device, 'writeback', '1',
+                   'false']
         execute_mock.return_value = ('', '')
+        dispatch_mock.return_value = [
+            hardware.BlockDevice('/dev/sda', 'disk', 1024, True)]
+        getsize_mock.return_value = 1024
+        stats = {}
 
-        standby._write_image(image_info, device)
+        standby._write_image(image_info, device, stats=stats)
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
+        dispatch_mock.assert_called_once_with('list_block_devices')
+        self.assertEqual('rotational', stats['write']['strategy'])
+        self.assertEqual(1024, stats['write']['bytes'])
 
         execute_mock.reset_mock()
         execute_mock.return_value = ('', '')
@@ -143,6 +209,44 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
 
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_write_strategy(self, dispatch_mock):
+        dispatch_mock.return_value = [
+            hardware.BlockDevice('/dev/sda', 'disk', 1024, True),
+            hardware.BlockDevice('/dev/sdb', 'ssd', 1024, False),
+            hardware.BlockDevice('/dev/nvme0n1', 'nvme', 1024, False)]
+        self.assertEqual('rotational', standby._write_strategy('/dev/sda'))
+        self.assertEqual('ssd', standby._write_strategy('/dev/sdb'))
+        self.assertEqual('nvme', standby._write_strategy('/dev/nvme0n1'))
+        # Devices which are not listed keep the safest strategy.
+        self.assertEqual('directsync', standby._write_strategy('/dev/sdc'))
+
+        dispatch_mock.side_effect = processutils.ProcessExecutionError()
+        self.assertEqual('directsync', standby._write_strategy('/dev/sda'))
+
+        dispatch_mock.reset_mock()
+        self.config(image_write_strategy='nvme')
+        self.assertEqual('nvme', standby._write_strategy('/dev/sda'))
+        self.assertFalse(dispatch_mock.called)
+
+    @mock.patch.object(os.path, 'getsize', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_whole_disk_image_directsync(self, execute_mock,
+                                               getsize_mock):
+        self.config(image_write_strategy='directsync')
+        execute_mock.return_value = ('', '')
+        getsize_mock.return_value = 1024
+        stats = standby._write_whole_disk_image('/tmp/image', {},
+                                                '/dev/sda')
+        # The command of previous releases, with no coroutines option.
+        execute_mock.assert_called_once_with(
+            '/bin/bash', standby._path_to_script('shell/write_image.sh'),
+            '/tmp/image', '/dev/sda', 'directsync', '', 'false',
+            check_exit_code=[0])
+        self.assertEqual('directsync', stats['strategy'])
+        self.assertIsNone(stats['coroutines'])
+        self.assertFalse(stats['out_of_order'])
+
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
@@ -308,6 +412,84 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         self.assertEqual(expected_uuid, work_on_disk_mock.return_value)
 
+    @mock.patch.object(standby, '_write_configdrive', autospec=True)
+    @mock.patch('ironic_lib.utils.mkfs', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.is_block_device', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.make_partitions', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.destroy_disk_metadata', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_make_partitions(self, dispatch_mock, destroy_mock,
+                             make_mock, block_mock, mkfs_mock,
+                             configdrive_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['preserve_ephemeral'] = False
+        image_info['deploy_boot_mode'] = 'uefi'
+        image_info['boot_option'] = 'local'
+        dispatch_mock.return_value = self.fake_cpu
+        partitions = {'root': '/dev/sda1', 'swap': '/dev/sda2',
+                      'ephemeral': '/dev/sda3', 'configdrive': '/dev/sda4',
+                      'efi system partition': '/dev/sda5'}
+        make_mock.return_value = partitions
+        block_mock.return_value = True
+
+        self.assertEqual(partitions,
+                         standby._make_partitions(image_info, '/dev/sda'))
+
+        destroy_mock.assert_called_once_with('/dev/sda', 'node_uuid')
+        make_mock.assert_called_once_with(
+            '/dev/sda', '10', '10', '10', 64, 'node_uuid', commit=True,
+            boot_option='local', boot_mode='uefi', disk_label='msdos',
+            cpu_arch=self.fake_cpu.architecture)
+        configdrive_mock.assert_called_once_with(
+            image_info, '/dev/sda', 'configdrive', partition='/dev/sda4')
+        mkfs_mock.assert_has_calls([
+            mock.call(fs='vfat', path='/dev/sda5', label='efi-part'),
+            mock.call(fs='swap', path='/dev/sda2', label='swap1'),
+            mock.call(fs='abc', path='/dev/sda3', label='ephemeral0')])
+
+    @mock.patch.object(standby, '_write_configdrive', autospec=True)
+    @mock.patch('ironic_lib.utils.mkfs', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.is_block_device', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.make_partitions', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.destroy_disk_metadata', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_make_partitions_preserve_ephemeral(self, dispatch_mock,
+                                                destroy_mock, make_mock,
+                                                block_mock, mkfs_mock,
+                                                configdrive_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['preserve_ephemeral'] = True
+        del image_info['configdrive']
+        dispatch_mock.return_value = self.fake_cpu
+        make_mock.return_value = {'root': '/dev/sda1',
+                                  'ephemeral': '/dev/sda2'}
+        block_mock.return_value = True
+
+        standby._make_partitions(image_info, '/dev/sda')
+
+        self.assertFalse(destroy_mock.called)
+        make_mock.assert_called_once_with(
+            '/dev/sda', '10', '10', '10', 0, 'node_uuid', commit=False,
+            boot_option='netboot', boot_mode='bios', disk_label='msdos',
+            cpu_arch=self.fake_cpu.architecture)
+        self.assertFalse(configdrive_mock.called)
+        self.assertFalse(mkfs_mock.called)
+
+    @mock.patch('ironic_lib.disk_utils.is_block_device', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.make_partitions', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.destroy_disk_metadata', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    def test_make_partitions_missing(self, dispatch_mock, destroy_mock,
+                                     make_mock, block_mock):
+        dispatch_mock.return_value = self.fake_cpu
+        make_mock.return_value = {'root': '/dev/sda1'}
+        block_mock.return_value = False
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               "'root' device '/dev/sda1' not found",
+                               standby._make_partitions,
+                               _build_fake_partition_image_info(),
+                               '/dev/sda')
+
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
     @mock.patch('requests.get', autospec=True)
@@ -379,6 +561,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
+        response.headers = {}
         hexdigest_mock = md5_mock.return_value.hexdigest
         hexdigest_mock.return_value = 'invalid-checksum'
         self.assertRaises(errors.ImageChecksumError,
@@ -391,6 +574,31 @@ class TestStandbyExtension(base.IronicAgentTest):
         checksum = image_info['checksum']
         standby._verify_image(image_info, image_location, checksum)
 
+    def test_verify_image_multihash(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'fake-sha512'
+        checksums = {'md5': image_info['checksum'], 'sha512': 'fake-sha512'}
+        standby._verify_image(image_info, '/foo/bar', checksums)
+
+        checksums['sha512'] = 'invalid-checksum'
+        self.assertRaisesRegex(errors.ImageChecksumError, 'invalid-checksum',
+                               standby._verify_image, image_info, '/foo/bar',
+                               checksums)
+
+    def test_validate_image_info_os_hash(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'fake-sha256'
+        standby._validate_image_info(None, image_info)
+        image_info['os_hash_value'] = ''
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['os_hash_algo'] = 'crc32'
+        image_info['os_hash_value'] = 'fake-crc32'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+
     def test_verify_image_failure(self):
         image_info = _build_fake_image_info()
         image_location = '/foo/bar'
@@ -415,11 +623,13 @@ class TestStandbyExtension(base.IronicAgentTest):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
+        self.assertEqual('manager', self.agent_extension.image_device)
         self.assertEqual('SUCCEEDED', async_result.command_status)
         self.assertIn('result', async_result.command_result)
         cmd_result = ('cache_image: image ({}) cached to device {} '
@@ -441,8 +651,9 @@ class TestStandbyExtension(base.IronicAgentTest):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -472,8 +683,9 @@ class TestStandbyExtension(base.IronicAgentTest):
             image_info=image_info, force=True
         )
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -513,7 +725,142 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
-    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+    @mock.patch('ironic_python_agent.extensions.standby._write_configdrive',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_prepare_image_target_devices(self, download_mock, write_mock,
+                                          dispatch_mock,
+                                          configdrive_copy_mock):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', {'serial': 'serial1'}]
+        download_mock.return_value = None
+        write_mock.return_value = None
+        dispatch_mock.return_value = _block_devices()
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive='configdrive_data'
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        dispatch_mock.assert_called_once_with('list_block_devices')
+        # The image is downloaded once and written to every device.
+        download_mock.assert_called_once_with(image_info, '/dev/sda')
+        write_mock.assert_has_calls([
+            mock.call(image_info, '/dev/sda', stats=mock.ANY),
+            mock.call(image_info, '/dev/sdb', stats=mock.ANY)])
+        configdrive_copy_mock.assert_called_once_with(
+            image_info, '/dev/sda', 'configdrive_data',
+            extra_devices=['/dev/sdb'])
+        cmd_result = ('prepare_image: image ({}) written to device {} '
+                      'root_uuid=ROOT').format(image_info['id'], '/dev/sda')
+        self.assertEqual(cmd_result, async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_target_devices_stream(self, stream_mock,
+                                                 dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                            '/dev/sda', ['/dev/sdb'])
+        self.assertFalse(dispatch_mock.called)
+
+    @mock.patch('ironic_lib.disk_utils.block_uuid', autospec=True)
+    @mock.patch.object(standby, '_make_partitions', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_partition_stream(self, stream_mock, dispatch_mock,
+                                            make_mock, uuid_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        dispatch_mock.return_value = '/dev/sda'
+        partitions = {'root': '/dev/sda1', 'swap': '/dev/sda2'}
+        make_mock.return_value = partitions
+        uuid_mock.return_value = 'ROOT'
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        make_mock.assert_called_once_with(image_info, '/dev/sda')
+        # The image goes straight into the root partition.
+        stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                            '/dev/sda1')
+        uuid_mock.assert_called_once_with('/dev/sda1')
+        self.assertEqual({'root uuid': 'ROOT',
+                          'efi system partition uuid': None,
+                          'partitions': partitions},
+                         self.agent_extension.partition_uuids)
+        cmd_result = ('prepare_image: image ({}) written to device {} '
+                      'root_uuid=ROOT').format(image_info['id'], '/dev/sda')
+        self.assertEqual(cmd_result, async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_partition_image_onto_device', autospec=True)
+    def test_stream_image_onto_device_partition(self, stream_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        self.assertTrue(self.agent_extension._stream_image_onto_device(
+            image_info, '/dev/sda'))
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/sda')
+
+        image_info['disk_format'] = 'qcow2'
+        self.assertFalse(self.agent_extension._stream_image_onto_device(
+            image_info, '/dev/sda'))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_target_devices_duplicate(self, dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', {'serial': 'serial0'}]
+        dispatch_mock.return_value = _block_devices()
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'more than once', standby._target_devices,
+                               image_info)
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_target_devices_root_device_hints(self, dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = [{'serial': 'serial1'},
+                                        {'size': '>= 2'}, '/dev/sdc']
+        dispatch_mock.return_value = _block_devices()
+        self.assertEqual(['/dev/sdb', '/dev/sda', '/dev/sdc'],
+                         standby._target_devices(image_info))
+        # The hints are not passed to the hardware managers.
+        dispatch_mock.assert_called_once_with('list_block_devices')
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_target_devices_not_found(self, dispatch_mock):
+        image_info = _build_fake_image_info()
+        dispatch_mock.return_value = _block_devices()
+        for hints, error in (({'serial': 'missing'}, 'No suitable device'),
+                             ({'size': 'big'}, 'failed to validate')):
+            image_info['target_devices'] = [hints]
+            self.assertRaisesRegex(errors.DeviceNotFound, error,
+                                   standby._target_devices, image_info)
+
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.extensions.standby._write_configdrive',
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -538,12 +885,14 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
-        configdrive_copy_mock.assert_called_once_with(image_info['node_uuid'],
-                                                      'manager',
-                                                      'configdrive_data')
+        configdrive_copy_mock.assert_called_once_with(image_info, 'manager',
+                                                      'configdrive_data',
+                                                      extra_devices=[])
+        self.assertEqual('manager', self.agent_extension.image_device)
 
         self.assertEqual('SUCCEEDED', async_result.command_status)
         self.assertIn('result', async_result.command_result)
@@ -551,7 +900,98 @@ class TestStandbyExtension(base.IronicAgentTest):
                       'root_uuid=ROOT').format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
 
-    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+    @mock.patch.object(config_drive, 'write_partition', autospec=True)
+    def test_write_configdrive(self, write_mock):
+        image_info = _build_fake_image_info()
+        standby._write_configdrive(image_info, '/dev/sda', 'configdrive')
+        write_mock.assert_called_once_with(image_info['node_uuid'],
+                                           '/dev/sda', mock.ANY,
+                                           partition=None)
+        self.assertEqual(['configdrive'], list(write_mock.call_args[0][2]))
+
+    @mock.patch.object(config_drive, 'write_partition', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_write_configdrive_url(self, requests_mock, write_mock):
+        image_info = _build_fake_image_info()
+        image_info['proxies'] = {'http': 'http://proxy'}
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.headers = {}
+        requests_mock.return_value.iter_content.return_value = [b'a', b'b']
+        received = []
+        write_mock.side_effect = (
+            lambda node_uuid, device, chunks, partition: received.extend(
+                chunks))
+
+        standby._write_configdrive(image_info, '/dev/sda',
+                                   'http://server/configdrive')
+
+        self.assertEqual([b'a', b'b'], received)
+        requests_mock.assert_called_once_with(
+            'http://server/configdrive', cert=None, verify=True,
+            stream=True, proxies={'http': 'http://proxy'})
+
+    @mock.patch.object(config_drive, 'write_partition', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_write_configdrive_url_extra_devices(self, requests_mock,
+                                                 write_mock):
+        image_info = _build_fake_image_info()
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.headers = {'Content-Length': '2'}
+        requests_mock.return_value.iter_content.return_value = [b'a', b'b']
+        received = {}
+        write_mock.side_effect = (
+            lambda node_uuid, device, chunks, partition: received.update(
+                {device: (list(chunks), partition)}))
+        current = progress.Progress()
+        current.start_download(100)
+        current.downloaded_bytes = current.written_bytes = 40
+        progress.set_current(current)
+        self.addCleanup(progress.set_current, None)
+
+        standby._write_configdrive(image_info, '/dev/sda',
+                                   'http://server/configdrive',
+                                   partition='/dev/sda4',
+                                   extra_devices=['/dev/sdb'])
+
+        # Downloaded once, without counting it in the image progress.
+        requests_mock.assert_called_once_with(
+            'http://server/configdrive', cert=None, verify=True,
+            stream=True, proxies={})
+        self.assertEqual({'/dev/sda': ([b'a', b'b'], '/dev/sda4'),
+                          '/dev/sdb': ([b'a', b'b'], None)}, received)
+        self.assertEqual((100, 40, 40), (current.total_bytes,
+                                         current.downloaded_bytes,
+                                         current.written_bytes))
+
+    @mock.patch.object(config_drive, 'MAX_SIZE', 1)
+    @mock.patch.object(config_drive, 'write_partition', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_write_configdrive_url_extra_devices_too_large(
+            self, requests_mock, write_mock):
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.headers = {}
+        requests_mock.return_value.iter_content.return_value = [b'ab', b'c']
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               'exceeds maximum limit',
+                               standby._write_configdrive,
+                               _build_fake_image_info(), '/dev/sda',
+                               'http://server/configdrive',
+                               extra_devices=['/dev/sdb'])
+        self.assertFalse(write_mock.called)
+
+    @mock.patch.object(config_drive, 'write_partition', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_write_configdrive_url_error(self, requests_mock, write_mock):
+        requests_mock.return_value.status_code = 404
+        requests_mock.return_value.text = 'Not found'
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               'Can\'t download the configdrive content',
+                               standby._write_configdrive,
+                               _build_fake_image_info(), '/dev/sda',
+                               'http://server/configdrive')
+        self.assertFalse(write_mock.called)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_configdrive',
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -576,8 +1016,9 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertFalse(configdrive_copy_mock.called)
 
@@ -611,7 +1052,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
-    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+    @mock.patch('ironic_python_agent.extensions.standby._write_configdrive',
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -636,8 +1077,9 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           stats=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertEqual(0, configdrive_copy_mock.call_count)
@@ -649,7 +1091,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
-    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+    @mock.patch('ironic_python_agent.extensions.standby._write_configdrive',
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -675,13 +1117,143 @@ class TestStandbyExtension(base.IronicAgentTest):
         # Assert we've streamed the image or not
         if image_info['stream_raw_images']:
             stream_mock.assert_called_once_with(mock.ANY, image_info,
-                                                '/dev/foo')
+                                                '/dev/foo', [])
             self.assertFalse(cache_write_mock.called)
         else:
             cache_write_mock.assert_called_once_with(mock.ANY, image_info,
-                                                     '/dev/foo')
+                                                     '/dev/foo', [])
             self.assertFalse(stream_mock.called)
 
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_raw_stream_stats(self, stream_mock,
+                                            dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        dispatch_mock.return_value = '/dev/foo'
+        stats = {'bytes': 42}
+
+        def fake_stream(ext, image_info, device, extra_devices):
+            ext.image_stats = stats
+        stream_mock.side_effect = fake_stream
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        cmd_result = ('prepare_image: image ({}) written to device {} '
+                      'root_uuid=ROOT').format(image_info['id'], '/dev/foo')
+        self.assertEqual(cmd_result, async_result.command_result['result'])
+        self.assertEqual(stats, async_result.command_result['image_stats'])
+
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_qcow2_image_onto_device', autospec=True)
+    def test_prepare_image_qcow2_stream(self, stream_mock, cache_write_mock,
+                                        dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        dispatch_mock.return_value = '/dev/foo'
+
+        # Disabled by default
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        self.assertFalse(stream_mock.called)
+        cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                 '/dev/foo', [])
+
+        cache_write_mock.reset_mock()
+        image_info['stream_qcow2_images'] = True
+        stream_mock.return_value = True
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        self.assertFalse(cache_write_mock.called)
+
+        # Falls back to caching the image without range support
+        stream_mock.reset_mock()
+        stream_mock.return_value = False
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                 '/dev/foo', [])
+
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_compressed_stream(self, stream_mock,
+                                             cache_write_mock, dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'xz'
+        dispatch_mock.return_value = '/dev/foo'
+
+        # Compressed images are always streamed
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                            '/dev/foo', [])
+        self.assertFalse(cache_write_mock.called)
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch.object(standby, '_download_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_cache_image_compressed(self, stream_mock, download_mock,
+                                    dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['container_format'] = 'compressed'
+        dispatch_mock.return_value = '/dev/foo'
+
+        self.agent_extension.cache_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                            '/dev/foo', [])
+        self.assertFalse(download_mock.called)
+        self.assertEqual(image_info['id'],
+                         self.agent_extension.cached_image_id)
+
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._delta_write_image', autospec=True)
+    def test_prepare_image_delta_deploy(self, delta_mock, cache_write_mock,
+                                        dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['delta_deploy'] = True
+        dispatch_mock.return_value = '/dev/foo'
+
+        delta_mock.return_value = True
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        delta_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        self.assertFalse(cache_write_mock.called)
+
+        # Falls back to writing the whole image
+        delta_mock.reset_mock()
+        delta_mock.return_value = False
+        self.agent_extension.cached_image_id = None
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        delta_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                 '/dev/foo', [])
+
     def test_prepare_image_raw_stream_true(self):
         image_info = _build_fake_image_info()
         image_info['disk_format'] = 'raw'
@@ -763,6 +1335,103 @@ class TestStandbyExtension(base.IronicAgentTest):
         execute_mock.assert_any_call('sync')
         self.assertEqual('FAILED', failed_result.command_status)
 
+    @mock.patch.object(kexec, 'execute', autospec=True)
+    @mock.patch.object(kexec, 'flush_device', autospec=True)
+    @mock.patch.object(kexec, 'load', autospec=True)
+    @mock.patch.object(kexec, 'partitions_of', autospec=True)
+    @mock.patch.object(kexec, 'rescan', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_kexec_image(self, execute_mock, rescan_mock, partitions_mock,
+                         load_mock, flush_mock, kexec_mock):
+        self.config(image_kexec=True)
+        self.agent_extension.image_device = '/dev/sda'
+        self.agent_extension.partition_uuids = {}
+        partitions_mock.return_value = ['/dev/sda1', '/dev/sda2']
+        load_mock.return_value = True
+        # kexec never returns when it succeeds.
+        kexec_mock.side_effect = SystemExit
+
+        self.assertRaises(SystemExit, self.agent_extension._kexec_image)
+        rescan_mock.assert_called_once_with('/dev/sda')
+        load_mock.assert_called_once_with(['/dev/sda1', '/dev/sda2'])
+        flush_mock.assert_called_once_with('/dev/sda')
+        self.assertFalse(execute_mock.called)
+
+    @mock.patch.object(kexec, 'execute', autospec=True)
+    @mock.patch.object(kexec, 'flush_device', autospec=True)
+    @mock.patch.object(kexec, 'load', autospec=True)
+    @mock.patch.object(kexec, 'rescan', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_kexec_image_partition(self, execute_mock, rescan_mock,
+                                   load_mock, flush_mock, kexec_mock):
+        self.agent_extension.image_device = '/dev/sda'
+        self.agent_extension.partition_uuids = {
+            'root uuid': 'root_uuid',
+            'partitions': {'root': '/dev/sda2'}}
+        load_mock.return_value = True
+        kexec_mock.side_effect = SystemExit
+
+        self.assertRaises(SystemExit, self.agent_extension._kexec_image)
+        self.assertFalse(rescan_mock.called)
+        load_mock.assert_called_once_with(['/dev/sda2'])
+
+    @mock.patch.object(kexec, 'flush_device', autospec=True)
+    @mock.patch.object(kexec, 'load', autospec=True)
+    @mock.patch.object(kexec, 'partitions_of', autospec=True)
+    @mock.patch.object(kexec, 'rescan', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_image_kexec_no_kernel(self, execute_mock, rescan_mock,
+                                       partitions_mock, load_mock,
+                                       flush_mock):
+        self.config(image_kexec=True)
+        execute_mock.return_value = ('', '')
+        self.agent_extension.image_device = '/dev/sda'
+        load_mock.return_value = False
+
+        result = self.agent_extension.run_image()
+        result.join()
+        self.assertFalse(flush_mock.called)
+        execute_mock.assert_has_calls([
+            mock.call('sync'),
+            mock.call('reboot', use_standard_locale=True,
+                      check_exit_code=[0])])
+        self.assertEqual('SUCCEEDED', result.command_status)
+
+    @mock.patch.object(kexec, 'execute', autospec=True)
+    @mock.patch.object(kexec, 'flush_device', autospec=True)
+    @mock.patch.object(kexec, 'load', autospec=True)
+    @mock.patch.object(kexec, 'partitions_of', autospec=True)
+    @mock.patch.object(kexec, 'rescan', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_image_kexec_fails(self, execute_mock, rescan_mock,
+                                   partitions_mock, load_mock, flush_mock,
+                                   kexec_mock):
+        self.config(image_kexec=True)
+        execute_mock.return_value = ('', '')
+        self.agent_extension.image_device = '/dev/sda'
+        load_mock.return_value = True
+        kexec_mock.side_effect = processutils.ProcessExecutionError()
+
+        result = self.agent_extension.run_image()
+        result.join()
+        flush_mock.assert_called_once_with('/dev/sda')
+        execute_mock.assert_has_calls([
+            mock.call('sync'),
+            mock.call('reboot', use_standard_locale=True,
+                      check_exit_code=[0])])
+        self.assertEqual('SUCCEEDED', result.command_status)
+
+    @mock.patch.object(kexec, 'load', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_image_kexec_no_image(self, execute_mock, load_mock):
+        self.config(image_kexec=True)
+        execute_mock.return_value = ('', '')
+
+        self.agent_extension.run_image().join()
+        self.assertFalse(load_mock.called)
+        execute_mock.assert_any_call('reboot', use_standard_locale=True,
+                                     check_exit_code=[0])
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     def test_power_off(self, execute_mock):
         execute_mock.return_value = ('', '')
@@ -806,9 +1475,67 @@ class TestStandbyExtension(base.IronicAgentTest):
     def test_cache_and_write_image(self, download_mock, write_mock):
         image_info = _build_fake_image_info()
         device = '/dev/foo'
+
+        def fake_write(image_info, device, stats):
+            stats['write'] = {'strategy': 'ssd'}
+            return {}
+
+        write_mock.side_effect = fake_write
         self.agent_extension._cache_and_write_image(image_info, device)
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, device)
+        download_mock.assert_called_once_with(image_info, device)
+        write_mock.assert_called_once_with(image_info, device,
+                                           stats=mock.ANY)
+        # The write strategy is reported in the command result.
+        self.assertEqual({'write': {'strategy': 'ssd'}},
+                         self.agent_extension.image_stats)
+
+    @mock.patch.object(standby.StandbyExtension,
+                       '_stream_raw_image_onto_device',
+                       autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_no_space(self, download_mock, write_mock,
+                                            stream_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        download_mock.side_effect = errors.ImageStagingError(
+            image_info['id'], 'does not fit')
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        stream_mock.assert_called_once_with(self.agent_extension, image_info,
+                                            '/dev/foo', None)
+        self.assertFalse(write_mock.called)
+        self.assertEqual(image_info['id'],
+                         self.agent_extension.cached_image_id)
+
+        image_info = _build_fake_partition_image_info()
+        self.assertRaisesRegex(errors.ImageStagingError, 'does not fit',
+                               self.agent_extension._cache_and_write_image,
+                               image_info, '/dev/foo')
+        self.assertEqual(1, stream_mock.call_count)
+        self.assertFalse(write_mock.called)
+
+    @mock.patch.object(standby, '_stage_image', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_no_space(self, requests_mock, open_mock,
+                                     stage_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': '1073741824'}
+        stage_mock.side_effect = errors.ImageStagingError(image_info['id'],
+                                                          'does not fit')
+
+        self.assertRaises(errors.ImageStagingError, standby._download_image,
+                          image_info, '/dev/foo')
+        stage_mock.assert_called_once_with(image_info, 1073741824,
+                                           '/dev/foo')
+        response.close.assert_called_once_with()
+        self.assertFalse(response.iter_content.called)
+        self.assertFalse(open_mock.called)
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
@@ -832,6 +1559,317 @@ class TestStandbyExtension(base.IronicAgentTest):
                                               stream=True, proxies={})
         expected_calls = [mock.call('some'), mock.call('content')]
         file_mock.write.assert_has_calls(expected_calls)
+        stats = self.agent_extension.image_stats
+        self.assertEqual(11, stats['bytes'])
+        self.assertIn('stall_seconds', stats['download'])
+        self.assertIn('bytes_per_second', stats['write'])
+
+    @mock.patch.object(standby, '_O_DIRECT', os.O_DSYNC)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_direct_io(self, requests_mock):
+        content = os.urandom(3 * standby.IMAGE_CHUNK_SIZE + 1000)
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        image_info['stream_direct_io'] = True
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.raw = io.BytesIO(content)
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device.name)
+        with open(device.name, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertFalse(response.iter_content.called)
+        self.assertEqual(len(content),
+                         self.agent_extension.image_stats['bytes'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_sparse(self, requests_mock):
+        block = standby.SPARSE_BLOCK_SIZE
+        data = os.urandom(block)
+        content = (b'\0' * standby.IMAGE_CHUNK_SIZE + data
+                   + b'\0' * 2 * block + data + b'\0' * 100)
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        image_info['stream_sparse'] = True
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.iter_content.return_value = [
+            content[i:i + standby.IMAGE_CHUNK_SIZE]
+            for i in range(0, len(content), standby.IMAGE_CHUNK_SIZE)]
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+        device.write(b'\xff' * len(content))
+        device.flush()
+
+        # Regular files do not support BLKZEROOUT, the zeros get written.
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device.name)
+        with open(device.name, 'rb') as f:
+            self.assertEqual(content, f.read())
+        stats = self.agent_extension.image_stats['sparse']
+        skipped = len(content) - 2 * block
+        self.assertEqual(skipped, stats['skipped_bytes'])
+        self.assertAlmostEqual(float(skipped) / len(content),
+                               stats['skipped_ratio'])
+        self.assertEqual('zeroout', stats['zero_mode'])
+
+    def _test_stream_compressed_image(self, requests_mock, image_info,
+                                      compressed, content):
+        image_info['checksum'] = hashlib.md5(compressed).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(compressed))}
+        # The raw stream and the content iterator share the same data.
+        response.raw = io.BytesIO(compressed)
+        response.iter_content.side_effect = (
+            lambda size: iter(lambda: response.raw.read(size), b''))
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device.name)
+        with open(device.name, 'rb') as f:
+            self.assertEqual(content, f.read())
+        stats = self.agent_extension.image_stats
+        self.assertEqual(len(content), stats['bytes'])
+        self.assertEqual(len(compressed), stats['compressed_bytes'])
+        return stats
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_gzip(self, requests_mock):
+        content = os.urandom(1000) + b'\0' * 3 * standby.IMAGE_CHUNK_SIZE
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(content) + compressor.flush()
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+
+        stats = self._test_stream_compressed_image(requests_mock, image_info,
+                                                   compressed, content)
+        self.assertEqual('gzip', stats['compression'])
+
+    @mock.patch.object(standby, '_O_DIRECT', os.O_DSYNC)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_gzip_direct_io(self,
+                                                         requests_mock):
+        content = os.urandom(2 * standby.IMAGE_CHUNK_SIZE + 1000)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(content) + compressor.flush()
+        image_info = _build_fake_image_info()
+        image_info['container_format'] = 'compressed'
+        image_info['stream_direct_io'] = True
+
+        stats = self._test_stream_compressed_image(requests_mock, image_info,
+                                                   compressed, content)
+        self.assertEqual('gzip', stats['compression'])
+
+    @mock.patch.object(standby, 'VERIFY_RANGE_SIZE',
+                       16 * standby.IMAGE_ALIGNMENT)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_verify(self, requests_mock):
+        content = os.urandom(standby.IMAGE_CHUNK_SIZE + 1000)
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        image_info['verify_writes'] = True
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.iter_content.return_value = [
+            content[:standby.IMAGE_CHUNK_SIZE],
+            content[standby.IMAGE_CHUNK_SIZE:]]
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device.name)
+        stats = self.agent_extension.image_stats['verify']
+        self.assertEqual(len(content), stats['bytes'])
+        self.assertEqual(4, stats['workers'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_not_compressed(self,
+                                                         requests_mock):
+        content = b'\xfa' + os.urandom(1000)
+        image_info = _build_fake_image_info()
+        image_info['container_format'] = 'compressed'
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.iter_content.return_value = [content]
+
+        self.assertRaisesRegex(
+            errors.ImageFormatError, 'Unsupported compression',
+            self.agent_extension._stream_raw_image_onto_device, image_info,
+            '/dev/foo')
+
+    def _test_delta_write_image(self, requests_mock, image, manifest,
+                                device_content):
+        ranged_get = _fake_ranged_get(image)
+
+        def fake_get(url, headers=None, **kwargs):
+            if url.endswith(standby.BLOCK_MANIFEST_SUFFIX):
+                response = mock.Mock(status_code=200)
+                response.content = manifest
+                return response
+            return ranged_get(url, headers=headers, **kwargs)
+
+        requests_mock.side_effect = fake_get
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(image).hexdigest()
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+        device.write(device_content)
+        device.flush()
+
+        result = self.agent_extension._delta_write_image(image_info,
+                                                         device.name)
+        with open(device.name, 'rb') as f:
+            return result, f.read()
+
+    @mock.patch('requests.get', autospec=True)
+    def test_delta_write_image(self, requests_mock):
+        block_size = test_block_manifest.BLOCK_SIZE
+        image = os.urandom(10 * block_size + 100)
+        old = bytearray(image + b'\xff' * block_size)
+        old[3 * block_size + 5] ^= 1
+        old[4 * block_size] ^= 1
+        old[-block_size - 1] ^= 1
+        manifest = test_block_manifest.build_manifest(image)
+
+        result, content = self._test_delta_write_image(
+            requests_mock, image, manifest, bytes(old))
+        self.assertTrue(result)
+        self.assertEqual(image + b'\xff' * block_size, content)
+        stats = self.agent_extension.image_stats
+        self.assertEqual(2 * block_size + 100, stats['bytes'])
+        self.assertEqual(11, stats['delta']['blocks'])
+        self.assertEqual(3, stats['delta']['changed_blocks'])
+        # The manifest, the initial request and two ranges
+        self.assertEqual(4, requests_mock.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_delta_write_image_stale_manifest(self, requests_mock):
+        block_size = test_block_manifest.BLOCK_SIZE
+        image = os.urandom(4 * block_size)
+        old = image[:block_size] + os.urandom(3 * block_size)
+        # The manifest of the old content
+        manifest = test_block_manifest.build_manifest(old)
+
+        result, content = self._test_delta_write_image(
+            requests_mock, image, manifest, old)
+        self.assertFalse(result)
+        self.assertIsNone(self.agent_extension.image_stats)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_delta_write_image_no_manifest(self, requests_mock):
+        requests_mock.return_value.status_code = 404
+        image_info = _build_fake_image_info()
+
+        self.assertFalse(self.agent_extension._delta_write_image(
+            image_info, '/dev/foo'))
+        requests_mock.assert_called_once_with(
+            image_info['urls'][0] + standby.BLOCK_MANIFEST_SUFFIX,
+            cert=None, verify=True, proxies={})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_delta_write_image_small_device(self, requests_mock):
+        image = os.urandom(4 * test_block_manifest.BLOCK_SIZE)
+        manifest = test_block_manifest.build_manifest(image)
+
+        result, content = self._test_delta_write_image(
+            requests_mock, image, manifest, image[:-1])
+        self.assertFalse(result)
+        self.assertEqual(image[:-1], content)
+
+    def test_changed_blocks(self):
+        block_size = test_block_manifest.BLOCK_SIZE
+        image = os.urandom(20 * block_size)
+        manifest = standby.block_manifest.Manifest(
+            test_block_manifest.build_manifest(image))
+        old = bytearray(image)
+        for index in (0, 7, 8, 19):
+            old[index * block_size] ^= 1
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+        device.write(bytes(old))
+        device.flush()
+
+        for workers in (1, 3):
+            self.assertEqual([0, 7, 8, 19], standby._changed_blocks(
+                device.name, manifest, workers))
+        self.assertRaises(OSError, standby._changed_blocks,
+                          '/nonexistent/device', manifest, 2)
+
+    @mock.patch.object(standby, '_erase_partition_tables', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device(self, requests_mock,
+                                            erase_mock):
+        image, raw = test_qcow2.build_image()
+        requests_mock.side_effect = _fake_ranged_get(image)
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(image).hexdigest()
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+        device.write(b'\xff' * len(raw))
+        device.flush()
+
+        self.assertTrue(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, device.name))
+
+        erase_mock.assert_called_once_with(device.name)
+        with open(device.name, 'rb') as f:
+            self.assertEqual(raw, f.read())
+        stats = self.agent_extension.image_stats
+        self.assertEqual(len(image), stats['bytes'])
+        self.assertEqual(len(raw), stats['virtual_size'])
+        self.assertEqual(len(raw) - 3 * test_qcow2.CLUSTER_SIZE,
+                         stats['zeroed_bytes'])
+
+    @mock.patch.object(standby, '_erase_partition_tables', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device_no_ranges(self, requests_mock,
+                                                      erase_mock):
+        image, raw = test_qcow2.build_image()
+        requests_mock.side_effect = _fake_ranged_get(image,
+                                                     accept_ranges='none')
+        image_info = _build_fake_image_info()
+
+        self.assertFalse(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, '/dev/foo'))
+        self.assertFalse(erase_mock.called)
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              cert=None, verify=True,
+                                              stream=True, proxies={})
+
+    @mock.patch.object(standby, '_erase_partition_tables', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device_not_qcow2(self, requests_mock,
+                                                      erase_mock):
+        requests_mock.side_effect = _fake_ranged_get(b'raw image' * 100)
+        image_info = _build_fake_image_info()
+
+        self.assertRaises(errors.ImageFormatError,
+                          self.agent_extension._stream_qcow2_image_onto_device,
+                          image_info, '/dev/foo')
+        self.assertFalse(erase_mock.called)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_erase_partition_tables(self, execute_mock):
+        execute_mock.side_effect = [processutils.ProcessExecutionError,
+                                    ('', '')]
+        standby._erase_partition_tables('/dev/foo')
+        execute_mock.assert_has_calls([mock.call('sgdisk', '-Z', '/dev/foo'),
+                                       mock.call('sgdisk', '-o', '/dev/foo')])
+
+        execute_mock.reset_mock()
+        execute_mock.side_effect = processutils.ProcessExecutionError
+        self.assertRaises(errors.ImageWriteError,
+                          standby._erase_partition_tables, '/dev/foo')
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
@@ -857,6 +1895,134 @@ class TestStandbyExtension(base.IronicAgentTest):
         # Assert write was only called once and failed!
         file_mock.write.assert_called_once_with('some')
 
+    def _fan_out_image_info(self, requests_mock, content):
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.iter_content.return_value = [
+            content[i:i + standby.IMAGE_CHUNK_SIZE]
+            for i in range(0, len(content), standby.IMAGE_CHUNK_SIZE)]
+        return image_info
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_fan_out(self, requests_mock):
+        content = os.urandom(3 * standby.IMAGE_CHUNK_SIZE + 1000)
+        image_info = self._fan_out_image_info(requests_mock, content)
+        image_info['verify_writes'] = True
+        devices = []
+        for i in range(3):
+            device = tempfile.NamedTemporaryFile()
+            self.addCleanup(device.close)
+            devices.append(device.name)
+
+        self.agent_extension._stream_raw_image_onto_device(
+            image_info, devices[0], devices[1:])
+        for device in devices:
+            with open(device, 'rb') as f:
+                self.assertEqual(content, f.read())
+        # The image was downloaded once.
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              cert=None, verify=True,
+                                              stream=True, proxies={})
+        stats = self.agent_extension.image_stats
+        self.assertEqual(len(content), stats['bytes'])
+        self.assertEqual(set(devices), set(stats['devices']))
+        for device in devices:
+            self.assertEqual(len(content),
+                             stats['devices'][device]['verify']['bytes'])
+        self.assertEqual(stats['devices'][devices[0]]['verify'],
+                         stats['verify'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_no_direct_io(self, requests_mock):
+        content = os.urandom(3 * standby.IMAGE_CHUNK_SIZE + 1000)
+        devices = []
+        for i in range(3):
+            device = tempfile.NamedTemporaryFile()
+            self.addCleanup(device.close)
+            devices.append(device.name)
+        real_open = standby._DirectIOWriter.open
+        real_close = standby._DirectIOWriter.close
+        for refused in (devices[1:2], devices):
+            image_info = self._fan_out_image_info(requests_mock, content)
+            image_info['stream_direct_io'] = True
+            opened = []
+
+            def fake_open(device):
+                if device in refused:
+                    return None
+                writer = real_open(device)
+                opened.append(writer)
+                return writer
+
+            with mock.patch.object(standby, '_O_DIRECT', os.O_DSYNC), \
+                    mock.patch.object(standby._DirectIOWriter, 'open',
+                                      side_effect=fake_open), \
+                    mock.patch.object(standby._DirectIOWriter, 'close',
+                                      autospec=True,
+                                      side_effect=real_close) as close_mock:
+                self.agent_extension._stream_raw_image_onto_device(
+                    image_info, devices[0], devices[1:])
+            for device in devices:
+                with open(device, 'rb') as f:
+                    self.assertEqual(content, f.read())
+                open(device, 'wb').close()
+            # The direct I/O writers opened before the refusal are closed.
+            self.assertEqual([mock.call(writer) for writer in opened],
+                             close_mock.call_args_list)
+            self.assertEqual(len(content),
+                             self.agent_extension.image_stats['bytes'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_progress(self, requests_mock):
+        content = os.urandom(3 * standby.IMAGE_CHUNK_SIZE + 1000)
+        image_info = self._fan_out_image_info(requests_mock, content)
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+        tracker = progress.Progress()
+        progress.set_current(tracker)
+        self.addCleanup(progress.set_current, None)
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device.name)
+        snapshot = tracker.snapshot()
+        self.assertEqual('verify', snapshot['stage'])
+        self.assertEqual(len(content), snapshot['total_bytes'])
+        self.assertEqual(len(content), snapshot['downloaded_bytes'])
+        self.assertEqual(len(content), snapshot['written_bytes'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_fan_out_error(self,
+                                                        requests_mock):
+        content = os.urandom(3 * standby.IMAGE_CHUNK_SIZE + 1000)
+        image_info = self._fan_out_image_info(requests_mock, content)
+        device = tempfile.NamedTemporaryFile()
+        self.addCleanup(device.close)
+
+        self.assertRaisesRegex(
+            errors.ImageDownloadError,
+            'Unable to write image to 1 of 2 devices: /dev/full: ',
+            self.agent_extension._stream_raw_image_onto_device,
+            image_info, device.name, ['/dev/full'])
+        # The device which did not fail got the whole image.
+        with open(device.name, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertIsNone(self.agent_extension.image_stats)
+
+    def test_fan_out_writer_all_failed(self):
+        streams = [mock.Mock(device='/dev/sda'), mock.Mock(device='/dev/sdb')]
+        streams[0].write.side_effect = IOError('sda failed')
+        streams[1].write.side_effect = IOError('sdb failed')
+        writer = standby._FanOutWriter(streams)
+        self.addCleanup(writer.close)
+
+        self.assertRaisesRegex(IOError, 'sda failed', writer.write, b'data')
+        self.assertEqual({'/dev/sda', '/dev/sdb'}, set(writer.errors))
+        writer.finish()
+        self.assertFalse(streams[0].finish.called)
+
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
     def test__message_format_whole_disk(self):
@@ -947,6 +2113,46 @@ class TestImageDownload(base.IronicAgentTest):
                                               stream=True, proxies={})
         self.assertEqual(image_info['checksum'], image_download.md5sum())
 
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peek(self, requests_mock):
+        content = [b'ab', b'cd', b'efgh']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = content
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(b'abcdefgh').hexdigest()
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(b'abcd', image_download.peek(3))
+        self.assertEqual(b'abcd', image_download.peek(3))
+        self.assertEqual(content, list(image_download))
+        self.assertEqual(image_info['checksum'], image_download.md5sum())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peek_readinto(self, requests_mock):
+        content = os.urandom(10000)
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(content))}
+        response.raw = io.BytesIO(content)
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content[:standby.IMAGE_ALIGNMENT],
+                         image_download.peek(6, readinto=True))
+        buf = bytearray(5000)
+        received = b''
+        while True:
+            count = image_download.readinto(buf)
+            if not count:
+                break
+            received += bytes(buf[:count])
+            image_download.wait_hashed(len(received))
+        self.assertEqual(content, received)
+        self.assertEqual(image_info['checksum'], image_download.md5sum())
+
     @mock.patch('time.time', autospec=True)
     @mock.patch('requests.get', autospec=True)
     def test_download_image_fail(self, requests_mock, time_mock):
@@ -964,3 +2170,1482 @@ class TestImageDownload(base.IronicAgentTest):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={})
+
+    @mock.patch.object(standby, 'IMAGE_RANGE_SIZE', 4)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        requests_mock.side_effect = _fake_ranged_get(content)
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 3
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         image_download.md5sum())
+        # One initial request plus one request per 4 byte range
+        self.assertEqual(6, requests_mock.call_count)
+        requests_mock.assert_any_call(image_info['urls'][0],
+                                      cert=None, verify=True,
+                                      stream=True, proxies={},
+                                      headers={'Range': 'bytes=16-19'})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged_not_supported(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        requests_mock.side_effect = _fake_ranged_get(content,
+                                                     accept_ranges='none')
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 3
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              cert=None, verify=True,
+                                              stream=True, proxies={})
+
+    @mock.patch.object(standby, 'IMAGE_RANGE_SIZE', 4)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged_short_read(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        requests_mock.side_effect = _fake_ranged_get(content,
+                                                     truncate_at=8)
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_download = standby.ImageDownload(image_info)
+
+        # Every range from byte 8 on is truncated, whichever of them uses
+        # up the retries last fails the download.
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Giving up after 3 retries. Last error: '
+                               'Received 0 bytes for range (8|12|16)-',
+                               b''.join, image_download)
+
+    def _interrupted_response(self, content, headers=None, status=200,
+                              reason=None):
+        def iter_content(chunk_size):
+            for i in range(0, len(content), 4):
+                yield content[i:i + 4]
+            if reason is not None:
+                raise reason
+
+        response = mock.Mock()
+        response.status_code = status
+        response.headers = headers or {}
+        response.iter_content.side_effect = iter_content
+        return response
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        headers = {'Content-Length': str(len(content)), 'ETag': '"v1"'}
+        requests_mock.side_effect = [
+            self._interrupted_response(
+                content[:8], headers,
+                reason=requests.exceptions.ChunkedEncodingError('reset')),
+            self._interrupted_response(content[8:], status=206)]
+        image_info = _build_fake_image_info()
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         image_download.md5sum())
+        requests_mock.assert_called_with(
+            image_info['urls'][0], cert=None, verify=True, stream=True,
+            proxies={}, headers={'Range': 'bytes=8-', 'If-Range': '"v1"'})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_next_url(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        headers = {'Content-Length': str(len(content)), 'ETag': '"v1"'}
+        requests_mock.side_effect = [
+            # The connection is closed early without an error.
+            self._interrupted_response(content[:8], headers),
+            # The image changed, the server ignores the range.
+            self._interrupted_response(content),
+            self._interrupted_response(content[8:], status=206)]
+        image_info = _build_fake_image_info()
+        image_info['urls'].append('http://mirror.example.org')
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual(
+            [mock.call(image_info['urls'][0], cert=None, verify=True,
+                       stream=True, proxies={},
+                       headers={'Range': 'bytes=8-', 'If-Range': '"v1"'}),
+             mock.call(image_info['urls'][1], cert=None, verify=True,
+                       stream=True, proxies={},
+                       headers={'Range': 'bytes=8-'})],
+            requests_mock.call_args_list[1:])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_readinto(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        first = requests_mock.return_value
+        first.status_code = 200
+        first.headers = {'Content-Length': str(len(content))}
+        first.raw.readinto.side_effect = [
+            requests.packages.urllib3.exceptions.ProtocolError('reset')]
+        second = self._interrupted_response(b'', status=206)
+        second.raw = io.BytesIO(content)
+        requests_mock.side_effect = [first, second]
+        image_download = standby.ImageDownload(_build_fake_image_info())
+
+        buf = bytearray(len(content))
+        self.assertEqual(len(content), image_download.readinto(buf))
+        self.assertEqual(0, image_download.readinto(buf))
+        self.assertEqual(content, bytes(buf))
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         image_download.md5sum())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_budget(self, requests_mock):
+        self.config(image_download_retries=2)
+        content = b'SpongeBobSquarePants'
+        headers = {'Content-Length': str(len(content))}
+        reason = requests.exceptions.ConnectionError('reset')
+        requests_mock.side_effect = [
+            self._interrupted_response(content[:4], headers, reason=reason),
+            self._interrupted_response(content[4:8], status=206,
+                                       reason=reason),
+            self._interrupted_response(content[8:12], status=206,
+                                       reason=reason)]
+        image_download = standby.ImageDownload(_build_fake_image_info())
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Giving up after 2 retries',
+                               b''.join, image_download)
+        self.assertEqual(3, requests_mock.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_encoded(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        headers = {'Content-Length': '10', 'Content-Encoding': 'gzip'}
+        requests_mock.return_value = self._interrupted_response(
+            content[:8], headers,
+            reason=requests.exceptions.ConnectionError('reset'))
+        image_download = standby.ImageDownload(_build_fake_image_info())
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'cannot be resumed',
+                               b''.join, image_download)
+        requests_mock.assert_called_once_with(mock.ANY, cert=None,
+                                              verify=True, stream=True,
+                                              proxies={})
+
+    @mock.patch.object(peers, 'fetch_chunk', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peers(self, requests_mock, fetch_mock):
+        content = os.urandom(3 * 512 + 10)
+        manifest = block_manifest.Manifest(
+            test_block_manifest.build_manifest(content, block_size=512))
+        requests_mock.side_effect = _fake_ranged_get(content)
+
+        def fake_fetch(peer, image_id, index, manifest):
+            if peer.url == 'http://down':
+                raise requests.exceptions.ConnectionError()
+            if index == 2:
+                return None
+            return content[index * 512:(index + 1) * 512]
+
+        fetch_mock.side_effect = fake_fetch
+        image_info = _build_fake_image_info()
+        image_download = standby.ImageDownload(image_info)
+        image_download.use_peers(manifest, ['http://down', 'http://up'], 2)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual(3 * 512 - 512 + 10, image_download.peer_bytes)
+        # The unreachable peer is not asked again once it failed.
+        self.assertEqual(1, len([c for c in fetch_mock.call_args_list
+                                 if c[0][0].url == 'http://down']))
+        requests_mock.assert_any_call(image_info['urls'][0], cert=None,
+                                      verify=True, stream=True, proxies={},
+                                      headers={'Range': 'bytes=1024-1535'})
+
+    @mock.patch.object(peers, 'fetch_chunk', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peers_wave(self, requests_mock, fetch_mock):
+        content = os.urandom(3 * 512 + 10)
+        manifest = block_manifest.Manifest(
+            test_block_manifest.build_manifest(content, block_size=512))
+        requests_mock.side_effect = _fake_ranged_get(content)
+
+        def fake_fetch(peer, image_id, index, manifest):
+            if peer.url == 'http://c':
+                raise requests.exceptions.ConnectionError()
+            peer.answered = peer.sharing = True
+            peer.available = index + 1
+            return content[index * 512:(index + 1) * 512]
+
+        fetch_mock.side_effect = fake_fetch
+        image_info = _build_fake_image_info()
+        image_download = standby.ImageDownload(image_info)
+        image_download.use_peers(manifest, ['http://c', 'http://a'], 1,
+                                 agent_url='http://b/')
+
+        self.assertEqual(content, b''.join(image_download))
+        # Chunks 0 and 3 are assigned to the peer a, chunk 1 to this agent
+        # and chunk 2 to the unreachable peer c.
+        self.assertEqual(512 + 10, image_download.peer_bytes)
+        self.assertEqual([(0, 'http://a'), (2, 'http://c'), (3, 'http://a')],
+                         [(c[0][2], c[0][0].url)
+                          for c in fetch_mock.call_args_list])
+        ranges = [c[1]['headers'] for c in requests_mock.call_args_list
+                  if 'headers' in c[1]]
+        self.assertEqual([{'Range': 'bytes=512-1023'},
+                          {'Range': 'bytes=1024-1535'}], ranges)
+
+    @mock.patch.object(peers, 'PEER_POLL_INTERVAL', 0)
+    @mock.patch.object(peers, 'fetch_chunk', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peers_wait(self, requests_mock, fetch_mock):
+        content = os.urandom(2 * 512)
+        manifest = block_manifest.Manifest(
+            test_block_manifest.build_manifest(content, block_size=512))
+        requests_mock.side_effect = _fake_ranged_get(content)
+        missing = []
+
+        def fake_fetch(peer, image_id, index, manifest):
+            peer.answered = peer.sharing = True
+            if not missing:
+                missing.append(index)
+                return None
+            peer.available = index + 1
+            return content[index * 512:(index + 1) * 512]
+
+        fetch_mock.side_effect = fake_fetch
+        image_download = standby.ImageDownload(_build_fake_image_info())
+        image_download.use_peers(manifest, ['http://a'], 1,
+                                 agent_url='http://b')
+
+        self.assertEqual(content, b''.join(image_download))
+        # The peer chunk 0 is assigned to is asked until it holds it.
+        self.assertEqual(512, image_download.peer_bytes)
+        self.assertEqual(2, fetch_mock.call_count)
+        ranges = [c[1]['headers'] for c in requests_mock.call_args_list
+                  if 'headers' in c[1]]
+        self.assertEqual([{'Range': 'bytes=512-1023'}], ranges)
+
+    @mock.patch.object(peers, 'fetch_chunk', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_peers_server_mismatch(self, requests_mock,
+                                                  fetch_mock):
+        content = os.urandom(2 * 512)
+        manifest = block_manifest.Manifest(
+            test_block_manifest.build_manifest(content, block_size=512))
+        requests_mock.side_effect = _fake_ranged_get(b'x' * len(content))
+        fetch_mock.return_value = None
+        image_download = standby.ImageDownload(_build_fake_image_info())
+        image_download.use_peers(manifest, ['http://peer'], 1)
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'does not match the block manifest',
+                               b''.join, image_download)
+
+    @mock.patch.object(standby, 'IMAGE_RANGE_SIZE', 8)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged_resume(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        fake_get = _fake_ranged_get(content)
+        interrupted = []
+
+        def flaky_get(url, headers=None, **kwargs):
+            if headers == {'Range': 'bytes=8-15'} and not interrupted:
+                interrupted.append(True)
+                return self._interrupted_response(
+                    content[8:12], status=206,
+                    reason=requests.exceptions.ConnectionError('reset'))
+            return fake_get(url, headers=headers, **kwargs)
+
+        requests_mock.side_effect = flaky_get
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        requests_mock.assert_any_call(image_info['urls'][0], cert=None,
+                                      verify=True, stream=True, proxies={},
+                                      headers={'Range': 'bytes=12-15'})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_rank_urls(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        urls = ['http://slow.example.org', 'http://broken.example.org',
+                'http://fast.example.org']
+
+        def fake_get(url, **kwargs):
+            response = mock.Mock()
+            response.status_code = 404 if 'broken' in url else 200
+            response.headers = {'Content-Length': str(len(content))}
+
+            def iter_content(chunk_size):
+                if 'slow' in url:
+                    time.sleep(0.05)
+                yield content
+            response.iter_content.side_effect = iter_content
+            return response
+
+        requests_mock.side_effect = fake_get
+        image_info = _build_fake_image_info()
+        image_info['urls'] = urls
+        image_info['url_selection'] = 'fastest'
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual([urls[2], urls[0], urls[1]], image_download._urls)
+        # Three probes, then the download from the fastest URL.
+        self.assertEqual(4, requests_mock.call_count)
+        requests_mock.assert_called_with(urls[2], cert=None, verify=True,
+                                         stream=True, proxies={})
+        self.assertEqual(content, b''.join(image_download))
+
+    @mock.patch.object(standby.ImageDownload, '_rank_urls', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ordered(self, requests_mock, rank_mock):
+        self.config(image_download_url_selection='fastest')
+        requests_mock.return_value.status_code = 200
+        image_info = _build_fake_image_info()
+        standby.ImageDownload(image_info)
+        self.assertFalse(rank_mock.called)
+
+        image_info['urls'].append('http://mirror.example.org')
+        image_info['url_selection'] = 'ordered'
+        standby.ImageDownload(image_info)
+        self.assertFalse(rank_mock.called)
+
+    @mock.patch.object(standby._RateMonitor, 'update', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_failover(self, requests_mock, update_mock):
+        self.config(image_download_min_rate=1024)
+        update_mock.side_effect = lambda monitor, count, seconds: (
+            update_mock.call_count == 1)
+        content = b'SpongeBobSquarePants'
+        headers = {'Content-Length': str(len(content))}
+        slow = self._interrupted_response(content, headers)
+        requests_mock.side_effect = [
+            slow,
+            # The first mirror fails, the second one takes over.
+            self._interrupted_response(b'', status=503),
+            self._interrupted_response(content[4:], status=206)]
+        image_info = _build_fake_image_info()
+        image_info['urls'] += ['http://broken.example.org',
+                               'http://mirror.example.org']
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         image_download.md5sum())
+        slow.close.assert_called_once_with()
+        requests_mock.assert_called_with(
+            image_info['urls'][2], cert=None, verify=True, stream=True,
+            proxies={}, headers={'Range': 'bytes=4-'})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_multihash(self, requests_mock):
+        content = b'SpongeBobSquarePants'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [content[:8], content[8:]]
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'fake-sha512'
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        self.assertEqual({'md5': hashlib.md5(content).hexdigest(),
+                          'sha512': hashlib.sha512(content).hexdigest()},
+                         image_download.hexdigests())
+
+    def test_image_hasher(self):
+        content = os.urandom(100000)
+        hasher = standby._ImageHasher(['md5', 'sha256', 'md5'])
+        view = memoryview(content)
+        for i in range(0, len(content), 10000):
+            hasher.update(view[i:i + 10000])
+        hasher.wait(len(content))
+        self.assertEqual({'md5': hashlib.md5(content).hexdigest(),
+                          'sha256': hashlib.sha256(content).hexdigest()},
+                         hasher.hexdigests())
+        # Finishing again returns the same result
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         hasher.hexdigests()['md5'])
+
+    def test_image_hasher_empty(self):
+        hasher = standby._ImageHasher(['sha256'])
+        hasher.wait(0)
+        self.assertEqual({'sha256': hashlib.sha256(b'').hexdigest()},
+                         hasher.hexdigests())
+
+    def test_rate_monitor(self):
+        monitor = standby._RateMonitor(100, 2)
+        self.assertFalse(monitor.update(10, 1))
+        self.assertTrue(monitor.update(10, 1))
+        self.assertFalse(monitor.update(150, 1.5))
+        self.assertFalse(monitor.update(150, 1.5))
+
+    def test_validate_image_info_url_selection(self):
+        image_info = _build_fake_image_info()
+        image_info['url_selection'] = 'random'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['url_selection'] = 'fastest'
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_download_connections(self):
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 0
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['download_connections'] = 'many'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['download_connections'] = '4'
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_target_devices(self):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = '/dev/sda'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['target_devices'] = ['/dev/sda', 42]
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['target_devices'] = ['/dev/sda', {'serial': 'serial1'}]
+        standby._validate_image_info(None, image_info)
+        image_info['image_type'] = 'partition'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+
+    def test_validate_image_info_peers(self):
+        image_info = _build_fake_image_info()
+        image_info['peers'] = 'http://10.0.0.5:9999'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['peers'] = [None]
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info, None, image_info)
+        image_info['peers'] = ['http://10.0.0.5:9999']
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_download_rate_limit(self):
+        image_info = _build_fake_image_info()
+        for key in ('download_max_rate', 'download_ramp_up'):
+            image_info[key] = -1
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info, None, image_info)
+            image_info[key] = 'fast'
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info, None, image_info)
+            image_info[key] = '100'
+            standby._validate_image_info(None, image_info)
+
+    def test_download_rate_limit(self):
+        self.config(image_download_max_rate=1000, image_download_ramp_up=30)
+        image_info = _build_fake_image_info()
+        self.assertEqual((1024000, 30), standby._download_rate_limit(
+            image_info))
+        image_info['download_max_rate'] = 0
+        image_info['download_ramp_up'] = '2.5'
+        self.assertEqual((0, 2.5), standby._download_rate_limit(image_info))
+
+    @mock.patch.object(time, 'sleep', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_rate_limited(self, requests_mock, sleep_mock):
+        content = b'x' * (3 * 1024)
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.headers = {
+            'Content-Length': str(len(content))}
+        requests_mock.return_value.iter_content.return_value = [
+            content[i:i + 1024] for i in range(0, len(content), 1024)]
+        image_info = _build_fake_image_info()
+        image_info['download_max_rate'] = 1
+
+        # Throttling moves the clock forward as a real sleep would.
+        clock = [time.time()]
+        sleep_mock.side_effect = lambda seconds: clock.append(
+            clock.pop() + seconds)
+
+        with mock.patch.object(time, 'time', autospec=True,
+                               side_effect=lambda: clock[0]):
+            image_download = standby.ImageDownload(image_info)
+            self.assertEqual(content, b''.join(image_download))
+        # About one second per KiB, less the initial burst.
+        self.assertEqual(3, sleep_mock.call_count)
+        self.assertAlmostEqual(3 - standby.RATE_LIMIT_BURST_SECONDS,
+                               image_download.rate_limit.throttled_seconds,
+                               places=3)
+
+
+@mock.patch.object(time, 'sleep', autospec=True)
+@mock.patch.object(time, 'time', autospec=True)
+class TestTokenBucket(base.IronicAgentTest):
+
+    def test_consume(self, time_mock, sleep_mock):
+        time_mock.return_value = 100.0
+        bucket = standby._TokenBucket(1000)
+        bucket.consume(100)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(500)
+        sleep_mock.assert_called_once_with(0.5)
+
+        # Tokens accumulate up to the burst size only.
+        sleep_mock.reset_mock()
+        time_mock.return_value = 110.0
+        bucket.consume(100)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(100)
+        sleep_mock.assert_called_once_with(0.1)
+        self.assertAlmostEqual(0.6, bucket.throttled_seconds)
+
+    def test_ramp_up(self, time_mock, sleep_mock):
+        time_mock.return_value = 0.0
+        bucket = standby._TokenBucket(1000, ramp_up=10)
+        # A tenth of the maximum rate at first.
+        bucket.consume(110)
+        sleep_mock.assert_called_once_with(1.0)
+
+        sleep_mock.reset_mock()
+        time_mock.return_value = 5.0
+        bucket._tokens = 0
+        bucket._last = 5.0
+        bucket.consume(550)
+        sleep_mock.assert_called_once_with(1.0)
+
+        sleep_mock.reset_mock()
+        time_mock.return_value = 20.0
+        bucket._tokens = 0
+        bucket._last = 20.0
+        bucket.consume(1000)
+        sleep_mock.assert_called_once_with(1.0)
+
+
+@mock.patch.object(psutil, 'virtual_memory', autospec=True)
+@mock.patch.object(psutil, 'disk_partitions', autospec=True)
+@mock.patch.object(os, 'statvfs', autospec=True)
+@mock.patch.object(standby, '_disk_of', autospec=True)
+class TestStageImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestStageImage, self).setUp()
+        self.addCleanup(standby._STAGED_IMAGES.clear)
+        self.config(image_staging_dirs=['/scratch'],
+                    image_staging_memory_reserve=1)
+        self.image_info = _build_fake_image_info()
+
+    def _setup(self, disk_mock, statvfs_mock, partitions_mock, memory_mock,
+               available, disk='sdb'):
+        statvfs_mock.return_value = mock.Mock(f_bavail=1000,
+                                              f_frsize=1024 * 1024)
+        partitions_mock.return_value = [
+            mock.Mock(mountpoint='/', fstype='rootfs'),
+            mock.Mock(mountpoint='/scratch', fstype='ext4')]
+        memory_mock.return_value = mock.Mock(available=available)
+        disk_mock.return_value = disk
+
+    def test_fits_in_memory(self, *mocks):
+        self._setup(*mocks, available=100 * 1024 * 1024)
+        self.assertEqual('/tmp/fake_id', standby._stage_image(
+            self.image_info, 50 * 1024 * 1024, '/dev/sda'))
+        self.assertEqual('/tmp/fake_id',
+                         standby._image_location(self.image_info))
+
+    def test_staging_dir(self, *mocks):
+        self._setup(*mocks, available=100 * 1024 * 1024)
+        self.assertEqual('/scratch/fake_id', standby._stage_image(
+            self.image_info, 500 * 1024 * 1024, '/dev/sda'))
+        self.assertEqual('/scratch/fake_id',
+                         standby._image_location(self.image_info))
+        mocks[0].assert_called_once_with('/scratch')
+
+    def test_no_space(self, *mocks):
+        self._setup(*mocks, available=100 * 1024 * 1024, disk='sda')
+        self.assertRaisesRegex(
+            errors.ImageStagingError,
+            '/tmp is held in memory with only 103809024 bytes available; '
+            '/scratch is on the install device /dev/sda',
+            standby._stage_image, self.image_info, 500 * 1024 * 1024,
+            '/dev/sda')
+        self.assertRaisesRegex(
+            errors.ImageStagingError, '/scratch is only 1048576000 bytes free',
+            standby._stage_image, self.image_info, 2000 * 1024 * 1024,
+            '/dev/sda')
+        self.assertEqual('/tmp/fake_id',
+                         standby._image_location(self.image_info))
+
+    def test_unknown_size(self, *mocks):
+        self._setup(*mocks, available=0)
+        self.assertEqual('/tmp/fake_id', standby._stage_image(
+            self.image_info, None, '/dev/sda'))
+        self.assertFalse(mocks[1].called)
+
+
+class TestImageFits(base.IronicAgentTest):
+
+    def _download(self, size=None, content=b'', ranges=True):
+        image_download = mock.Mock(spec=['size', 'supports_ranges',
+                                         'read_range'])
+        image_download.size = size
+        image_download.supports_ranges.return_value = ranges
+        image_download.read_range.side_effect = (
+            lambda offset, length: content[offset:offset + length])
+        return image_download
+
+    def test_virtual_size_raw(self):
+        image_info = dict(_build_fake_image_info(), disk_format='raw')
+        self.assertEqual(4096, standby._image_virtual_size(
+            image_info, self._download(size=4096)))
+        self.assertIsNone(standby._image_virtual_size(
+            image_info, self._download()))
+
+    def test_virtual_size_qcow2(self):
+        image, raw = test_qcow2.build_image()
+        image_download = self._download(len(image), image)
+        image_info = dict(_build_fake_image_info(), disk_format='qcow2')
+        self.assertEqual(test_qcow2.VIRTUAL_SIZE,
+                         standby._image_virtual_size(image_info,
+                                                     image_download))
+        image_download.read_range.assert_called_once_with(0,
+                                                          qcow2.HEADER_SIZE)
+        # Not a qcow2 image after all.
+        self.assertEqual(len(raw), standby._image_virtual_size(
+            image_info, self._download(len(raw), raw)))
+
+    def test_virtual_size_no_disk_format(self):
+        image, raw = test_qcow2.build_image()
+        for content in (image, raw):
+            image_download = self._download(len(content), content)
+            self.assertEqual(len(content), standby._image_virtual_size(
+                _build_fake_image_info(), image_download))
+            self.assertFalse(image_download.read_range.called)
+
+    def test_virtual_size_unknown(self):
+        image, raw = test_qcow2.build_image()
+        for disk_format, download in [
+                ('qcow2', self._download(len(image), image, ranges=False)),
+                ('gzip', self._download(len(image), image)),
+                ('vmdk', self._download(len(image), image))]:
+            image_info = dict(_build_fake_image_info(),
+                              disk_format=disk_format)
+            self.assertIsNone(standby._image_virtual_size(image_info,
+                                                          download))
+
+    def test_check_partition_image(self):
+        image_info = _build_fake_partition_image_info()
+        standby._check_image_fits(image_info, 10 * 1024 * 1024,
+                                  ['/dev/sda1'])
+        self.assertRaisesRegex(
+            errors.InvalidCommandParamsError,
+            'Image virtual size: 11 MB, Root size: 10 MB',
+            standby._check_image_fits, image_info, 10 * 1024 * 1024 + 1,
+            ['/dev/sda1'])
+
+    @mock.patch.object(standby, '_block_device_size', autospec=True)
+    def test_check_whole_disk_image(self, size_mock):
+        size_mock.side_effect = lambda dev: {'/dev/sda': 8192}.get(dev)
+        image_info = _build_fake_image_info()
+        standby._check_image_fits(image_info, 8192, ['/dev/sda', '/dev/sdb'])
+        standby._check_image_fits(image_info, None, ['/dev/sda'])
+        self.assertRaisesRegex(
+            errors.InvalidCommandParamsError,
+            'Device /dev/sda is too small for requested image. Image '
+            'virtual size: 8193 bytes, device size: 8192 bytes',
+            standby._check_image_fits, image_info, 8193,
+            ['/dev/sdb', '/dev/sda'])
+
+    def test_block_device_size_not_block_device(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertIsNone(standby._block_device_size(f.name))
+        self.assertIsNone(standby._block_device_size('/nonexistent'))
+
+    @mock.patch.object(standby, '_stage_image', autospec=True)
+    @mock.patch.object(standby, '_block_device_size', autospec=True,
+                       return_value=50)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_too_large(self, requests_mock, size_mock,
+                                      stage_mock):
+        requests_mock.side_effect = _fake_ranged_get(b'x' * 100)
+        image_info = dict(_build_fake_image_info(), disk_format='raw')
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'Device /dev/sda is too small',
+                               standby._download_image, image_info,
+                               '/dev/sda')
+        self.assertFalse(stage_mock.called)
+        size_mock.assert_called_once_with('/dev/sda')
+
+    @mock.patch.object(standby, '_block_device_size', autospec=True,
+                       return_value=50)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_image_too_large(self, requests_mock, size_mock):
+        requests_mock.side_effect = _fake_ranged_get(b'x' * 100)
+        image_info = dict(_build_fake_image_info(), disk_format='raw')
+        extension = standby.StandbyExtension()
+        with mock.patch('six.moves.builtins.open',
+                        autospec=True) as open_mock:
+            self.assertRaisesRegex(
+                errors.InvalidCommandParamsError,
+                'Device /dev/sda is too small',
+                extension._stream_raw_image_onto_device, image_info,
+                '/dev/sda')
+        self.assertFalse(open_mock.called)
+
+
+@mock.patch.object(chunk_store, 'CHUNK_SIZE', 4096)
+@mock.patch('requests.get', autospec=True)
+class TestImageChunkStore(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestImageChunkStore, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.addCleanup(chunk_store._STORES.clear)
+        self.config(image_chunk_store_dir=self.store_dir)
+        self.content = os.urandom(4096 * 3 + 100)
+        self.image_info = dict(_build_fake_image_info(), disk_format='raw')
+        self.image_info['checksum'] = hashlib.md5(self.content).hexdigest()
+        self.range_requests = 0
+
+    def _fake_get(self, url, headers=None, **kwargs):
+        if url.endswith(standby.BLOCK_MANIFEST_SUFFIX):
+            return mock.Mock(status_code=404)
+        if headers is not None:
+            self.range_requests += 1
+        return _fake_ranged_get(self.content)(url, headers=headers)
+
+    def _fetch(self):
+        location = os.path.join(self.store_dir, 'image')
+        with mock.patch.object(standby, '_stage_image', autospec=True,
+                               return_value=location):
+            with mock.patch.object(standby, '_block_device_size',
+                                   autospec=True, return_value=None):
+                standby._fetch_image(self.image_info, '/dev/sda')
+        with open(location, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+    @mock.patch.object(standby, '_disk_of', autospec=True,
+                       return_value='sdb')
+    def test_fetch_image(self, disk_mock, requests_mock):
+        requests_mock.side_effect = self._fake_get
+        self._fetch()
+        self.assertEqual(0, self.range_requests)
+        store = chunk_store.get_store()
+        self.assertEqual(len(self.content), store.size)
+        manifest = store.load_manifest(
+            standby._manifest_key(self.image_info))
+        self.assertEqual(4, len(manifest.blocks))
+
+        # All the chunks are in the store.
+        self._fetch()
+        self.assertEqual(0, self.range_requests)
+
+        # Only the missing chunk is downloaded.
+        os.unlink(os.path.join(self.store_dir, 'chunks', '{}-{}'.format(
+            manifest.algorithm, manifest.blocks[1])))
+        self._fetch()
+        self.assertEqual(1, self.range_requests)
+        self.assertEqual(manifest.blocks[1], hashlib.sha256(
+            store.get(manifest.algorithm, manifest.blocks[1])).hexdigest())
+
+    @mock.patch.object(standby, '_disk_of', autospec=True,
+                       return_value='sda')
+    def test_store_on_install_device(self, disk_mock, requests_mock):
+        requests_mock.side_effect = self._fake_get
+        self.assertIsNone(standby._chunk_store(['/dev/sda']))
+        self.assertIsNotNone(standby._chunk_store(['/dev/sdb']))
+        self._fetch()
+        self.assertEqual(0, chunk_store.get_store().size)
+
+    @mock.patch.object(standby, '_disk_of', autospec=True,
+                       return_value='sdb')
+    def test_stream_raw_image(self, disk_mock, requests_mock):
+        requests_mock.side_effect = self._fake_get
+        self._fetch()
+        extension = standby.StandbyExtension()
+        device = os.path.join(self.store_dir, 'device')
+        open(device, 'wb').close()
+        with mock.patch.object(standby, '_block_device_size',
+                               autospec=True, return_value=None):
+            extension._stream_raw_image_onto_device(self.image_info, device)
+        self.assertEqual(len(self.content),
+                         extension.image_stats['store_bytes'])
+        self.assertEqual(0, self.range_requests)
+        with open(device, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+
+@mock.patch.object(standby, '_disk_of', autospec=True,
+                   return_value='sdb')
+@mock.patch.object(standby, '_target_devices', autospec=True,
+                   return_value=['/dev/sda'])
+@mock.patch.object(standby, '_fetch_image', autospec=True,
+                   return_value='manifest')
+class TestPrefetch(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.addCleanup(standby._PREFETCHES.clear)
+        self.agent_extension = standby.StandbyExtension()
+        self.image_info = _build_fake_image_info()
+
+    def test_download_prefetched(self, fetch_mock, targets_mock, disk_mock):
+        standby._start_prefetch(self.image_info)
+        self.assertEqual('manifest',
+                         standby._download_image(self.image_info,
+                                                 '/dev/sda'))
+        fetch_mock.assert_called_once_with(self.image_info, '/dev/sda')
+        disk_mock.assert_called_once_with('/tmp/fake_id')
+        self.assertEqual({}, standby._PREFETCHES)
+
+    def test_download_prefetch_failed(self, fetch_mock, targets_mock,
+                                      disk_mock):
+        fetch_mock.side_effect = [
+            errors.ImageDownloadError('fake_id', 'boom'), 'manifest']
+        standby._start_prefetch(self.image_info)
+        self.assertEqual('manifest',
+                         standby._download_image(self.image_info,
+                                                 '/dev/sda'))
+        self.assertEqual(2, fetch_mock.call_count)
+        fetch_mock.assert_called_with(self.image_info, '/dev/sda')
+
+    def test_download_prefetch_other_checksum(self, fetch_mock, targets_mock,
+                                              disk_mock):
+        standby._start_prefetch(dict(self.image_info, checksum='def456'))
+        standby._download_image(self.image_info, '/dev/sda')
+        self.assertEqual(2, fetch_mock.call_count)
+        fetch_mock.assert_called_with(self.image_info, '/dev/sda')
+
+    def test_download_prefetch_on_install_device(self, fetch_mock,
+                                                 targets_mock, disk_mock):
+        disk_mock.return_value = 'sda'
+        standby._start_prefetch(self.image_info)
+        standby._download_image(self.image_info, '/dev/sda')
+        self.assertEqual(2, fetch_mock.call_count)
+
+    def test_prefetch_unknown_device(self, fetch_mock, targets_mock,
+                                     disk_mock):
+        targets_mock.side_effect = errors.DeviceNotFound('no disk')
+        self.config(image_prefetch_max_rate=100)
+        standby._start_prefetch(self.image_info)._thread.join()
+        fetch_mock.assert_called_once_with(
+            dict(self.image_info, download_max_rate=100), None)
+
+    def test_prefetch_image(self, fetch_mock, targets_mock, disk_mock):
+        result = self.agent_extension.prefetch_image(
+            image_info=self.image_info)
+        self.assertEqual({'result': 'prefetching image (fake_id)'},
+                         result.command_result)
+        prefetch = standby._PREFETCHES['fake_id']
+        self.agent_extension.prefetch_image(image_info=self.image_info)
+        self.assertIs(prefetch, standby._PREFETCHES['fake_id'])
+        prefetch._thread.join()
+        fetch_mock.assert_called_once_with(self.image_info, '/dev/sda')
+
+    def test_prefetch_image_compressed(self, fetch_mock, targets_mock,
+                                       disk_mock):
+        self.image_info['disk_format'] = 'gzip'
+        result = self.agent_extension.prefetch_image(
+            image_info=self.image_info)
+        self.assertEqual(
+            {'result': 'image (fake_id) is streamed, not prefetched'},
+            result.command_result)
+        self.assertEqual({}, standby._PREFETCHES)
+
+    def test_prefetch_image_cached(self, fetch_mock, targets_mock,
+                                   disk_mock):
+        self.agent_extension.cached_image_id = 'fake_id'
+        result = self.agent_extension.prefetch_image(
+            image_info=self.image_info)
+        self.assertEqual({'result': 'image (fake_id) already cached'},
+                         result.command_result)
+        self.assertEqual({}, standby._PREFETCHES)
+
+    @mock.patch.object(standby, '_start_prefetch', autospec=True)
+    def test_prefetch_node_image(self, start_mock, fetch_mock, targets_mock,
+                                 disk_mock):
+        node = {
+            'uuid': 'node_uuid',
+            'instance_info': {
+                'image_source': 'glance://images/fake_id',
+                'image_url': 'http://example.org/fake_id',
+                'image_checksum': 'abc123',
+                'image_disk_format': 'raw',
+                'image_os_hash_algo': 'sha512',
+                'image_os_hash_value': 'abc' * 42 + 'ab',
+            },
+        }
+        self.agent_extension.prefetch_node_image(node)
+        start_mock.assert_called_once_with({
+            'id': 'fake_id',
+            'urls': ['http://example.org/fake_id'],
+            'checksum': 'abc123',
+            'node_uuid': 'node_uuid',
+            'disk_format': 'raw',
+            'os_hash_algo': 'sha512',
+            'os_hash_value': 'abc' * 42 + 'ab',
+        })
+
+    @mock.patch.object(standby, '_start_prefetch', autospec=True)
+    def test_prefetch_node_image_invalid(self, start_mock, fetch_mock,
+                                         targets_mock, disk_mock):
+        self.agent_extension.prefetch_node_image({'uuid': 'node_uuid'})
+        self.agent_extension.prefetch_node_image({
+            'uuid': 'node_uuid',
+            'instance_info': {'image_source': 'fake_id',
+                              'image_url': 'http://example.org/fake_id',
+                              'image_checksum': 'abc123',
+                              'image_os_hash_algo': 'crc32',
+                              'image_os_hash_value': 'abc'},
+        })
+        self.assertFalse(start_mock.called)
+
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier', autospec=True,
+                return_value='ROOT')
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby.StandbyExtension,
+                       '_stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_prefetched(self, stream_mock, write_mock,
+                                      id_mock, dispatch_mock, fetch_mock,
+                                      targets_mock, disk_mock):
+        self.image_info['disk_format'] = 'raw'
+        self.image_info['stream_raw_images'] = True
+        standby._start_prefetch(self.image_info)
+        result = self.agent_extension.prepare_image(
+            image_info=self.image_info)
+        result.join()
+        self.assertIsNone(result.command_error)
+        self.assertFalse(stream_mock.called)
+        fetch_mock.assert_called_once_with(self.image_info, '/dev/sda')
+        write_mock.assert_called_once_with(self.image_info, '/dev/sda',
+                                           stats=mock.ANY)
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+
+class TestImageStreamPipeline(base.IronicAgentTest):
+
+    def test_run(self):
+        written = []
+        pipeline = standby._ImageStreamPipeline([b'some', b'content'], 1)
+        stats = pipeline.run(written.append)
+
+        self.assertEqual([b'some', b'content'], written)
+        self.assertEqual(11, stats['bytes'])
+        self.assertIn(stats['bottleneck'], ('network', 'disk'))
+        for stage in ('download', 'write'):
+            self.assertEqual({'seconds', 'stall_seconds', 'bytes_per_second'},
+                             set(stats[stage]))
+
+    def test_run_download_error(self):
+        def chunks():
+            yield b'some'
+            raise errors.ImageDownloadError('fake_id', 'Connection reset')
+
+        written = []
+        pipeline = standby._ImageStreamPipeline(chunks(), 4)
+        self.assertRaisesRegex(errors.ImageDownloadError, 'Connection reset',
+                               pipeline.run, written.append)
+        self.assertEqual([b'some'], written)
+
+    def test_run_write_error_stops_reader(self):
+        closed = []
+
+        def chunks():
+            try:
+                while True:
+                    yield b'chunk'
+            finally:
+                closed.append(True)
+
+        write_mock = mock.Mock(side_effect=IOError('No space left'))
+        pipeline = standby._ImageStreamPipeline(chunks(), 2)
+        self.assertRaises(IOError, pipeline.run, write_mock)
+        write_mock.assert_called_once_with(b'chunk')
+        self.assertEqual([True], closed)
+
+
+@mock.patch.object(standby, 'IMAGE_CHUNK_SIZE', 8192)
+@mock.patch.object(standby, 'IMAGE_MIN_CHUNK_SIZE', 4096)
+@mock.patch.object(standby, 'IMAGE_MAX_CHUNK_SIZE', 16384)
+class TestAlignedImageReader(base.IronicAgentTest):
+
+    def _read(self, download):
+        reader = standby._AlignedImageReader(download, 3)
+        chunks = [bytes(view) for view in reader]
+        for chunk in chunks[:-1]:
+            self.assertEqual(0, len(chunk) % standby.IMAGE_ALIGNMENT)
+        return chunks
+
+    def test_readinto(self):
+        content = os.urandom(40000)
+        stream = io.BytesIO(content)
+        download = mock.Mock(spec=['supports_readinto', 'readinto',
+                                   'wait_hashed'])
+        download.supports_readinto.return_value = True
+        # Return short reads like a socket would
+        download.readinto.side_effect = lambda buf: stream.readinto(buf[:1000])
+
+        chunks = self._read(download)
+        self.assertEqual(content, b''.join(chunks))
+        # Before reusing a buffer the reader waits for its old content to be
+        # hashed.
+        ends = [sum(len(chunk) for chunk in chunks[:i + 1])
+                for i in range(len(chunks))]
+        expected = [mock.call(0)] * 3 + [mock.call(end) for end in ends[:-3]]
+        self.assertEqual(expected, download.wait_hashed.call_args_list)
+
+    def test_chunks(self):
+        content = os.urandom(40000)
+        download = mock.MagicMock(spec=['supports_readinto', '__iter__'])
+        download.supports_readinto.return_value = False
+        download.__iter__.return_value = iter(
+            [content[i:i + 3000] for i in range(0, len(content), 3000)])
+
+        chunks = self._read(download)
+        self.assertEqual(content, b''.join(chunks))
+
+    def test_next_chunk_size(self):
+        # Too slow, halve the chunk size
+        self.assertEqual(4096, standby._next_chunk_size(8192, 1.0))
+        # Fast, double it at most
+        self.assertEqual(16384, standby._next_chunk_size(8192, 0.0001))
+        self.assertEqual(16384, standby._next_chunk_size(16384, 0))
+        # Sizes stay aligned
+        self.assertEqual(8192, standby._next_chunk_size(8192, 0.09))
+
+
+class TestDirectIOWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDirectIOWriter, self).setUp()
+        self.device = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.device.close)
+
+    @mock.patch.object(standby, '_O_DIRECT', 0)
+    def test_write_unaligned_tail(self):
+        aligned = b'a' * 2 * standby.IMAGE_ALIGNMENT
+        with standby._DirectIOWriter(self.device.name) as writer:
+            writer.write(aligned)
+            writer.write(b'tail')
+            self.assertRaises(IOError, writer.write, aligned)
+
+        with open(self.device.name, 'rb') as f:
+            self.assertEqual(aligned + b'tail', f.read())
+
+    @mock.patch.object(standby, '_O_DIRECT', os.O_DSYNC)
+    @mock.patch.object(os, 'open', autospec=True)
+    def test_open_not_supported(self, open_mock):
+        open_mock.side_effect = OSError(errno.EINVAL, 'Invalid argument')
+        self.assertIsNone(standby._DirectIOWriter.open(self.device.name))
+
+    @mock.patch.object(standby, '_O_DIRECT', os.O_DSYNC)
+    @mock.patch.object(os, 'open', autospec=True)
+    def test_open_fails(self, open_mock):
+        open_mock.side_effect = OSError(errno.ENOENT, 'No such device')
+        self.assertRaises(OSError, standby._DirectIOWriter.open,
+                          self.device.name)
+
+
+class TestSparseWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSparseWriter, self).setUp()
+        self.device = tempfile.TemporaryFile()
+        self.addCleanup(self.device.close)
+        self.block = standby.SPARSE_BLOCK_SIZE
+        self.data = os.urandom(self.block)
+        self.content = (self.data + b'\0' * 3 * self.block + self.data
+                        + b'\0' * self.block)
+
+    def _write(self, writer, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            writer.write(self.content[i:i + chunk_size])
+        writer.flush()
+
+    def test_is_zero(self):
+        self.assertTrue(standby._is_zero(b'\0' * 10))
+        self.assertTrue(standby._is_zero(memoryview(b'\0' * 10)))
+        self.assertFalse(standby._is_zero(b'\0' * 9 + b'\1'))
+        self.assertTrue(standby._is_zero(b''))
+        view = memoryview(bytearray(b'\1' + b'\0' * 10))
+        self.assertTrue(standby._is_zero(view[1:]))
+        self.assertFalse(standby._is_zero(view[:5]))
+
+    @mock.patch.object(six, 'PY2', True)
+    def test_is_zero_py2(self):
+        view = memoryview(bytearray(b'\1' + b'\0' * 10))
+        self.assertTrue(standby._is_zero(view[1:]))
+        self.assertFalse(standby._is_zero(view[:5]))
+        self.assertTrue(standby._is_zero(b'\0' * 10))
+
+    def test_release(self):
+        view = mock.Mock(spec=['release'])
+        standby._release(view)
+        view.release.assert_called_once_with()
+        with mock.patch.object(six, 'PY2', True):
+            view = mock.Mock(spec=[])
+            # No AttributeError without memoryview.release().
+            standby._release(view)
+
+    @mock.patch.object(standby, '_discard_zeroes_data', autospec=True)
+    @mock.patch.object(standby, '_range_ioctl', autospec=True)
+    def test_zeroout(self, ioctl_mock, discard_mock):
+        discard_mock.return_value = False
+        ioctl_mock.return_value = True
+        writer = standby._SparseWriter(self.device, '/dev/fake',
+                                       len(self.content))
+        self._write(writer, 2 * self.block)
+
+        self.assertEqual(
+            [mock.call(self.device.fileno(), standby.BLKZEROOUT, self.block,
+                       3 * self.block),
+             mock.call(self.device.fileno(), standby.BLKZEROOUT,
+                       5 * self.block, self.block)],
+            ioctl_mock.call_args_list)
+        self.device.seek(0)
+        self.assertEqual(self.data, self.device.read(self.block))
+        self.device.seek(4 * self.block)
+        self.assertEqual(self.data, self.device.read())
+        self.assertEqual({'skipped_bytes': 4 * self.block,
+                          'skipped_ratio': 4.0 / 6,
+                          'zero_mode': 'zeroout'}, writer.stats)
+
+    @mock.patch.object(standby, '_discard_zeroes_data', autospec=True)
+    @mock.patch.object(standby, '_range_ioctl', autospec=True)
+    def test_discard(self, ioctl_mock, discard_mock):
+        discard_mock.return_value = True
+        ioctl_mock.return_value = True
+        writer = standby._SparseWriter(self.device, '/dev/fake',
+                                       len(self.content))
+        self._write(writer, self.block)
+
+        # Only the upfront discard, zero blocks are skipped entirely.
+        ioctl_mock.assert_called_once_with(self.device.fileno(),
+                                           standby.BLKDISCARD, 0,
+                                           len(self.content))
+        discard_mock.assert_called_once_with('/dev/fake')
+        self.assertEqual('discard', writer.stats['zero_mode'])
+        self.assertEqual(4 * self.block, writer.skipped_bytes)
+
+    @mock.patch.object(standby, '_discard_zeroes_data', autospec=True)
+    def test_unknown_size(self, discard_mock):
+        writer = standby._SparseWriter(self.device, '/dev/fake')
+        self._write(writer, len(self.content))
+
+        self.assertFalse(discard_mock.called)
+        self.assertEqual('zeroout', writer.stats['zero_mode'])
+        self.device.seek(0)
+        self.assertEqual(self.content, self.device.read())
+
+
+class TestVerifyWrittenImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestVerifyWrittenImage, self).setUp()
+        self.range_size = 4 * standby.IMAGE_ALIGNMENT
+        self.content = os.urandom(5 * self.range_size + 100)
+        self.device = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.device.close)
+        self.digester = standby._RangeDigester(self.device.write,
+                                               self.range_size)
+        for i in range(0, len(self.content), 3000):
+            self.digester.write(self.content[i:i + 3000])
+        self.digester.flush()
+        self.device.flush()
+        self.image_info = _build_fake_image_info()
+
+    def test_digests(self):
+        self.assertEqual(len(self.content), self.digester.size)
+        self.assertEqual(
+            [zlib.crc32(self.content[i:i + self.range_size]) & 0xffffffff
+             for i in range(0, len(self.content), self.range_size)],
+            self.digester.digests)
+        with open(self.device.name, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+    def test_verify(self):
+        for workers in (1, 4, 10):
+            stats = standby._verify_written_image(
+                self.image_info, self.device.name, self.digester, workers)
+            self.assertEqual(len(self.content), stats['bytes'])
+            self.assertEqual(min(workers, 6), stats['workers'])
+
+    def test_verify_mismatch(self):
+        with open(self.device.name, 'r+b') as f:
+            f.seek(2 * self.range_size + 10)
+            f.write(b'\0\0')
+        self.assertRaisesRegex(
+            errors.ImageChecksumError,
+            r'bytes 32768-49151 \(1 of 6 ranges differ\)',
+            standby._verify_written_image, self.image_info,
+            self.device.name, self.digester, 3)
+
+    def test_verify_truncated(self):
+        with open(self.device.name, 'r+b') as f:
+            f.truncate(len(self.content) - 1)
+        self.assertRaisesRegex(
+            errors.ImageChecksumError, r'\(1 of 6 ranges differ\)',
+            standby._verify_written_image, self.image_info,
+            self.device.name, self.digester, 2)
+
+    def test_combine(self):
+        digesters = []
+        for start, end in [(0, 2 * self.range_size),
+                           (2 * self.range_size, len(self.content))]:
+            digester = standby._RangeDigester(lambda data: None,
+                                              self.range_size)
+            digester.write(self.content[start:end])
+            digester.flush()
+            digesters.append(digester)
+        combined = standby._RangeDigester.combine(digesters)
+        self.assertEqual(self.digester.digests, combined.digests)
+        self.assertEqual(len(self.content), combined.size)
+
+
+@mock.patch.object(standby, 'VERIFY_RANGE_SIZE', 4 * standby.IMAGE_ALIGNMENT)
+@mock.patch.object(standby, '_queue_attribute', autospec=True)
+class TestRegionWrites(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestRegionWrites, self).setUp()
+        self.range_size = 4 * standby.IMAGE_ALIGNMENT
+        self.content = os.urandom(5 * self.range_size + 100)
+        self.device = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.device.close)
+        self.image_info = dict(_build_fake_image_info(), disk_format='raw')
+        self.image_info['checksum'] = hashlib.md5(self.content).hexdigest()
+        self.config(image_region_writes=True)
+        self.range_requests = []
+
+    def _queue(self, rotational='0', nr_requests='256'):
+        return lambda device, attribute: {
+            'rotational': rotational, 'nr_requests': nr_requests}[attribute]
+
+    def _fake_get(self, url, headers=None, **kwargs):
+        if headers is not None:
+            self.range_requests.append(headers['Range'])
+        return _fake_ranged_get(self.content)(url, headers=headers)
+
+    def test_region_writers(self, queue_mock):
+        size = 40 * self.range_size
+        for rotational, nr_requests, expected in [
+                ('0', '1023', 16), ('0', '64', 2), ('0', '16', 1),
+                ('1', '1023', 1), (None, None, 1), ('0', None, 1)]:
+            queue_mock.side_effect = self._queue(rotational, nr_requests)
+            self.assertEqual(expected, standby._region_writers(
+                self.image_info, '/dev/nvme0n1', size))
+        queue_mock.side_effect = self._queue('0', '1023')
+        self.assertEqual(6, standby._region_writers(
+            self.image_info, '/dev/nvme0n1', len(self.content)))
+        self.config(image_region_max_writers=4)
+        self.assertEqual(4, standby._region_writers(
+            self.image_info, '/dev/nvme0n1', size))
+        self.image_info['region_writes'] = False
+        self.assertEqual(1, standby._region_writers(
+            self.image_info, '/dev/nvme0n1', size))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_regions(self, requests_mock, queue_mock):
+        requests_mock.side_effect = self._fake_get
+        queue_mock.side_effect = self._queue(nr_requests='96')
+        extension = standby.StandbyExtension()
+        extension._stream_raw_image_onto_device(self.image_info,
+                                                self.device.name)
+        with open(self.device.name, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        self.assertEqual(['bytes=0-32767', 'bytes=32768-65535',
+                          'bytes=65536-82019'],
+                         sorted(self.range_requests))
+        stats = extension.image_stats
+        self.assertEqual(3, stats['regions'])
+        self.assertEqual(len(self.content), stats['bytes'])
+        self.assertEqual(len(self.content), stats['verify']['bytes'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_regions_checksum(self, requests_mock,
+                                               queue_mock):
+        requests_mock.side_effect = self._fake_get
+        queue_mock.side_effect = self._queue()
+        self.image_info['checksum'] = 'abc123'
+        extension = standby.StandbyExtension()
+        self.assertRaises(errors.ImageChecksumError,
+                          extension._stream_raw_image_onto_device,
+                          self.image_info, self.device.name)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_regions_no_ranges(self, requests_mock,
+                                                queue_mock):
+        requests_mock.side_effect = _fake_ranged_get(self.content,
+                                                     accept_ranges='none')
+        queue_mock.side_effect = self._queue()
+        extension = standby.StandbyExtension()
+        extension._stream_raw_image_onto_device(self.image_info,
+                                                self.device.name)
+        self.assertNotIn('regions', extension.image_stats)
+        self.assertFalse(queue_mock.called)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_regions_download_error(self, requests_mock, queue_mock):
+        self.config(image_download_retries=0)
+        requests_mock.side_effect = _fake_ranged_get(
+            self.content, truncate_at=3 * self.range_size)
+        image_download = standby.ImageDownload(self.image_info)
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Giving up after 0 retries',
+                               standby._write_regions, self.image_info,
+                               image_download, self.device.name, 2)
+
+    def test_verify_regions_mismatch(self, queue_mock):
+        digester = standby._RangeDigester(self.device.write,
+                                          self.range_size)
+        digester.write(self.content)
+        digester.flush()
+        self.device.seek(self.range_size)
+        self.device.write(b'\0')
+        self.device.flush()
+        self.assertRaisesRegex(
+            errors.ImageChecksumError, r'\(1 of 6 ranges differ\)',
+            standby._verify_regions, self.image_info, self.device.name,
+            digester)
+
+
+class _ImageRequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the image of the server, with range support."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        content = self.server.content
+        start = 0
+        self.server.ranges.append(self.headers.get('Range'))
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        cut_at = self.server.cut_at
+        if cut_at is not None and start < cut_at:
+            # Drop the connection in the middle of the image.
+            self.server.cut_at = None
+            self.wfile.write(content[start:cut_at])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class _ImageServer(six.moves.socketserver.ThreadingMixIn,
+                   six.moves.BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestSpliceImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSpliceImage, self).setUp()
+        if not splice.available():
+            self.skipTest('splice is not available')
+        self.content = os.urandom(3 * standby.SPLICE_PIPE_SIZE + 123)
+        self.server = _ImageServer(('127.0.0.1', 0), _ImageRequestHandler)
+        self.server.content = self.content
+        self.server.cut_at = None
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.image_info = dict(_build_fake_image_info(), disk_format='raw',
+                               stream_splice=True, no_proxy='127.0.0.1')
+        self.image_info['urls'] = ['http://127.0.0.1:{}/image'.format(
+            self.server.server_address[1])]
+        self.image_info['checksum'] = hashlib.md5(self.content).hexdigest()
+        self.device = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.device.close)
+        self.extension = standby.StandbyExtension()
+
+    def _stream(self):
+        self.extension._stream_raw_image_onto_device(self.image_info,
+                                                     self.device.name)
+        with open(self.device.name, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        return self.extension.image_stats
+
+    def test_splice_image(self):
+        stats = self._stream()
+        self.assertTrue(stats['splice'])
+        self.assertEqual(len(self.content), stats['bytes'])
+        self.assertEqual([None], self.server.ranges)
+
+    def test_splice_image_resumed(self):
+        self.server.cut_at = standby.SPLICE_PIPE_SIZE + 1000
+        stats = self._stream()
+        self.assertTrue(stats['splice'])
+        self.assertEqual(
+            [None, 'bytes={}-'.format(standby.SPLICE_PIPE_SIZE + 1000)],
+            self.server.ranges)
+
+    def test_splice_image_verify_writes(self):
+        self.image_info['verify_writes'] = True
+        stats = self._stream()
+        self.assertEqual(len(self.content), stats['verify']['bytes'])
+
+    def test_splice_image_checksum_mismatch(self):
+        self.image_info['checksum'] = 'abc123'
+        self.assertRaises(errors.ImageChecksumError,
+                          self.extension._stream_raw_image_onto_device,
+                          self.image_info, self.device.name)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_not_spliced(self, requests_mock):
+        requests_mock.side_effect = _fake_ranged_get(self.content)
+        stats = self._stream()
+        self.assertNotIn('splice', stats)
+
+    def test_response_socket(self):
+        response = requests.get(self.image_info['urls'][0], stream=True)
+        self.addCleanup(response.close)
+        reader, sock = standby._response_socket(response)
+        self.assertIsInstance(sock, socket.socket)
+        response.headers['Content-Encoding'] = 'gzip'
+        self.assertIsNone(standby._response_socket(response))
+        self.assertIsNone(standby._response_socket(mock.Mock()))
+
+
+class TestQcow2DeviceWriter(base.IronicAgentTest):
+
+    def _convert(self, image, chunk_size):
+        header, clusters = test_qcow2.read_clusters(image)
+        device = tempfile.TemporaryFile()
+        self.addCleanup(device.close)
+        writer = standby._Qcow2DeviceWriter(header, clusters,
+                                            device.fileno())
+        for i in range(0, len(image), chunk_size):
+            writer.write(image[i:i + chunk_size])
+        writer.close()
+        for offset, length in standby._holes(clusters, header.virtual_size):
+            standby._zero_range(device.fileno(), offset, length)
+        device.seek(0)
+        return device.read()
+
+    def test_write(self):
+        image, raw = test_qcow2.build_image()
+        for chunk_size in (7, 512, 1000, len(image)):
+            self.assertEqual(raw, self._convert(image, chunk_size))
+
+    def test_write_truncated(self):
+        image, raw = test_qcow2.build_image()
+        self.assertRaisesRegex(errors.ImageFormatError, 'truncated',
+                               self._convert,
+                               image[:4 * test_qcow2.CLUSTER_SIZE], 512)
+
+    def test_holes(self):
+        clusters = [qcow2.Cluster(1024, 512, 0, 512, qcow2.DATA),
+                    qcow2.Cluster(0, 512, 512, 512, qcow2.DATA)]
+        self.assertEqual([(512, 512), (1536, 512)],
+                         standby._holes(clusters, 2048))
+        self.assertEqual([(512, 512)], standby._holes(clusters, 1536))
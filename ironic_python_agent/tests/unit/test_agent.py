@@ -217,6 +217,47 @@ class TestBaseAgent(ironic_agent_base.IronicAgentTest):
                          mock_dispatch.call_args_list)
         self.agent.heartbeater.start.assert_called_once_with()
 
+    @mock.patch.object(agent.IronicPythonAgent, 'get_extension',
+                       autospec=True)
+    @mock.patch.object(hardware, '_check_for_iscsi', mock.Mock())
+    @mock.patch(
+        'ironic_python_agent.hardware_managers.cna._detect_cna_card',
+        mock.Mock())
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    @mock.patch.object(agent.IronicPythonAgent,
+                       '_wait_for_interface', autospec=True)
+    @mock.patch('wsgiref.simple_server.WSGIServer', autospec=True)
+    @mock.patch.object(hardware, 'load_managers', autospec=True)
+    def test_run_image_prefetch(self, mock_load_managers, mock_wsgi,
+                                mock_wait, mock_dispatch, mock_get_ext):
+        CONF.set_override('inspection_callback_url', '')
+        self.config(image_prefetch=True)
+
+        wsgi_server = mock_wsgi.return_value
+
+        def set_serve_api():
+            self.agent.serve_api = False
+
+        wsgi_server.handle_request.side_effect = set_serve_api
+        self.agent.heartbeater = mock.Mock()
+        node = {
+            'uuid': 'deadbeef-dabb-ad00-b105-f00d00bab10c',
+            'instance_info': {'image_source': 'fake_id'},
+        }
+        self.agent.api_client.lookup_node = mock.Mock()
+        self.agent.api_client.lookup_node.return_value = {
+            'node': node,
+            'config': {
+                'heartbeat_timeout': 300
+            }
+        }
+
+        self.agent.run()
+
+        mock_get_ext.assert_called_once_with(self.agent, 'standby')
+        mock_get_ext.return_value.prefetch_node_image.assert_called_once_with(
+            node)
+
     @mock.patch.object(hardware, '_check_for_iscsi', mock.Mock())
     @mock.patch(
         'ironic_python_agent.hardware_managers.cna._detect_cna_card',
@@ -312,3 +312,71 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         self.assertEqual(200, response.status_code)
         data = response.json
         self.assertEqual(serialized_cmd_result, data)
+
+    def test_get_command_result_progress(self):
+        cmd_result = base.AsyncCommandResult('prepare_image', {},
+                                             mock.Mock(),
+                                             track_progress=True)
+        cmd_result.progress.stage = 'stream'
+        cmd_result.progress.start_download(100)
+        cmd_result.progress.downloaded_bytes = 42
+        self.mock_agent.get_command_result.return_value = cmd_result
+
+        response = self.get_json('/commands/abc123')
+        self.assertEqual(200, response.status_code)
+        data = response.json
+        self.assertEqual('RUNNING', data['command_status'])
+        snapshot = data['command_result']['progress']
+        self.assertEqual('stream', snapshot['stage'])
+        self.assertEqual(100, snapshot['total_bytes'])
+        self.assertEqual(42, snapshot['downloaded_bytes'])
+
+    def test_get_image_chunk(self):
+        self.cfg_fixture.config(image_peer_sharing=True)
+        extension = self.mock_agent.get_extension.return_value
+        extension.shared_images.available.return_value = 5
+        extension.shared_images.read_chunk.return_value = b'chunk'
+
+        response = self.app.get(PATH_PREFIX + '/images/fake-id/3')
+        self.mock_agent.get_extension.assert_called_once_with('standby')
+        extension.shared_images.read_chunk.assert_called_once_with(
+            'fake-id', 3)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'chunk', response.body)
+        self.assertEqual('application/octet-stream', response.content_type)
+        self.assertEqual('5', response.headers['X-Available-Chunks'])
+
+    def test_get_image_chunk_not_held(self):
+        self.cfg_fixture.config(image_peer_sharing=True)
+        extension = self.mock_agent.get_extension.return_value
+        extension.shared_images.available.return_value = 2
+        extension.shared_images.read_chunk.return_value = None
+
+        response = self.app.get(PATH_PREFIX + '/images/fake-id/3',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
+        self.assertEqual('2', response.headers['X-Available-Chunks'])
+
+    def test_get_image_chunk_not_shared(self):
+        self.cfg_fixture.config(image_peer_sharing=True)
+        extension = self.mock_agent.get_extension.return_value
+        extension.shared_images.available.return_value = None
+        extension.shared_images.read_chunk.return_value = None
+
+        response = self.app.get(PATH_PREFIX + '/images/fake-id/3',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
+        self.assertNotIn('X-Available-Chunks', response.headers)
+
+    def test_get_image_chunk_invalid_index(self):
+        self.cfg_fixture.config(image_peer_sharing=True)
+        response = self.app.get(PATH_PREFIX + '/images/fake-id/first',
+                                expect_errors=True)
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(self.mock_agent.get_extension.called)
+
+    def test_get_image_chunk_sharing_disabled(self):
+        response = self.app.get(PATH_PREFIX + '/images/fake-id/3',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(self.mock_agent.get_extension.called)
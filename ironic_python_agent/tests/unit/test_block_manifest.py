@@ -0,0 +1,102 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+
+from ironic_python_agent import block_manifest
+from ironic_python_agent import errors
+from ironic_python_agent.tests.unit import base
+
+BLOCK_SIZE = 1024
+
+
+def build_manifest(image, block_size=BLOCK_SIZE, algorithm='sha256'):
+    """Build the block-hash manifest of an image, as a JSON document."""
+    blocks = [getattr(hashlib, algorithm)(image[i:i + block_size])
+              .hexdigest() for i in range(0, len(image), block_size)]
+    return json.dumps({'size': len(image), 'block_size': block_size,
+                       'algorithm': algorithm, 'blocks': blocks})
+
+
+class TestManifest(base.IronicAgentTest):
+
+    def test_parse(self):
+        image = b'a' * BLOCK_SIZE + b'b' * 100
+        manifest = block_manifest.Manifest(
+            build_manifest(image).encode('utf-8'))
+        self.assertEqual(len(image), manifest.size)
+        self.assertEqual(BLOCK_SIZE, manifest.block_size)
+        self.assertEqual(2, manifest.block_count)
+        self.assertEqual((0, BLOCK_SIZE), manifest.block_range(0))
+        self.assertEqual((BLOCK_SIZE, 100), manifest.block_range(1))
+        self.assertTrue(manifest.matches(0, image[:BLOCK_SIZE]))
+        self.assertTrue(manifest.matches(1, image[BLOCK_SIZE:]))
+        self.assertFalse(manifest.matches(1, image[:100]))
+
+    def test_parse_invalid(self):
+        valid = json.loads(build_manifest(b'a' * 2 * BLOCK_SIZE))
+        for changes, msg in [({'size': 0}, 'size'),
+                             ({'size': 'big'}, 'size'),
+                             ({'block_size': 1000}, 'multiple of 512'),
+                             ({'algorithm': 'crc32'}, 'algorithm'),
+                             ({'blocks': ['00']}, 'has 1 blocks, '
+                                                  'expected 2'),
+                             ({'blocks': None}, 'Invalid block manifest')]:
+            manifest = dict(valid, **changes)
+            self.assertRaisesRegex(errors.ImageFormatError, msg,
+                                   block_manifest.Manifest,
+                                   json.dumps(manifest))
+        self.assertRaisesRegex(errors.ImageFormatError,
+                               'Invalid block manifest',
+                               block_manifest.Manifest, 'not json')
+        del valid['algorithm']
+        self.assertRaisesRegex(errors.ImageFormatError,
+                               'Invalid block manifest',
+                               block_manifest.Manifest, json.dumps(valid))
+
+    def test_ranges(self):
+        manifest = block_manifest.Manifest(
+            build_manifest(b'a' * (6 * BLOCK_SIZE + 100)))
+        self.assertEqual(
+            [(0, 2 * BLOCK_SIZE), (2 * BLOCK_SIZE, BLOCK_SIZE),
+             (4 * BLOCK_SIZE, 2 * BLOCK_SIZE + 100)],
+            manifest.ranges([0, 1, 2, 4, 5, 6], 2 * BLOCK_SIZE + 100))
+        self.assertEqual([], manifest.ranges([], BLOCK_SIZE))
+
+    def test_to_json(self):
+        image = b'a' * BLOCK_SIZE + b'b' * 100
+        manifest = block_manifest.Manifest(build_manifest(image))
+        self.assertEqual(json.loads(build_manifest(image)),
+                         json.loads(manifest.to_json()))
+
+
+class TestBuilder(base.IronicAgentTest):
+
+    def test_build(self):
+        image = b'a' * BLOCK_SIZE + b'b' * BLOCK_SIZE + b'c' * 100
+        builder = block_manifest.Builder(BLOCK_SIZE)
+        blocks = builder.update(image[:100])
+        self.assertEqual([], blocks)
+        blocks = builder.update(memoryview(image[100:]))
+        self.assertEqual([image[:BLOCK_SIZE],
+                          image[BLOCK_SIZE:2 * BLOCK_SIZE]],
+                         [block for digest, block in blocks])
+        last_blocks, manifest = builder.finish()
+        self.assertEqual([(hashlib.sha256(b'c' * 100).hexdigest(),
+                           b'c' * 100)], last_blocks)
+        self.assertEqual(json.loads(build_manifest(image)),
+                         json.loads(manifest.to_json()))
+
+    def test_build_empty(self):
+        builder = block_manifest.Builder(BLOCK_SIZE)
+        self.assertEqual(([], None), builder.finish())
@@ -0,0 +1,110 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from ironic_python_agent import block_manifest
+from ironic_python_agent import chunk_store
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent.tests.unit import test_block_manifest
+
+
+class TestChunkStore(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestChunkStore, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.store = chunk_store.ChunkStore(self.path, 3000)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.path, 'chunks', 'sha256-' + digest)
+
+    def test_put_get(self):
+        self.assertIsNone(self.store.get('sha256', 'aa'))
+        self.store.put('sha256', 'aa', b'a' * 1000)
+        self.store.put('sha256', 'aa', b'a' * 1000)
+        self.assertEqual(b'a' * 1000, self.store.get('sha256', 'aa'))
+        self.assertEqual(1000, self.store.size)
+        self.assertEqual(1000, chunk_store.ChunkStore(self.path, 3000).size)
+
+    def test_put_too_large(self):
+        self.store.put('sha256', 'aa', b'a' * 3001)
+        self.assertIsNone(self.store.get('sha256', 'aa'))
+        self.assertEqual(0, self.store.size)
+
+    def test_evict_least_recently_used(self):
+        for index, digest in enumerate(['aa', 'bb', 'cc']):
+            self.store.put('sha256', digest, b'x' * 1000)
+            os.utime(self._chunk_path(digest), (index, index))
+        # Reading a chunk makes it the most recently used.
+        self.store.get('sha256', 'aa')
+        self.store.put('sha256', 'dd', b'x' * 1500)
+        self.assertIsNotNone(self.store.get('sha256', 'aa'))
+        self.assertIsNone(self.store.get('sha256', 'bb'))
+        self.assertIsNone(self.store.get('sha256', 'cc'))
+        self.assertIsNotNone(self.store.get('sha256', 'dd'))
+        self.assertEqual(2500, self.store.size)
+
+    def test_put_error(self):
+        shutil.rmtree(os.path.join(self.path, 'chunks'))
+        self.store.put('sha256', 'aa', b'a' * 1000)
+        self.assertIsNone(self.store.get('sha256', 'aa'))
+        self.assertEqual(0, self.store.size)
+
+    def test_leftover_temporary_files(self):
+        with open(self._chunk_path('aa') + '.1.tmp', 'wb') as f:
+            f.write(b'a' * 100)
+        self.assertEqual(0, chunk_store.ChunkStore(self.path, 3000).size)
+        self.assertEqual([], os.listdir(os.path.join(self.path, 'chunks')))
+
+    def test_manifest(self):
+        manifest = block_manifest.Manifest(
+            test_block_manifest.build_manifest(b'a' * 3000))
+        self.assertIsNone(self.store.load_manifest('key'))
+        self.store.save_manifest('key', manifest)
+        self.assertEqual(manifest.to_json(),
+                         self.store.load_manifest('key').to_json())
+
+    def test_manifest_invalid(self):
+        with open(os.path.join(self.path, 'manifests', 'key'), 'w') as f:
+            f.write('not json')
+        self.assertIsNone(self.store.load_manifest('key'))
+
+
+class TestGetStore(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestGetStore, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.addCleanup(chunk_store._STORES.clear)
+
+    def test_get_store(self):
+        self.assertIsNone(chunk_store.get_store())
+        self.config(image_chunk_store_dir=self.path,
+                    image_chunk_store_max_size=2)
+        store = chunk_store.get_store()
+        self.assertEqual(self.path, store.path)
+        self.assertEqual(2 * 1024 * 1024, store.max_size)
+        self.config(image_chunk_store_max_size=3)
+        self.assertIs(store, chunk_store.get_store())
+        self.assertEqual(3 * 1024 * 1024, store.max_size)
+
+    def test_get_store_error(self):
+        path = os.path.join(self.path, 'file')
+        with open(path, 'w'):
+            pass
+        self.config(image_chunk_store_dir=path)
+        self.assertIsNone(chunk_store.get_store())
@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import zlib
+
+import mock
+import testtools
+
+from ironic_python_agent import compression
+from ironic_python_agent import errors
+from ironic_python_agent.tests.unit import base
+
+CHUNK_SIZE = 4096
+# Compresses well, so that decompressed chunks have to be bounded.
+DATA = os.urandom(1000) + b'\0' * (20 * CHUNK_SIZE) + os.urandom(1000)
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestCompression(base.IronicAgentTest):
+
+    def _test_decompress(self, algorithm, compressed, expected=DATA):
+        for size in (1, 100, len(compressed)):
+            chunks = list(compression.decompress(split(compressed, size),
+                                                 algorithm, CHUNK_SIZE))
+            self.assertEqual(expected, b''.join(chunks))
+            self.assertLessEqual(max(len(chunk) for chunk in chunks),
+                                 CHUNK_SIZE)
+
+    def test_detect(self):
+        self.assertEqual(compression.GZIP,
+                         compression.detect(gzip_compress(b'data')))
+        self.assertEqual(compression.XZ,
+                         compression.detect(b'\xfd7zXZ\x00\x00'))
+        self.assertEqual(compression.ZSTD,
+                         compression.detect(b'\x28\xb5\x2f\xfd\x00'))
+        self.assertIsNone(compression.detect(b'\xfa\x31\xc0'))
+        self.assertIsNone(compression.detect(b''))
+
+    def test_gunzip(self):
+        self._test_decompress(compression.GZIP, gzip_compress(DATA))
+
+    def test_gunzip_multiple_members(self):
+        self._test_decompress(compression.GZIP,
+                              gzip_compress(DATA) + gzip_compress(b'more'),
+                              DATA + b'more')
+
+    def test_gunzip_truncated(self):
+        compressed = gzip_compress(DATA)[:-10]
+        self.assertRaisesRegex(
+            errors.ImageFormatError, 'truncated', list,
+            compression.decompress([compressed], compression.GZIP,
+                                   CHUNK_SIZE))
+
+    def test_gunzip_invalid(self):
+        self.assertRaisesRegex(
+            errors.ImageFormatError, 'Invalid gzip compressed image', list,
+            compression.decompress([b'\x1f\x8bnot gzip data'],
+                                   compression.GZIP, CHUNK_SIZE))
+
+    @testtools.skipIf(compression.lzma is None, 'lzma is not available')
+    def test_unxz(self):
+        compressed = compression.lzma.compress(DATA)
+        self._test_decompress(compression.XZ, compressed)
+        self._test_decompress(compression.XZ,
+                              compressed + compression.lzma.compress(b'more'),
+                              DATA + b'more')
+        self.assertRaisesRegex(
+            errors.ImageFormatError, 'truncated', list,
+            compression.decompress([compressed[:-10]], compression.XZ,
+                                   CHUNK_SIZE))
+
+    @testtools.skipIf(compression.zstandard is None,
+                      'zstandard is not installed')
+    def test_unzstd(self):
+        compressor = compression.zstandard.ZstdCompressor()
+        self._test_decompress(compression.ZSTD, compressor.compress(DATA))
+
+    @mock.patch.object(compression, 'zstandard', None)
+    @mock.patch.object(compression, 'lzma', None)
+    def test_missing_module(self):
+        for algorithm, name in [(compression.XZ, 'lzma module'),
+                                (compression.ZSTD, 'zstandard package')]:
+            self.assertRaisesRegex(
+                errors.ImageFormatError, name, list,
+                compression.decompress([b'data'], algorithm, CHUNK_SIZE))
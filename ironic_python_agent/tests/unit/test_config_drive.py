@@ -0,0 +1,198 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import gzip
+import io
+import os
+import tempfile
+
+from ironic_lib import disk_utils
+from ironic_lib import exception
+from ironic_lib import utils as il_utils
+import mock
+
+from ironic_python_agent import config_drive
+from ironic_python_agent.tests.unit import base
+
+ISO = os.urandom(3000) + b'\0' * 5000
+
+
+def _encode(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    encoded = base64.b64encode(out.getvalue()).decode('ascii')
+    # Line-wrapped, like the output of base64(1).
+    return '\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+
+class TestDecode(base.IronicAgentTest):
+
+    def test_base64(self):
+        content = _encode(ISO)
+        # Small chunks split the groups of base64 characters and the lines.
+        chunks = config_drive.text_chunks(content, chunk_size=103)
+        self.assertEqual(ISO, b''.join(config_drive.decode(chunks, 'node')))
+
+    def test_base64_bytes(self):
+        content = _encode(ISO).encode('ascii')
+        self.assertEqual(ISO, b''.join(config_drive.decode([content],
+                                                           'node')))
+
+    def test_binary(self):
+        chunks = [ISO[:1000], ISO[1000:]]
+        self.assertEqual(ISO, b''.join(config_drive.decode(chunks, 'node')))
+
+    def test_bounded_chunks(self):
+        content = _encode(b'\0' * (3 * config_drive.CHUNK_SIZE))
+        chunks = list(config_drive.decode([content], 'node'))
+        self.assertEqual(3 * config_drive.CHUNK_SIZE,
+                         sum(len(chunk) for chunk in chunks))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks),
+                             config_drive.CHUNK_SIZE)
+
+    def test_malformed(self):
+        for content in [_encode(ISO)[:-10], _encode(ISO) + 'A',
+                        base64.b64encode(ISO).decode('ascii'), '']:
+            self.assertRaisesRegex(exception.InstanceDeployFailure,
+                                   'not base64 encoded or the content is '
+                                   'malformed', b''.join,
+                                   config_drive.decode([content], 'node'))
+
+
+@mock.patch.object(disk_utils, 'fix_gpt_partition', autospec=True)
+@mock.patch.object(config_drive, '_labelled_partition', autospec=True)
+class TestWritePartition(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestWritePartition, self).setUp()
+        fd, self.partition = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.partition)
+
+    def _read_partition(self):
+        with open(self.partition, 'rb') as f:
+            return f.read()
+
+    def test_existing_partition(self, labelled_mock, fix_gpt_mock):
+        labelled_mock.return_value = self.partition
+        config_drive.write_partition(
+            'node', '/dev/sda', config_drive.text_chunks(_encode(ISO)))
+        self.assertEqual(ISO, self._read_partition())
+        labelled_mock.assert_called_once_with('/dev/sda', 'config-2',
+                                              'node')
+        fix_gpt_mock.assert_called_once_with('/dev/sda', 'node')
+
+    @mock.patch.object(config_drive, '_partition_path', autospec=True)
+    @mock.patch.object(disk_utils, 'list_partitions', autospec=True)
+    @mock.patch.object(il_utils, 'execute', autospec=True)
+    def test_new_gpt_partition(self, execute_mock, list_mock, path_mock,
+                               labelled_mock, fix_gpt_mock):
+        labelled_mock.return_value = None
+        list_mock.side_effect = [[{'number': 1}],
+                                 [{'number': 1}, {'number': 2}]]
+        execute_mock.side_effect = [('gpt\n', ''), ('', ''), ('', ''),
+                                    ('', ''), ('', '')]
+        path_mock.return_value = self.partition
+
+        config_drive.write_partition('node', '/dev/sda', [ISO])
+
+        self.assertEqual(ISO, self._read_partition())
+        execute_mock.assert_has_calls([
+            mock.call('blkid', '-p', '-o', 'value', '-s', 'PTTYPE',
+                      '/dev/sda', use_standard_locale=True,
+                      run_as_root=True),
+            mock.call('sgdisk', '-n', '0:-64MB:0', '/dev/sda',
+                      run_as_root=True),
+            mock.call('partprobe', '/dev/sda', run_as_root=True,
+                      attempts=10, delay_on_retry=True),
+            mock.call('udevadm', 'settle'),
+            mock.call('test', '-e', self.partition, attempts=15,
+                      delay_on_retry=True)])
+        path_mock.assert_called_once_with('/dev/sda', 2)
+
+    @mock.patch.object(disk_utils, 'count_mbr_partitions', autospec=True)
+    @mock.patch.object(disk_utils, 'list_partitions', autospec=True)
+    @mock.patch.object(il_utils, 'execute', autospec=True)
+    def test_new_mbr_partition_large_disk(self, execute_mock, list_mock,
+                                          count_mock, labelled_mock,
+                                          fix_gpt_mock):
+        labelled_mock.return_value = None
+        list_mock.side_effect = [[], [{'number': 1}]]
+        count_mock.return_value = (0, 0)
+        execute_mock.side_effect = [('dos\n', ''),
+                                    ('%d\n' % (3 * 1024 ** 4), ''),
+                                    ('', ''), ('', ''), ('', ''), ('', '')]
+
+        self.assertEqual('/dev/nvme0n1p1', config_drive._create_partition(
+            'node', '/dev/nvme0n1'))
+        execute_mock.assert_any_call(
+            'parted', '-a', 'optimal', '-s', '--', '/dev/nvme0n1', 'mkpart',
+            'primary', 'fat32', disk_utils.MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR
+            - 65, disk_utils.MAX_DISK_SIZE_MB_SUPPORTED_BY_MBR - 1,
+            run_as_root=True)
+
+    @mock.patch.object(il_utils, 'execute', autospec=True)
+    def test_malformed_before_partitioning(self, execute_mock,
+                                           labelled_mock, fix_gpt_mock):
+        self.assertRaises(exception.InstanceDeployFailure,
+                          config_drive.write_partition, 'node', '/dev/sda',
+                          [base64.b64encode(b'not gzip').decode('ascii')])
+        self.assertFalse(labelled_mock.called)
+        self.assertFalse(execute_mock.called)
+
+    @mock.patch.object(config_drive, 'MAX_SIZE', 4096)
+    def test_too_large(self, labelled_mock, fix_gpt_mock):
+        labelled_mock.return_value = self.partition
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               'exceeds maximum limit',
+                               config_drive.write_partition, 'node',
+                               '/dev/sda', [ISO[:4096], ISO[4096:]])
+
+    def test_write_error(self, labelled_mock, fix_gpt_mock):
+        labelled_mock.return_value = os.path.join(self.partition, 'missing')
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               'Failed to create config drive on disk '
+                               '/dev/sda', config_drive.write_partition,
+                               'node', '/dev/sda', [ISO])
+
+
+@mock.patch.object(il_utils, 'execute', autospec=True)
+class TestLabelledPartition(base.IronicAgentTest):
+
+    def test_found(self, execute_mock):
+        execute_mock.side_effect = [
+            ('', ''), ('', ''),
+            ('NAME="sda" LABEL=""\nNAME="sda1" LABEL="root"\n'
+             'NAME="sda2" LABEL="config-2"\n', '')]
+        self.assertEqual('/dev/sda2', config_drive._labelled_partition(
+            '/dev/sda', 'config-2', 'node'))
+        execute_mock.assert_called_with(
+            'lsblk', '-Po', 'name,label', '/dev/sda', check_exit_code=[0, 1],
+            use_standard_locale=True, run_as_root=True)
+
+    def test_not_found(self, execute_mock):
+        execute_mock.side_effect = [('', ''), ('', ''),
+                                    ('NAME="sda" LABEL=""\n', '')]
+        self.assertIsNone(config_drive._labelled_partition(
+            '/dev/sda', 'config-2', 'node'))
+
+    def test_several(self, execute_mock):
+        execute_mock.side_effect = [
+            ('', ''), ('', ''),
+            ('NAME="sda1" LABEL="config-2"\n'
+             'NAME="sda2" LABEL="config-2"\n', '')]
+        self.assertRaisesRegex(exception.InstanceDeployFailure,
+                               '/dev/sda1 and /dev/sda2',
+                               config_drive._labelled_partition,
+                               '/dev/sda', 'config-2', 'node')
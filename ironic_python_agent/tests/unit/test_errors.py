@@ -124,6 +124,9 @@ class TestErrors(base.IronicAgentTest):
                  (errors.IncompatibleHardwareMethodError(), DEFAULT_DETAILS),
                  (errors.IncompatibleHardwareMethodError(DETAILS),
                   SAME_DETAILS),
+                 (errors.ImageFormatError(DETAILS), SAME_DETAILS),
+                 (errors.ImageStagingError('image_id', DETAILS),
+                  DIFF_CL_DETAILS),
                  ]
         for (obj, check_details) in cases:
             self._test_class(obj, check_details)
@@ -0,0 +1,177 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import os
+import shutil
+import tempfile
+
+from ironic_lib import disk_utils
+import mock
+from oslo_concurrency import processutils
+
+from ironic_python_agent import kexec
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import utils
+
+
+class TestFindBootEntry(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestFindBootEntry, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def _write(self, path, content=''):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_bls_entry(self):
+        kernel = self._write('boot/vmlinuz-5.14.0-162.el9.x86_64')
+        initrd = self._write('boot/initramfs-5.14.0-162.el9.x86_64.img')
+        self._write('boot/vmlinuz-5.14.0-70.el9.x86_64')
+        self._write('boot/loader/entries/abc-5.14.0-70.el9.x86_64.conf',
+                    'linux /boot/vmlinuz-5.14.0-70.el9.x86_64\n'
+                    'options root=UUID=old ro\n')
+        self._write('boot/loader/entries/abc-5.14.0-162.el9.x86_64.conf',
+                    'title Linux\n'
+                    'linux /vmlinuz-5.14.0-162.el9.x86_64\n'
+                    'initrd /initramfs-5.14.0-162.el9.x86_64.img\n'
+                    'options root=UUID=1234 ro quiet\n')
+        self.assertEqual((kernel, initrd, 'root=UUID=1234 ro quiet'),
+                         kexec.find_boot_entry(self.root))
+
+    def test_bls_entry_grub_variables(self):
+        kernel = self._write('boot/vmlinuz-4.18.0')
+        self._write('boot/loader/entries/abc-4.18.0.conf',
+                    'linux /vmlinuz-4.18.0\n'
+                    'options $kernelopts\n')
+        self._write('etc/kernel/cmdline', 'root=UUID=1234 ro\n')
+        self.assertEqual((kernel, None, 'root=UUID=1234 ro'),
+                         kexec.find_boot_entry(self.root))
+
+    def test_linked_entry(self):
+        kernel = self._write('boot/vmlinuz-5.10.0-19-amd64')
+        initrd = self._write('boot/initrd.img-5.10.0-19-amd64')
+        os.symlink('boot/vmlinuz-5.10.0-19-amd64',
+                   os.path.join(self.root, 'vmlinuz'))
+        os.symlink('/boot/initrd.img-5.10.0-19-amd64',
+                   os.path.join(self.root, 'initrd.img'))
+        self._write('boot/grub/grub.cfg',
+                    'menuentry "Debian" {\n'
+                    '\tlinux\t/boot/vmlinuz-5.10.0-19-amd64 root=UUID=1234 '
+                    'ro quiet\n'
+                    '\tinitrd\t/boot/initrd.img-5.10.0-19-amd64\n'
+                    '}\n')
+        self.assertEqual((kernel, initrd, 'root=UUID=1234 ro quiet'),
+                         kexec.find_boot_entry(self.root))
+
+    def test_versioned_entry(self):
+        self._write('boot/vmlinuz-3.10.0-957.el7.x86_64')
+        kernel = self._write('boot/vmlinuz-3.10.0-1160.el7.x86_64')
+        initrd = self._write('boot/initramfs-3.10.0-1160.el7.x86_64.img')
+        self._write('boot/vmlinuz-0-rescue-abc')
+        self.assertEqual((kernel, initrd, None),
+                         kexec.find_boot_entry(self.root))
+
+    def test_no_kernel(self):
+        self._write('etc/fstab')
+        self.assertIsNone(kexec.find_boot_entry(self.root))
+
+
+@mock.patch.object(utils, 'execute', autospec=True)
+class TestLoad(base.IronicAgentTest):
+
+    @mock.patch.object(kexec, 'find_boot_entry', autospec=True)
+    def test_load(self, find_mock, execute_mock):
+        find_mock.side_effect = [None, ('/mnt/boot/vmlinuz',
+                                        '/mnt/boot/initrd.img',
+                                        'root=UUID=1234 ro')]
+        self.assertTrue(kexec.load(['/dev/sda1', '/dev/sda2', '/dev/sda3']))
+        self.assertEqual(2, find_mock.call_count)
+        execute_mock.assert_has_calls([
+            mock.call('mount', '-o', 'ro', '/dev/sda1', mock.ANY),
+            mock.call('umount', mock.ANY),
+            mock.call('mount', '-o', 'ro', '/dev/sda2', mock.ANY),
+            mock.call('kexec', '--load', '/mnt/boot/vmlinuz',
+                      '--command-line=root=UUID=1234 ro',
+                      '--initrd=/mnt/boot/initrd.img'),
+            mock.call('umount', mock.ANY)])
+        self.assertEqual(5, execute_mock.call_count)
+
+    @mock.patch.object(disk_utils, 'block_uuid', autospec=True,
+                       return_value='1234')
+    @mock.patch.object(kexec, 'find_boot_entry', autospec=True)
+    def test_load_default_cmdline(self, find_mock, uuid_mock, execute_mock):
+        def find_boot_entry(root):
+            os.mkdir(os.path.join(root, 'etc'))
+            return '/mnt/vmlinuz', None, None
+
+        find_mock.side_effect = find_boot_entry
+        self.assertTrue(kexec.load(['/dev/sda1']))
+        execute_mock.assert_any_call('kexec', '--load', '/mnt/vmlinuz',
+                                     '--command-line=root=UUID=1234 ro')
+        uuid_mock.assert_called_once_with('/dev/sda1')
+
+    @mock.patch.object(kexec, 'find_boot_entry', autospec=True)
+    def test_load_no_cmdline(self, find_mock, execute_mock):
+        find_mock.return_value = ('/mnt/vmlinuz', None, None)
+        self.assertFalse(kexec.load(['/dev/sda1']))
+        execute_mock.assert_has_calls([
+            mock.call('mount', '-o', 'ro', '/dev/sda1', mock.ANY),
+            mock.call('umount', mock.ANY)])
+        self.assertEqual(2, execute_mock.call_count)
+
+    @mock.patch.object(kexec, 'find_boot_entry', autospec=True)
+    def test_load_not_mountable(self, find_mock, execute_mock):
+        execute_mock.side_effect = processutils.ProcessExecutionError()
+        self.assertFalse(kexec.load(['/dev/sda1']))
+        self.assertFalse(find_mock.called)
+
+
+class TestFlushDevice(base.IronicAgentTest):
+
+    @mock.patch.object(os, 'close', autospec=True)
+    @mock.patch.object(fcntl, 'ioctl', autospec=True)
+    @mock.patch.object(os, 'fdatasync', autospec=True)
+    @mock.patch.object(os, 'open', autospec=True)
+    @mock.patch.object(kexec, 'partitions_of', autospec=True)
+    def test_flush_device(self, partitions_mock, open_mock, fdatasync_mock,
+                          ioctl_mock, close_mock):
+        partitions_mock.return_value = ['/dev/sda1', '/dev/sda2']
+        open_mock.side_effect = [3, 4, 5]
+        kexec.flush_device('/dev/sda')
+        open_mock.assert_has_calls([
+            mock.call('/dev/sda', os.O_RDONLY),
+            mock.call('/dev/sda1', os.O_RDONLY),
+            mock.call('/dev/sda2', os.O_RDONLY)])
+        fdatasync_mock.assert_has_calls([mock.call(3), mock.call(4),
+                                         mock.call(5)])
+        ioctl_mock.assert_has_calls([mock.call(3, kexec.BLKFLSBUF),
+                                     mock.call(4, kexec.BLKFLSBUF),
+                                     mock.call(5, kexec.BLKFLSBUF)])
+        self.assertEqual(3, close_mock.call_count)
+
+    @mock.patch.object(kexec, '_read', autospec=True)
+    @mock.patch('glob.glob', autospec=True)
+    def test_partitions_of(self, glob_mock, read_mock):
+        glob_mock.return_value = ['/sys/class/block/sda/sda10/partition',
+                                  '/sys/class/block/sda/sda2/partition']
+        read_mock.side_effect = ['10\n', '2\n']
+        self.assertEqual(['/dev/sda2', '/dev/sda10'],
+                         kexec.partitions_of('/dev/sda'))
+        glob_mock.assert_called_once_with(
+            '/sys/class/block/sda/sda*/partition')
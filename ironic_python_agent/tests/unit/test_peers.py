@@ -0,0 +1,321 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from wsgiref import simple_server
+
+import mock
+import pecan
+import requests
+from six.moves import BaseHTTPServer
+
+from ironic_python_agent.api import app
+from ironic_python_agent import block_manifest
+from ironic_python_agent.extensions import standby
+from ironic_python_agent import peers
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent.tests.unit import test_block_manifest
+
+BLOCK_SIZE = test_block_manifest.BLOCK_SIZE
+IMAGE = os.urandom(40 * BLOCK_SIZE + 100)
+MANIFEST = test_block_manifest.build_manifest(IMAGE).encode('utf-8')
+
+
+class TestSharedImages(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSharedImages, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'image')
+        with open(self.path, 'wb') as f:
+            f.write(IMAGE)
+        self.manifest = block_manifest.Manifest(MANIFEST)
+        self.shared_images = peers.SharedImages()
+
+    def test_read_chunk(self):
+        self.shared_images.share('fake_id', self.manifest, self.path)
+        self.assertEqual(IMAGE[BLOCK_SIZE:2 * BLOCK_SIZE],
+                         self.shared_images.read_chunk('fake_id', 1))
+        self.assertEqual(IMAGE[40 * BLOCK_SIZE:],
+                         self.shared_images.read_chunk('fake_id', 40))
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', 41))
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', -1))
+        self.assertIsNone(self.shared_images.read_chunk('other_id', 1))
+
+    def test_update(self):
+        self.shared_images.share('fake_id', self.manifest, self.path,
+                                 available=0)
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', 0))
+        self.shared_images.update('fake_id', 2)
+        self.shared_images.update('fake_id', 1)
+        self.assertIsNotNone(self.shared_images.read_chunk('fake_id', 1))
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', 2))
+        self.shared_images.unshare('fake_id')
+        self.shared_images.update('fake_id', 3)
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', 1))
+
+    def test_available(self):
+        self.assertIsNone(self.shared_images.available('fake_id'))
+        self.shared_images.share('fake_id', self.manifest, self.path,
+                                 available=3)
+        self.assertEqual(3, self.shared_images.available('fake_id'))
+        self.shared_images.share('fake_id', self.manifest, self.path)
+        self.assertEqual(41, self.shared_images.available('fake_id'))
+
+    def test_read_chunk_truncated(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(BLOCK_SIZE)
+        self.shared_images.share('fake_id', self.manifest, self.path)
+        self.assertIsNotNone(self.shared_images.read_chunk('fake_id', 0))
+        self.assertIsNone(self.shared_images.read_chunk('fake_id', 1))
+
+
+@mock.patch('requests.get', autospec=True)
+class TestFetchChunk(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestFetchChunk, self).setUp()
+        self.manifest = block_manifest.Manifest(MANIFEST)
+        self.peer = peers.Peer('http://10.0.0.5:9999/')
+
+    def _response(self, status_code, content=b'', available=None):
+        response = mock.Mock()
+        response.status_code = status_code
+        response.content = content
+        response.headers = {}
+        if available is not None:
+            response.headers[peers.AVAILABLE_HEADER] = available
+        return response
+
+    def test_fetch_chunk(self, requests_mock):
+        requests_mock.return_value = self._response(
+            200, IMAGE[BLOCK_SIZE:2 * BLOCK_SIZE], available='7')
+        self.assertEqual(IMAGE[BLOCK_SIZE:2 * BLOCK_SIZE],
+                         peers.fetch_chunk(self.peer, 'fake_id', 1,
+                                           self.manifest))
+        requests_mock.assert_called_once_with(
+            'http://10.0.0.5:9999/v1/images/fake_id/1',
+            timeout=peers.PEER_TIMEOUT)
+        requests_mock.return_value.close.assert_called_once_with()
+        self.assertTrue(self.peer.answered)
+        self.assertTrue(self.peer.sharing)
+        self.assertEqual(7, self.peer.available)
+
+    def test_fetch_chunk_not_held(self, requests_mock):
+        requests_mock.return_value = self._response(404, available='1')
+        self.assertIsNone(peers.fetch_chunk(self.peer, 'fake_id', 1,
+                                            self.manifest))
+        self.assertTrue(self.peer.sharing)
+        self.assertEqual(1, self.peer.available)
+
+    def test_fetch_chunk_not_shared(self, requests_mock):
+        requests_mock.return_value = self._response(404)
+        self.assertIsNone(peers.fetch_chunk(self.peer, 'fake_id', 1,
+                                            self.manifest))
+        self.assertTrue(self.peer.answered)
+        self.assertFalse(self.peer.sharing)
+        self.assertEqual(0, self.peer.available)
+
+    def test_fetch_chunk_invalid_available(self, requests_mock):
+        requests_mock.return_value = self._response(404, available='many')
+        self.assertIsNone(peers.fetch_chunk(self.peer, 'fake_id', 1,
+                                            self.manifest))
+        self.assertFalse(self.peer.sharing)
+
+    def test_fetch_chunk_mismatch(self, requests_mock):
+        requests_mock.return_value = self._response(
+            200, IMAGE[:BLOCK_SIZE])
+        self.assertIsNone(peers.fetch_chunk(self.peer, 'fake_id', 1,
+                                            self.manifest))
+
+    def test_fetch_chunk_unreachable(self, requests_mock):
+        requests_mock.side_effect = requests.exceptions.ConnectionError()
+        self.assertRaises(requests.exceptions.RequestException,
+                          peers.fetch_chunk, self.peer, 'fake_id', 1,
+                          self.manifest)
+        self.assertFalse(self.peer.answered)
+
+
+class _OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves IMAGE and its block manifest, with range requests."""
+
+    def do_GET(self):
+        if self.path.endswith(standby.BLOCK_MANIFEST_SUFFIX):
+            body, status = MANIFEST, 200
+        else:
+            body, status = IMAGE, 200
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                start, end = byte_range.split('=')[1].split('-')
+                body, status = IMAGE[int(start):int(end) + 1], 206
+                with self.server.lock:
+                    self.server.range_requests += 1
+                    self.server.range_bytes += len(body)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (IOError, OSError):
+            # Agents abandon the first request when downloading ranges.
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+_Host = collections.namedtuple('_Host', ['hostname', 'port'])
+
+
+class _FakeAgent(object):
+
+    def __init__(self, extension):
+        self.extension = extension
+        extension.agent = self
+        self.advertise_address = _Host(None, None)
+
+    def get_extension(self, name):
+        return self.extension
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDeploymentWave(base.IronicAgentTest):
+    """Agents deploying the same image share it over their API."""
+
+    def setUp(self):
+        super(TestDeploymentWave, self).setUp()
+        self.config(image_peer_sharing=True)
+        self.addCleanup(pecan.set_config, {}, overwrite=True)
+        # Keep polling peers for the chunks assigned to them, the image is
+        # downloaded from the image server at once.
+        poll_patcher = mock.patch.object(peers, 'PEER_POLL_MAX_INTERVAL',
+                                         peers.PEER_POLL_INTERVAL)
+        poll_patcher.start()
+        self.addCleanup(poll_patcher.stop)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+        self.origin = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _OriginHandler)
+        self.origin.lock = threading.Lock()
+        self.origin.range_requests = 0
+        self.origin.range_bytes = 0
+        self._serve(self.origin)
+
+    def _serve(self, server):
+        # Shutting down waits for the poll interval of the server.
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def _start_agents(self, count):
+        agents = []
+        for i in range(count):
+            extension = standby.StandbyExtension()
+            agent = _FakeAgent(extension)
+            server = simple_server.make_server(
+                '127.0.0.1', 0, app.setup_app(agent=agent),
+                handler_class=_QuietHandler)
+            agent.advertise_address = _Host('127.0.0.1', server.server_port)
+            self._serve(server)
+            agents.append({'extension': extension,
+                           'url': 'http://127.0.0.1:%d' % server.server_port,
+                           'device': os.path.join(self.tempdir,
+                                                  'device%d' % i)})
+        return agents
+
+    def _deploy(self, agent, peer_urls):
+        image_info = {
+            'id': 'fake_id',
+            'urls': ['http://127.0.0.1:%d/image' % self.origin.server_port],
+            'checksum': hashlib.md5(IMAGE).hexdigest(),
+            'no_proxy': '127.0.0.1',
+            'download_connections': 4,
+            'peers': peer_urls,
+        }
+        with open(agent['device'], 'wb'):
+            pass
+        agent['extension']._stream_raw_image_onto_device(image_info,
+                                                         agent['device'])
+        with open(agent['device'], 'rb') as f:
+            self.assertEqual(IMAGE, f.read())
+
+    def _deploy_concurrently(self, agents, peer_urls):
+        threads = []
+        failures = []
+        for agent in agents:
+            def deploy(agent=agent):
+                try:
+                    self._deploy(agent, [url for url in peer_urls
+                                         if url != agent['url']])
+                except Exception as e:
+                    failures.append(e)
+            threads.append(threading.Thread(target=deploy))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], failures)
+
+    def _test_wave(self, size):
+        agents = self._start_agents(size + 1)
+        wave, late = agents[:-1], agents[-1]
+        urls = [agent['url'] for agent in wave]
+        chunks = block_manifest.Manifest(MANIFEST).block_count
+
+        self._deploy_concurrently(wave, urls)
+        # Every chunk was downloaded from the image server once, whatever
+        # the size of the wave.
+        self.assertEqual(chunks, self.origin.range_requests)
+        self.assertEqual(len(IMAGE), self.origin.range_bytes)
+        self.assertEqual((size - 1) * len(IMAGE),
+                         sum(agent['extension'].image_stats['peer_bytes']
+                             for agent in wave))
+
+        # An agent deploying later gets the whole image from the wave.
+        self._deploy(late, urls)
+        self.assertEqual(chunks, self.origin.range_requests)
+        self.assertEqual(len(IMAGE),
+                         late['extension'].image_stats['peer_bytes'])
+
+    def test_wave_2(self):
+        self._test_wave(2)
+
+    def test_wave_4(self):
+        self._test_wave(4)
+
+    def test_wave_6(self):
+        self._test_wave(6)
+
+    def test_without_peers(self):
+        agents = self._start_agents(2)
+        for agent in agents:
+            self._deploy(agent, [])
+        # Every agent downloads the whole image from the image server.
+        self.assertEqual(2 * len(IMAGE), self.origin.range_bytes)
+        for agent in agents:
+            self.assertNotIn('peer_bytes', agent['extension'].image_stats)
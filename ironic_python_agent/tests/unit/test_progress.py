@@ -0,0 +1,92 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import mock
+
+from ironic_python_agent import progress
+from ironic_python_agent.tests.unit import base
+
+
+@mock.patch.object(time, 'time', autospec=True)
+class TestProgress(base.IronicAgentTest):
+
+    def test_snapshot(self, time_mock):
+        time_mock.return_value = 100.0
+        tracker = progress.Progress()
+        tracker.stage = 'stream'
+        tracker.start_download(1000)
+        snapshot = tracker.snapshot()
+        self.assertEqual({'stage': 'stream', 'elapsed_seconds': 0.0,
+                          'total_bytes': 1000, 'downloaded_bytes': 0,
+                          'written_bytes': 0, 'bytes_per_second': None,
+                          'average_bytes_per_second': None,
+                          'eta_seconds': None}, snapshot)
+
+        time_mock.return_value = 102.0
+        tracker.downloaded_bytes = 400
+        tracker.written_bytes = 300
+        snapshot = tracker.snapshot()
+        self.assertEqual(200, snapshot['bytes_per_second'])
+        self.assertEqual(200, snapshot['average_bytes_per_second'])
+        self.assertEqual(3.0, snapshot['eta_seconds'])
+        self.assertEqual(300, snapshot['written_bytes'])
+
+    def test_current_throughput_window(self, time_mock):
+        time_mock.return_value = 0.0
+        tracker = progress.Progress()
+        tracker.start_download(None)
+        for second in range(1, 11):
+            time_mock.return_value = float(second)
+            # Slowing down from 1000 to 100 bytes per second.
+            tracker.downloaded_bytes += 1000 if second <= 5 else 100
+            snapshot = tracker.snapshot()
+        self.assertEqual(100, snapshot['bytes_per_second'])
+        self.assertEqual(550, snapshot['average_bytes_per_second'])
+        self.assertIsNone(snapshot['eta_seconds'])
+
+    def test_start_download_resets(self, time_mock):
+        time_mock.return_value = 0.0
+        tracker = progress.Progress()
+        tracker.start_download(100)
+        tracker.downloaded_bytes = tracker.written_bytes = 100
+        time_mock.return_value = 10.0
+        tracker.start_download(50)
+        snapshot = tracker.snapshot()
+        self.assertEqual(50, snapshot['total_bytes'])
+        self.assertEqual(0, snapshot['downloaded_bytes'])
+        self.assertEqual(0, snapshot['written_bytes'])
+        self.assertEqual(10.0, snapshot['elapsed_seconds'])
+
+    def test_set_stage(self, time_mock):
+        progress.set_stage('download')
+        tracker = progress.Progress()
+        progress.set_current(tracker)
+        self.addCleanup(progress.set_current, None)
+        self.assertIs(tracker, progress.current())
+        progress.set_stage('download')
+        self.assertEqual('download', tracker.stage)
+
+    def test_current_per_thread(self, time_mock):
+        tracker = progress.Progress()
+        progress.set_current(tracker)
+        self.addCleanup(progress.set_current, None)
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(progress.current()))
+        thread.start()
+        thread.join()
+        # Background threads do not update the progress of the command.
+        self.assertEqual([None], seen)
+        self.assertIs(tracker, progress.current())
@@ -0,0 +1,175 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import zlib
+
+from ironic_python_agent import errors
+from ironic_python_agent import qcow2
+from ironic_python_agent.tests.unit import base
+
+CLUSTER_BITS = 9
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+# Two L2 tables worth of clusters plus two, the second L2 table is never
+# allocated.
+VIRTUAL_SIZE = (2 * CLUSTER_SIZE // 8 + 2) * CLUSTER_SIZE
+
+
+def build_image(version=3, backing_file_offset=0, crypt_method=0,
+                incompatible_features=0):
+    """Build a small qcow2 image.
+
+    Guest clusters 0 and 1 are stored in reverse order on the host, cluster
+    3 is compressed, cluster 4 has the zero flag set and everything else is
+    unallocated.
+
+    :returns: A tuple of the image and the raw virtual disk it holds.
+    """
+    cluster_data = [bytes(bytearray([i + 1]) * CLUSTER_SIZE)
+                    for i in range(4)]
+    raw = bytearray(VIRTUAL_SIZE)
+    raw[0:CLUSTER_SIZE] = cluster_data[0]
+    raw[CLUSTER_SIZE:2 * CLUSTER_SIZE] = cluster_data[1]
+    raw[3 * CLUSTER_SIZE:4 * CLUSTER_SIZE] = cluster_data[3]
+
+    l1_offset = CLUSTER_SIZE
+    l2_offset = 2 * CLUSTER_SIZE
+    image = bytearray(7 * CLUSTER_SIZE)
+
+    header = struct.pack('>4sIQIIQIIQQIIQ', qcow2.MAGIC, version,
+                         backing_file_offset, 0, CLUSTER_BITS, VIRTUAL_SIZE,
+                         crypt_method, 3, l1_offset, 0, 0, 0, 0)
+    if version == 3:
+        header += struct.pack('>QQQII', incompatible_features, 0, 0, 4, 104)
+    image[0:len(header)] = header
+    image[l1_offset:l1_offset + 24] = struct.pack('>QQQ',
+                                                  l2_offset | 1 << 63, 0, 0)
+
+    l2 = [0] * (CLUSTER_SIZE // 8)
+    l2[0] = 4 * CLUSTER_SIZE
+    l2[1] = 3 * CLUSTER_SIZE
+    image[4 * CLUSTER_SIZE:5 * CLUSTER_SIZE] = cluster_data[0]
+    image[3 * CLUSTER_SIZE:4 * CLUSTER_SIZE] = cluster_data[1]
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+    compressed = compressor.compress(cluster_data[3]) + compressor.flush()
+    compressed_offset = 5 * CLUSTER_SIZE + 10
+    image[compressed_offset:compressed_offset + len(compressed)] = compressed
+    sectors = (10 + len(compressed) + 511) // 512
+    csize_shift = 62 - (CLUSTER_BITS - 8)
+    l2[3] = (1 << 62 | (sectors - 1) << csize_shift | compressed_offset)
+
+    l2[4] = 6 * CLUSTER_SIZE | 1
+    image[6 * CLUSTER_SIZE:7 * CLUSTER_SIZE] = cluster_data[2]
+
+    image[l2_offset:l2_offset + CLUSTER_SIZE] = struct.pack(
+        '>{}Q'.format(len(l2)), *l2)
+    return bytes(image), bytes(raw)
+
+
+def read_clusters(image):
+    """Parse an image built by build_image."""
+    header = qcow2.Header(image[:qcow2.HEADER_SIZE])
+    l1 = header.parse_l1_table(
+        image[header.l1_table_offset:
+              header.l1_table_offset + header.l1_table_length])
+    clusters = []
+    for index, offset in enumerate(l1):
+        if offset:
+            clusters.extend(header.parse_l2_table(
+                image[offset:offset + header.cluster_size], index))
+    return header, clusters
+
+
+class TestQcow2(base.IronicAgentTest):
+
+    def test_is_qcow2(self):
+        image, raw = build_image()
+        self.assertTrue(qcow2.is_qcow2(image))
+        self.assertFalse(qcow2.is_qcow2(raw))
+
+    def test_header(self):
+        for version in (2, 3):
+            image, raw = build_image(version=version)
+            header = qcow2.Header(image[:qcow2.HEADER_SIZE])
+            self.assertEqual(version, header.version)
+            self.assertEqual(CLUSTER_SIZE, header.cluster_size)
+            self.assertEqual(VIRTUAL_SIZE, header.virtual_size)
+            self.assertEqual(CLUSTER_SIZE, header.l1_table_offset)
+            self.assertEqual(24, header.l1_table_length)
+
+    def test_header_invalid(self):
+        image, raw = build_image()
+        self.assertRaisesRegex(errors.ImageFormatError, 'Not a qcow2 image',
+                               qcow2.Header, raw)
+        self.assertRaisesRegex(errors.ImageFormatError, 'Not a qcow2 image',
+                               qcow2.Header, image[:20])
+        bad_version = image[:4] + struct.pack('>I', 4) + image[8:]
+        self.assertRaisesRegex(errors.ImageFormatError, 'version 4',
+                               qcow2.Header, bad_version)
+
+    def test_header_unsupported_features(self):
+        for kwargs, msg in [({'backing_file_offset': 4096}, 'backing file'),
+                            ({'crypt_method': 1}, 'Encrypted'),
+                            ({'incompatible_features': 1 << 2},
+                             'incompatible features 0x4')]:
+            image, raw = build_image(**kwargs)
+            self.assertRaisesRegex(errors.ImageFormatError, msg,
+                                   qcow2.Header, image[:qcow2.HEADER_SIZE])
+
+    def test_virtual_size(self):
+        image, raw = build_image(backing_file_offset=4096)
+        self.assertEqual(VIRTUAL_SIZE,
+                         qcow2.virtual_size(image[:qcow2.HEADER_SIZE]))
+        self.assertIsNone(qcow2.virtual_size(raw))
+        self.assertIsNone(qcow2.virtual_size(image[:20]))
+
+    def test_tables(self):
+        image, raw = build_image()
+        header, clusters = read_clusters(image)
+
+        self.assertEqual(
+            [(0, CLUSTER_SIZE, 4 * CLUSTER_SIZE, qcow2.DATA),
+             (CLUSTER_SIZE, CLUSTER_SIZE, 3 * CLUSTER_SIZE, qcow2.DATA),
+             (3 * CLUSTER_SIZE, CLUSTER_SIZE, 5 * CLUSTER_SIZE + 10,
+              qcow2.COMPRESSED)],
+            [(c.guest_offset, c.guest_length, c.host_offset, c.kind)
+             for c in clusters])
+
+    def test_convert(self):
+        image, raw = build_image()
+        header, clusters = read_clusters(image)
+
+        converted = bytearray(VIRTUAL_SIZE)
+        for cluster in clusters:
+            data = image[cluster.host_offset:
+                         cluster.host_offset + cluster.host_length]
+            if cluster.kind == qcow2.COMPRESSED:
+                data = header.decompress(data)
+            converted[cluster.guest_offset:
+                      cluster.guest_offset + cluster.guest_length] = (
+                data[:cluster.guest_length])
+        self.assertEqual(raw, bytes(converted))
+
+    def test_truncated_tables(self):
+        image, raw = build_image()
+        header = qcow2.Header(image[:qcow2.HEADER_SIZE])
+        self.assertRaises(errors.ImageFormatError, header.parse_l1_table,
+                          b'\0' * 8)
+        self.assertRaises(errors.ImageFormatError, header.parse_l2_table,
+                          b'\0' * 8, 0)
+
+    def test_decompress_invalid(self):
+        image, raw = build_image()
+        header = qcow2.Header(image[:qcow2.HEADER_SIZE])
+        self.assertRaises(errors.ImageFormatError, header.decompress,
+                          b'not deflate data')
@@ -0,0 +1,67 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import errno
+import os
+import socket
+import tempfile
+
+import mock
+
+from ironic_python_agent import splice
+from ironic_python_agent.tests.unit import base
+
+
+class TestSplice(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSplice, self).setUp()
+        if not splice.available():
+            self.skipTest('splice is not available')
+        self.read_fd, self.write_fd = splice.pipe(64 * 1024)
+        self.addCleanup(os.close, self.read_fd)
+        self.addCleanup(os.close, self.write_fd)
+
+    def test_splice_tee(self):
+        sender, receiver = socket.socketpair()
+        self.addCleanup(sender.close)
+        self.addCleanup(receiver.close)
+        sender.sendall(b'spliced data')
+        self.assertEqual(12, splice.splice(receiver.fileno(),
+                                           self.write_fd, 100))
+
+        copy_read, copy_write = splice.pipe(64 * 1024)
+        self.addCleanup(os.close, copy_read)
+        self.addCleanup(os.close, copy_write)
+        self.assertEqual(12, splice.tee(self.read_fd, copy_write, 100))
+        self.assertEqual(b'spliced data', os.read(copy_read, 100))
+
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(12, splice.splice(self.read_fd, f.fileno(), 12,
+                                               offset_out=4))
+            f.seek(0)
+            self.assertEqual(b'\0\0\0\0spliced data', f.read())
+            # The position of the file is not used.
+            self.assertEqual(16, f.tell())
+
+    def test_splice_error(self):
+        error = self.assertRaises(OSError, splice.splice, -1,
+                                  self.write_fd, 100)
+        self.assertEqual(errno.EBADF, error.errno)
+
+    @mock.patch.object(ctypes, 'get_errno', autospec=True)
+    def test_retry_interrupted(self, errno_mock):
+        errno_mock.return_value = errno.EINTR
+        func = mock.Mock(side_effect=[-1, 5])
+        self.assertEqual(5, splice._call(func, 1, 2))
+        self.assertEqual(2, func.call_count)